@@ -0,0 +1,152 @@
+import hashlib
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from os import getenv
+from typing import Union
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import Field, SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from database import write_session
+
+
+# Cache settings (can be tuned through .env)
+
+ADVICE_CACHE_SIZE = int(getenv("ADVICE_CACHE_SIZE", "1024"))
+ADVICE_CACHE_TTL = int(getenv("ADVICE_CACHE_TTL", str(7 * 24 * 3600)))
+ADVICE_CACHE_MAX_ROWS = int(getenv("ADVICE_CACHE_MAX_ROWS", "10000"))
+
+
+class AdviceCacheEntry(SQLModel, table=True):
+    key: str = Field(primary_key=True)
+    prompt_version: str
+    advice: str
+    created_at: datetime = Field(index=True)
+
+
+# The prompt version is a hash of the prompt template itself,
+# so editing the template makes every old answer a miss
+
+def prompt_version(template: str) -> str:
+    return hashlib.sha256(template.encode()).hexdigest()[:12]
+
+
+# Descriptions that differ only in case or spacing share one answer
+
+def cache_key(description: str, version: str) -> str:
+    normalised = " ".join(description.lower().split())
+    return hashlib.sha256(f"{version}:{normalised}".encode()).hexdigest()
+
+
+# Two tiers: an LRU dict inside the process and an SQLite table that survives restarts.
+# Entries expire after "ttl" seconds, the table keeps at most "max_rows" newest answers.
+# Writes take their turn with all other writers (see database.write_session)
+
+class AdviceCache:
+    def __init__(self, engine: AsyncEngine, version: str, *,
+                 max_items: int = ADVICE_CACHE_SIZE,
+                 ttl: int = ADVICE_CACHE_TTL,
+                 max_rows: int = ADVICE_CACHE_MAX_ROWS):
+        self.engine = engine
+        self.version = version
+        self.max_items = max_items
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self._memory: OrderedDict[str, tuple[str, float]] = OrderedDict()
+
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def key(self, description: str) -> str:
+        return cache_key(description, self.version)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "memory_items": len(self._memory),
+        }
+
+    def _remember(self, key: str, advice: str, expires_at: float) -> None:
+        self._memory[key] = (advice, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    async def get(self, description: str) -> Union[str, None]:
+        key = self.key(description)
+
+        cached = self._memory.get(key)
+        if cached is not None:
+            advice, expires_at = cached
+            if expires_at > time.time():
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return advice
+            del self._memory[key]
+
+        oldest = datetime.now() - timedelta(seconds=self.ttl)
+        async with AsyncSession(self.engine) as session:
+            entry = await session.scalar(select(AdviceCacheEntry)
+                                         .where(AdviceCacheEntry.key == key,
+                                                AdviceCacheEntry.created_at > oldest))
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.db_hits += 1
+        expires_at = (entry.created_at + timedelta(seconds=self.ttl)).timestamp()
+        self._remember(key, entry.advice, expires_at)
+        return entry.advice
+
+    # Whether there is a fresh answer, without counting it as a hit or a miss
+
+    async def has(self, description: str) -> bool:
+        key = self.key(description)
+
+        cached = self._memory.get(key)
+        if cached is not None and cached[1] > time.time():
+            return True
+
+        oldest = datetime.now() - timedelta(seconds=self.ttl)
+        async with AsyncSession(self.engine) as session:
+            found = await session.scalar(select(AdviceCacheEntry.key)
+                                         .where(AdviceCacheEntry.key == key,
+                                                AdviceCacheEntry.created_at > oldest))
+        return found is not None
+
+    async def set(self, description: str, advice: str) -> None:
+        key = self.key(description)
+        now = datetime.now().replace(microsecond=0)
+        self._remember(key, advice, now.timestamp() + self.ttl)
+
+        row = {"key": key, "prompt_version": self.version, "advice": advice, "created_at": now}
+        query = insert(AdviceCacheEntry).values(**row)
+        query = query.on_conflict_do_update(index_elements=[AdviceCacheEntry.key], set_=row)
+
+        # Keeping only the newest "max_rows" answers
+        evicted = (select(AdviceCacheEntry.key)
+                   .order_by(AdviceCacheEntry.created_at.desc())
+                   .limit(-1).offset(self.max_rows))
+
+        async with write_session(self.engine) as session:
+            await session.exec(query)
+            await session.exec(delete(AdviceCacheEntry).where(AdviceCacheEntry.key.in_(evicted)))
+            await session.commit()
+
+    # Dropping expired answers and answers to other prompt versions
+
+    async def purge(self) -> None:
+        oldest = datetime.now() - timedelta(seconds=self.ttl)
+        async with write_session(self.engine) as session:
+            await session.exec(delete(AdviceCacheEntry)
+                               .where((AdviceCacheEntry.prompt_version != self.version)
+                                      | (AdviceCacheEntry.created_at <= oldest)))
+            await session.commit()
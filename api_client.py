@@ -0,0 +1,270 @@
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from os import getenv
+from typing import Any, AsyncIterator, Callable, Union
+
+import httpx
+from dotenv import load_dotenv
+from models import TasksInfo, TasksDeleteOut, TasksBatchOut, Reminder
+load_dotenv()
+
+
+API_BASE_URL = getenv("API_BASE_URL", "http://localhost:8000")
+
+logger = logging.getLogger(__name__)
+
+
+# Connection pool and retry settings (can be tuned through .env)
+
+MAX_CONNECTIONS = int(getenv("API_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE_CONNECTIONS = int(getenv("API_MAX_KEEPALIVE_CONNECTIONS", "20"))
+KEEPALIVE_EXPIRY = float(getenv("API_KEEPALIVE_EXPIRY", "30"))
+MAX_RETRIES = int(getenv("API_MAX_RETRIES", "3"))
+RETRY_BACKOFF = float(getenv("API_RETRY_BACKOFF", "0.2"))
+
+
+# Per-endpoint timeouts: regular calls are answered by the database,
+# while an advice request waits for the Sonar model
+
+DEFAULT_TIMEOUT = httpx.Timeout(10.0, connect=3.0)
+SONAR_TIMEOUT = httpx.Timeout(30.0, connect=3.0)
+
+RETRY_STATUS_CODES = {502, 503, 504}
+
+# How many users' task lists and counts the bot keeps to revalidate with ETags
+CACHE_SIZE = int(getenv("API_CACHE_SIZE", "1000"))
+
+
+class APIError(Exception):
+    def __init__(self, status_code: int, detail: Any = None):
+        super().__init__(f"API responded with {status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+
+class TaskNotFound(APIError):
+    pass
+
+
+# A small LRU of responses, each stored with the tag (ETag or version) it was current for
+
+class ResponseCache:
+    def __init__(self, max_items: int = CACHE_SIZE):
+        self.max_items = max_items
+        self._items: OrderedDict[Any, tuple[Any, Any]] = OrderedDict()
+
+    def get(self, key: Any) -> Union[tuple[Any, Any], None]:
+        item = self._items.get(key)
+        if item is not None:
+            self._items.move_to_end(key)
+        return item
+
+    def set(self, key: Any, tag: Any, value: Any) -> None:
+        self._items[key] = (tag, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+
+# A single client shared by all bot handlers.
+# It keeps connections to the API alive instead of opening a new one for every request
+
+def raise_for_status(resp: httpx.Response) -> None:
+    if not resp.is_error:
+        return
+
+    try:
+        detail = resp.json()
+    except ValueError:
+        detail = resp.text
+    if resp.status_code == 404:
+        raise TaskNotFound(resp.status_code, detail)
+    raise APIError(resp.status_code, detail)
+
+
+class TaskAPIClient:
+    def __init__(self, base_url: str = API_BASE_URL, *,
+                 max_connections: int = MAX_CONNECTIONS,
+                 max_keepalive_connections: int = MAX_KEEPALIVE_CONNECTIONS,
+                 keepalive_expiry: float = KEEPALIVE_EXPIRY,
+                 max_retries: int = MAX_RETRIES,
+                 retry_backoff: float = RETRY_BACKOFF,
+                 transport: Union[httpx.AsyncBaseTransport, None] = None):
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._client = httpx.AsyncClient(base_url=base_url,
+                                         limits=limits,
+                                         timeout=DEFAULT_TIMEOUT,
+                                         transport=transport)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.cache = ResponseCache()
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+    async def __aenter__(self) -> "TaskAPIClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+
+    # Sends a request and raises APIError on a non-2xx answer, or with status 503 when
+    # the API can't be reached at all. Only calls marked as idempotent are retried,
+    # with exponential backoff
+
+    async def _request(self, method: str, url: str, *, idempotent: bool = False,
+                       timeout: httpx.Timeout = DEFAULT_TIMEOUT, **kwargs) -> httpx.Response:
+        attempts = self.max_retries + 1 if idempotent else 1
+
+        for attempt in range(attempts):
+            last_try = attempt == attempts - 1
+            try:
+                resp = await self._client.request(method, url, timeout=timeout, **kwargs)
+            except httpx.TransportError as exc:
+                if last_try:
+                    raise APIError(503, f"API is unreachable: {exc!r}") from exc
+                logger.warning("%s %s failed (%s), retrying", method, url, exc)
+            else:
+                if resp.status_code not in RETRY_STATUS_CODES or last_try:
+                    break
+                logger.warning("%s %s answered %s, retrying", method, url, resp.status_code)
+
+            await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+
+        raise_for_status(resp)
+        return resp
+
+
+    # GET with If-None-Match: an unchanged resource costs a 304 and is taken from the cache
+
+    async def _get_cached(self, url: str, read: Callable[[httpx.Response], Any] = httpx.Response.json) -> Any:
+        cached = self.cache.get(url)
+        headers = {"If-None-Match": cached[0]} if cached else {}
+
+        resp = await self._request("GET", url, headers=headers, idempotent=True)
+        if resp.status_code == 304 and cached:
+            return cached[1]
+
+        data = read(resp)
+        if "ETag" in resp.headers:
+            self.cache.set(url, resp.headers["ETag"], data)
+        return data
+
+
+    # Users
+
+    async def register_user(self, tg_id: int, name: str) -> None:
+        await self._request("POST", "/user/new/", params={"tg_id": tg_id, "name": name},
+                            idempotent=True)
+
+    async def get_user_info(self, user_id: int) -> TasksInfo:
+        resp = await self._request("GET", "/tasks/user/", params={"user_id": user_id},
+                                   idempotent=True)
+        return TasksInfo.model_validate(resp.json())
+
+
+    # Tasks
+
+    async def get_tasks(self, tg_id: int) -> list[dict]:
+        return await self._get_cached(f"/tasks/{tg_id}")
+
+    # One page of the user's tasks and the number of all of them
+
+    async def get_tasks_page(self, tg_id: int, offset: int, limit: int) -> tuple[list[dict], int]:
+        return await self._get_cached(f"/tasks/{tg_id}?offset={offset}&limit={limit}",
+                                      lambda resp: (resp.json(), int(resp.headers["X-Total-Count"])))
+
+    async def get_tasks_count(self, tg_id: int) -> int:
+        return int((await self._get_cached(f"/tasks/count/{tg_id}"))["count"])
+
+    # User's tasks whose description has every word of "query", best matches first
+
+    async def search_tasks(self, tg_id: int, query: str, limit: int) -> list[dict]:
+        resp = await self._request("GET", "/tasks/search", params={"tg_id": tg_id, "q": query, "limit": limit},
+                                   idempotent=True)
+        return resp.json()
+
+    async def create_task(self, tg_id: int, description: str, deadline: int) -> dict:
+        resp = await self._request("POST", "/tasks/",
+                                   json={"description": description,
+                                         "deadline": deadline,
+                                         "tg_id": tg_id})
+        return resp.json()
+
+    # "tasks" are {"description": ..., "deadline": days or None}, the numbers of the new tasks are returned
+
+    async def create_tasks(self, tg_id: int, tasks: list[dict]) -> list[int]:
+        resp = await self._request("POST", "/tasks/batch", json={"tg_id": tg_id, "tasks": tasks})
+        return TasksBatchOut.model_validate(resp.json()).ordinals
+
+    async def mark_done(self, user_id: int, task_id: int) -> dict:
+        resp = await self._request("PUT", "/tasks/", params={"user_id": user_id, "task_id": task_id},
+                                   idempotent=True)
+        return resp.json()
+
+    async def delete_task(self, item_id: int) -> None:
+        await self._request("DELETE", "/tasks/delete/", params={"item_id": item_id})
+
+    # Not retried: after a lost answer the repeat would report every number as not deleted
+
+    async def delete_tasks(self, tg_id: int, task_ids: list[int]) -> TasksDeleteOut:
+        resp = await self._request("POST", "/tasks/delete/bulk/",
+                                   json={"tg_id": tg_id, "task_ids": task_ids})
+        return TasksDeleteOut.model_validate(resp.json())
+
+
+    # Reminders
+
+    async def get_due_reminders(self, limit: int) -> list[Reminder]:
+        resp = await self._request("GET", "/reminders/due/", params={"limit": limit}, idempotent=True)
+        return [Reminder.model_validate(item) for item in resp.json()]
+
+    async def mark_reminders_sent(self, ids: list[int]) -> None:
+        await self._request("POST", "/reminders/sent/", json={"ids": ids}, idempotent=True)
+
+
+    # AI advice
+
+    # Reserving and refunding are idempotent thanks to the request key
+
+    async def reserve_quota(self, user_id: int, request_key: str) -> bool:
+        resp = await self._request("POST", "/quota/reserve/",
+                                   params={"user_id": user_id, "request_key": request_key},
+                                   idempotent=True)
+        return resp.json()["reserved"]
+
+    async def refund_quota(self, request_key: str) -> None:
+        await self._request("POST", "/quota/refund/", params={"request_key": request_key},
+                            idempotent=True)
+
+    async def get_advice(self, user_id: int, task_id: int) -> str:
+        resp = await self._request("GET", "/sonar/", params={"user_id": user_id, "task_id": task_id},
+                                   timeout=SONAR_TIMEOUT)
+        return resp.json()
+
+    # Yields pieces of the advice as soon as the API receives them from Sonar
+
+    async def stream_advice(self, user_id: int, task_id: int) -> AsyncIterator[str]:
+        params = {"user_id": user_id, "task_id": task_id, "stream": True}
+        try:
+            async with self._client.stream("GET", "/sonar/", params=params, timeout=SONAR_TIMEOUT) as resp:
+                if resp.is_error:
+                    await resp.aread()
+                    raise_for_status(resp)
+
+                async for line in resp.aiter_lines():
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    if "error" in data:
+                        raise APIError(502, data["error"])
+                    yield data["text"]
+        except httpx.HTTPError as exc:
+            raise APIError(502, str(exc)) from exc
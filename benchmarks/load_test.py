@@ -0,0 +1,84 @@
+"""Concurrent load test for the task API.
+
+Start the API first (`fastapi run main.py`), then run:
+
+    python benchmarks/load_test.py --users 50 --requests 2000 --concurrency 50
+
+Every simulated user registers, then the workers fire a mix of the bot's
+hot calls (create task, list, profile, count, mark done) and the script
+prints throughput and latency percentiles per call. With --read-only
+only the list, profile and count calls are made.
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import httpx
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def run(args) -> None:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    timings: dict[str, list[float]] = {}
+    errors = 0
+
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=30.0) as client:
+        user_ids = [args.first_user + i for i in range(args.users)]
+        for user_id in user_ids:
+            await client.post("/user/new/", params={"tg_id": user_id, "name": f"load{user_id}"})
+            await client.post("/tasks/", json={"tg_id": user_id, "description": "warm up", "deadline": 1})
+
+        calls = [
+            ("create", lambda u: client.post("/tasks/", json={"tg_id": u, "description": "load test", "deadline": 3})),
+            ("list", lambda u: client.get(f"/tasks/{u}")),
+            ("profile", lambda u: client.get("/tasks/user/", params={"user_id": u})),
+            ("count", lambda u: client.get(f"/tasks/count/{u}")),
+            ("done", lambda u: client.put("/tasks/", params={"user_id": u, "task_id": 1})),
+        ]
+        if args.read_only:
+            calls = [call for call in calls if call[0] in ("list", "profile", "count")]
+
+        queue: asyncio.Queue = asyncio.Queue()
+        for _ in range(args.requests):
+            queue.put_nowait((random.choice(calls), random.choice(user_ids)))
+
+        async def worker():
+            nonlocal errors
+            while not queue.empty():
+                (name, call), user_id = queue.get_nowait()
+                start = time.perf_counter()
+                try:
+                    resp = await call(user_id)
+                    if resp.is_error:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                timings.setdefault(name, []).append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    print(f"{args.requests} requests, concurrency {args.concurrency}: "
+          f"{args.requests / elapsed:.1f} req/s, {errors} errors")
+    for name, values in sorted(timings.items()):
+        print(f"  {name:8} n={len(values):5}  mean={statistics.mean(values) * 1000:7.1f} ms  "
+              f"p50={percentile(values, 0.5) * 1000:7.1f} ms  p95={percentile(values, 0.95) * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--first-user", type=int, default=900_000_000)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--read-only", action="store_true")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,138 @@
+"""Task search benchmark: services.search_tasks (FTS5) vs a LIKE scan of the user's tasks.
+
+Fills a temporary database with --rows tasks of --users users (every user gets the
+same number of tasks, descriptions are made of words drawn from a Zipf-like
+vocabulary, so some words are in almost every task and some are rare) plus one
+user with --heavy tasks, then times the queries below with both ways of searching,
+for random users and for the heavy one:
+
+    common    a frequent word
+    rare      a rare word
+    prefix    the first 3 letters of a frequent word
+    words     a frequent and a rare word
+
+    before    description LIKE '%word%' for every word, on the (tg_id, ordinal) index
+    after     services.search_tasks
+
+Prints the median, p95 and p99 of --queries runs of each:
+
+    python benchmarks/search.py --rows 1000000 --users 10000
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from sqlalchemy import insert
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("PERPLEXITY_API_KEY", "benchmark")
+
+from sqlmodel import select
+
+import database
+import services
+from database import TasksDB
+from storage import PROFILES, create_engine
+from suite import percentile
+
+SYLLABLES = ["ка", "ло", "ми", "ре", "ту", "на", "по", "ве", "да", "зо", "ри", "ку", "са", "те", "бы", "го"]
+WORDS_PER_TASK = 6
+SEED_BATCH = 20_000
+
+
+def vocabulary(size: int, rng: random.Random) -> list[str]:
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+async def seed(args, words: list[str], weights: list[float], rng: random.Random) -> None:
+    per_user = args.rows // args.users
+    now = datetime.now().replace(microsecond=0)
+    rows = []
+    async with database.engine.begin() as conn:
+        for tg_id in range(1, args.users + 2):
+            for ordinal in range(1, (per_user if tg_id <= args.users else args.heavy) + 1):
+                rows.append({"tg_id": tg_id, "ordinal": ordinal, "status": "incomplete", "reminder_sent": False,
+                             "description": " ".join(rng.choices(words, weights, k=WORDS_PER_TASK)),
+                             "created_at": now})
+                if len(rows) == SEED_BATCH:
+                    await conn.execute(insert(TasksDB), rows)
+                    rows = []
+        if rows:
+            await conn.execute(insert(TasksDB), rows)
+
+
+async def like_search(tg_id: int, text: str, limit: int) -> list:
+    query = select(*services.TASK_COLUMNS).where(TasksDB.tg_id == tg_id)
+    for word in text.split():
+        query = query.where(TasksDB.description.like(f"%{word}%"))
+    async with database.read_session() as session:
+        return list((await session.exec(query.order_by(TasksDB.ordinal).limit(limit))).all())
+
+
+async def fts_search(tg_id: int, text: str, limit: int) -> list:
+    async with database.read_session() as session:
+        return await services.search_tasks(session, tg_id, text, limit)
+
+
+async def run(args) -> None:
+    rng = random.Random(args.seed)
+    words = vocabulary(args.vocabulary, rng)
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.engine = create_engine(f"sqlite+aiosqlite:///{tmp}/bench.db", PROFILES["production"],
+                                        connect_args={"check_same_thread": False})
+        await database.create_db_and_tables()
+
+        started = time.perf_counter()
+        await seed(args, words, weights, rng)
+        print(f"seeded {args.rows} + {args.heavy} tasks of {args.users} + 1 users in {time.perf_counter() - started:.1f}s, "
+              f"database {sum(f.stat().st_size for f in Path(tmp).iterdir()) / 2**20:.0f} MB")
+
+        common, rare = words[:10], words[len(words) // 2:]
+        queries = {
+            "common": lambda: rng.choice(common),
+            "rare": lambda: rng.choice(rare),
+            "prefix": lambda: rng.choice(common)[:3],
+            "words": lambda: f"{rng.choice(common)} {rng.choice(rare)}",
+        }
+
+        users = {"random": lambda: rng.randint(1, args.users), "heavy": lambda: args.users + 1}
+
+        print(f"{'user':7} {'query':8} {'':7} {'p50':>9} {'p95':>9} {'p99':>9} {'found':>7}")
+        for user, pick_user in users.items():
+            for name, make in queries.items():
+                for label, search in (("before", like_search), ("after", fts_search)):
+                    timings, found = [], 0
+                    for _ in range(args.queries):
+                        tg_id, text = pick_user(), make()
+                        started = time.perf_counter()
+                        found += len(await search(tg_id, text, args.limit))
+                        timings.append(time.perf_counter() - started)
+                    print(f"{user:7} {name:8} {label:7} {percentile(timings, 0.5) * 1000:7.2f}ms "
+                          f"{percentile(timings, 0.95) * 1000:7.2f}ms {percentile(timings, 0.99) * 1000:7.2f}ms "
+                          f"{found / args.queries:7.1f}")
+
+        await database.engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--heavy", type=int, default=5000, help="tasks of the user with many tasks")
+    parser.add_argument("--vocabulary", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,118 @@
+"""Task list serialization benchmark: ORM objects + response_model vs column rows + orjson.
+
+Fills a temporary database with one user's tasks and times, for every row count
+in --rows, the two halves of a /tasks/{tg_id} response the old way and the new way:
+
+    query   select(TasksDB) into ORM objects   vs  services.list_tasks (plain rows)
+    encode  response_model=list[TasksDB] with  vs  ORJSONResponse of the rows
+            JSONResponse (pydantic validation
+            and jsonable_encoder)
+
+The encode step runs through a FastAPI app over ASGI, so it includes everything
+FastAPI does with the endpoint's return value. Prints the median time of
+--repeat runs and the response size:
+
+    python benchmarks/serialization.py --rows 1000 100000
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import httpx
+from fastapi import FastAPI, responses
+from sqlalchemy import insert
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("PERPLEXITY_API_KEY", "benchmark")
+
+from sqlmodel import select
+
+import database
+import services
+from database import TasksDB
+from storage import PROFILES, create_engine
+
+USER = 1
+
+
+def encode_app(rows: list, tasks: list) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/before", response_model=list[TasksDB])
+    async def before():
+        return tasks
+
+    @app.get("/after")
+    async def after():
+        return responses.ORJSONResponse(content=rows)
+
+    return app
+
+
+async def seed(count: int) -> None:
+    deadline = datetime.now().replace(microsecond=0) + timedelta(days=3)
+    async with database.engine.begin() as conn:
+        await conn.execute(TasksDB.__table__.delete())
+        await conn.execute(insert(TasksDB), [
+            {"tg_id": USER, "ordinal": i, "status": "incomplete", "reminder_sent": False,
+             "description": f"Задача номер {i}: подготовить отчёт и отправить его команде",
+             "created_at": datetime.now().replace(microsecond=0), "deadline": deadline}
+            for i in range(1, count + 1)])
+
+
+async def timed(repeat: int, call) -> tuple[float, object]:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = await call()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), result
+
+
+async def run(args) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        database.engine = create_engine(f"sqlite+aiosqlite:///{tmp}/bench.db", PROFILES["production"],
+                                        connect_args={"check_same_thread": False})
+        await database.create_db_and_tables()
+
+        print(f"{'rows':>8} {'':7} {'query':>10} {'encode':>10} {'total':>10} {'size':>10}")
+        for count in args.rows:
+            await seed(count)
+
+            async def query_orm():
+                async with database.read_session() as session:
+                    query = select(TasksDB).where(TasksDB.tg_id == USER).order_by(TasksDB.ordinal)
+                    return list((await session.exec(query)).all())
+
+            async def query_rows():
+                async with database.read_session() as session:
+                    return await services.list_tasks(session, USER)
+
+            query_before, tasks = await timed(args.repeat, query_orm)
+            query_after, rows = await timed(args.repeat, query_rows)
+
+            transport = httpx.ASGITransport(app=encode_app(rows, tasks))
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                encode_before, before = await timed(args.repeat, lambda: client.get("/before"))
+                encode_after, after = await timed(args.repeat, lambda: client.get("/after"))
+
+            for name, query, encode, resp in (("before", query_before, encode_before, before),
+                                              ("after", query_after, encode_after, after)):
+                print(f"{count:>8} {name:7} {query * 1000:8.1f}ms {encode * 1000:8.1f}ms "
+                      f"{(query + encode) * 1000:8.1f}ms {len(resp.content) / 1024:8.0f}KB")
+
+        await database.engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 100_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,75 @@
+"""Storage profile benchmark: create_task and get_tasks under concurrent writers.
+
+Runs the API in-process against a fresh temporary database for every
+profile in storage.PROFILES and prints operations per second:
+
+    python benchmarks/storage_profile.py --writers 20 --readers 20 --seconds 10
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("PERPLEXITY_API_KEY", "benchmark")
+
+import database
+import main
+from storage import PROFILES, checkpoint, create_engine
+
+
+async def run_profile(name: str, args) -> dict[str, float]:
+    profile = PROFILES[name]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.engine = create_engine(f"sqlite+aiosqlite:///{tmp}/bench.db", profile,
+                                    connect_args={"check_same_thread": False})
+        await database.create_db_and_tables()
+
+        transport = httpx.ASGITransport(app=main.app)
+        counts = {"create_task": 0, "get_tasks": 0}
+        deadline = time.perf_counter() + args.seconds
+
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            async def writer(user_id: int):
+                while time.perf_counter() < deadline:
+                    resp = await client.post("/tasks/", json={"tg_id": user_id, "description": "bench", "deadline": 2})
+                    resp.raise_for_status()
+                    counts["create_task"] += 1
+
+            async def reader(user_id: int):
+                while time.perf_counter() < deadline:
+                    resp = await client.get(f"/tasks/{user_id}")
+                    resp.raise_for_status()
+                    counts["get_tasks"] += 1
+
+            await asyncio.gather(*(writer(i % args.users) for i in range(args.writers)),
+                                 *(reader(i % args.users) for i in range(args.readers)))
+
+        if profile.journal_mode == "WAL":
+            await checkpoint(database.engine, "TRUNCATE")
+        await database.engine.dispose()
+
+    return {op: count / args.seconds for op, count in counts.items()}
+
+
+async def run(args) -> None:
+    for name in args.profiles:
+        result = await run_profile(name, args)
+        print(f"{name:12} " + "  ".join(f"{op}={rate:8.1f}/s" for op, rate in result.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--profiles", nargs="+", default=list(PROFILES), choices=list(PROFILES))
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--writers", type=int, default=20)
+    parser.add_argument("--readers", type=int, default=20)
+    parser.add_argument("--seconds", type=float, default=10)
+    asyncio.run(run(parser.parse_args()))
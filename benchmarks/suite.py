@@ -0,0 +1,372 @@
+"""Benchmark suite for the hot flows of the API and the bot.
+
+Seeds a temporary SQLite database with --users users and --tasks tasks each,
+then measures every flow twice: through the main.py endpoints (ASGI client)
+and as a conversation with the bot, fed as synthetic Telegram updates to the
+tg_bot.py Dispatcher with a fake Bot. Perplexity is stubbed with a fixed
+--sonar-latency. Prints p50/p95/p99 latency and throughput per flow, and
+writes them to a JSON file that a later run can be compared with:
+
+    python benchmarks/suite.py --output before.json
+    python benchmarks/suite.py --output after.json --compare before.json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("PERPLEXITY_API_KEY", "benchmark")
+os.environ.setdefault("BOT_TOKEN", "42:benchmark")
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import EditMessageText, SendMessage
+from aiogram.types import Message, Update
+from sqlalchemy import insert
+
+import database
+import main
+import services
+import tg_bot
+from api_client import TaskAPIClient
+from local_client import LocalTaskClient
+from storage import PROFILES, create_engine
+
+# Bulk delete goes last, as it takes away tasks the other flows refer to
+FLOWS = ["add_task", "add_batch", "list", "mark_done", "advice", "bulk_delete"]
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def summarize(timings: list[float], elapsed: float) -> dict[str, float]:
+    return {
+        "count": len(timings),
+        "throughput": len(timings) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(timings, 0.5) * 1000,
+        "p95_ms": percentile(timings, 0.95) * 1000,
+        "p99_ms": percentile(timings, 0.99) * 1000,
+    }
+
+
+# Perplexity stand-in: answers after a fixed delay, in a few pieces when streaming
+
+class FakeCompletions:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def create(self, *, messages, model, stream=False):
+        await asyncio.sleep(self.latency)
+        answer = "Разбейте задачу на шаги и начните с самого простого."
+        if not stream:
+            return types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=answer))])
+        return FakeStream(answer.split(" "))
+
+
+class FakeStream:
+    def __init__(self, words: list[str]):
+        self.words = iter(words)
+
+    async def __anext__(self):
+        word = next(self.words, None)
+        if word is None:
+            raise StopAsyncIteration
+        delta = types.SimpleNamespace(content=word + " ")
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)])
+
+    async def close(self):
+        pass
+
+
+# Telegram stand-in: every call succeeds at once, sent and edited messages are echoed back
+
+class FakeSession(BaseSession):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+        self.message_ids = itertools.count(1)
+
+    async def make_request(self, bot: Bot, method, timeout=None) -> Any:
+        self.calls += 1
+        if isinstance(method, (SendMessage, EditMessageText)):
+            return Message.model_validate({
+                "message_id": getattr(method, "message_id", None) or next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": method.chat_id, "type": "private"},
+                "text": method.text,
+            }, context={"bot": bot})
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        return
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+
+async def seed(args) -> None:
+    await database.create_db_and_tables()
+    deadline = datetime.now().replace(microsecond=0) + timedelta(days=3)
+
+    async with database.engine.begin() as conn:
+        await conn.execute(insert(database.Users), [
+            {"tg_id": user_id, "username": f"user{user_id}", "user_since": datetime.now().date()}
+            for user_id in user_ids(args)])
+        # Unlimited, so the advice flow isn't cut off by the daily limit
+        await conn.execute(insert(database.UsageLimit), [
+            {"user_id": user_id, "requests_count": 0, "unlimited": True} for user_id in user_ids(args)])
+        await conn.execute(insert(database.TasksDB), [
+            {"tg_id": user_id, "ordinal": ordinal, "status": "incomplete", "reminder_sent": False,
+             "description": f"задача {ordinal} пользователя {user_id}", "created_at": datetime.now(),
+             # Every other task has no deadline, like in real lists
+             "deadline": deadline if ordinal % 2 else None}
+            for user_id in user_ids(args) for ordinal in range(1, args.tasks + 1)])
+        await conn.execute(database.TaskCounters.__table__.delete())
+        await conn.run_sync(database.backfill_task_counters)
+
+
+def user_ids(args) -> list[int]:
+    return [args.first_user + i for i in range(args.users)]
+
+
+# Runs "call" --requests times from --concurrency workers. Every worker has users of its own,
+# so a user's bot conversation is never interleaved with another one of the same user
+
+async def measure(args, call: Callable[[int, int], Awaitable[None]]) -> dict[str, float]:
+    timings: list[float] = []
+    counter = itertools.count()
+    users = user_ids(args)
+
+    async def worker(k: int):
+        own = users[k::args.concurrency] or users
+        while (n := next(counter)) < args.requests:
+            user_id = own[n % len(own)]
+            start = time.perf_counter()
+            await call(user_id, n)
+            timings.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(k) for k in range(args.concurrency)))
+    return summarize(timings, time.perf_counter() - started)
+
+
+# Task numbers for the bulk delete flow: the user's tasks three at a time, from the newest one down
+
+def delete_batch(added: dict[int, int], user_id: int, args) -> list[int]:
+    top = args.tasks + added.get(user_id, 0)
+    added[user_id] = added.get(user_id, 0) - 3
+    return [top, top - 1, top - 2]
+
+
+def api_flows(client: httpx.AsyncClient, args) -> dict[str, Callable[[int, int], Awaitable[None]]]:
+    added: dict[int, int] = {}
+
+    async def add_task(user_id, n):
+        resp = await client.post("/tasks/", json={"tg_id": user_id, "description": f"новая задача {n}", "deadline": 2})
+        resp.raise_for_status()
+        added[user_id] = added.get(user_id, 0) + 1
+
+    async def add_batch(user_id, n):
+        tasks = [{"description": f"задача {i} из пакета {n}", "deadline": i % 3 or None} for i in range(args.batch_size)]
+        resp = await client.post("/tasks/batch", json={"tg_id": user_id, "tasks": tasks})
+        resp.raise_for_status()
+        added[user_id] = added.get(user_id, 0) + args.batch_size
+
+    async def list_tasks(user_id, n):
+        resp = await client.get(f"/tasks/{user_id}", params={"limit": tg_bot.TASKS_PAGE_SIZE})
+        resp.raise_for_status()
+
+    async def mark_done(user_id, n):
+        resp = await client.put("/tasks/", params={"user_id": user_id, "task_id": n % args.tasks + 1})
+        resp.raise_for_status()
+
+    async def bulk_delete(user_id, n):
+        resp = await client.post("/tasks/delete/bulk/",
+                                 json={"tg_id": user_id, "task_ids": delete_batch(added, user_id, args)})
+        resp.raise_for_status()
+
+    async def advice(user_id, n):
+        resp = await client.get("/sonar/", params={"user_id": user_id, "task_id": n % args.tasks + 1})
+        resp.raise_for_status()
+
+    return {"add_task": add_task, "add_batch": add_batch, "list": list_tasks, "mark_done": mark_done,
+            "bulk_delete": bulk_delete, "advice": advice}
+
+
+def bot_flows(bot: Bot, api, args) -> dict[str, Callable[[int, int], Awaitable[None]]]:
+    update_ids = itertools.count(1)
+    added: dict[int, int] = {}
+
+    async def say(user_id: int, text: str) -> None:
+        update = Update.model_validate({
+            "update_id": next(update_ids),
+            "message": {
+                "message_id": next(update_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+                "text": text,
+            },
+        }, context={"bot": bot})
+        await tg_bot.dp.feed_update(bot, update, api=api)
+        # The update is only queued by now, see user_queues.py
+        await tg_bot.user_queues.join(user_id)
+
+    # Marking a task done and getting advice leave the conversation in its state, so the user can
+    # go on with another number. Every run starts like a new conversation instead
+    async def start(user_id: int, text: str) -> None:
+        await tg_bot.dp.fsm.get_context(bot, chat_id=user_id, user_id=user_id).clear()
+        await say(user_id, text)
+
+    async def add_task(user_id, n):
+        await start(user_id, "Добавить задачу")
+        await say(user_id, f"задача из бота {n}")
+        await say(user_id, "3")
+        added[user_id] = added.get(user_id, 0) + 1
+
+    async def add_batch(user_id, n):
+        await start(user_id, "Добавить несколько задач")
+        await say(user_id, "\n".join(f"задача {i} из пакета {n}" + (f"; {i % 3}" if i % 3 else "")
+                                      for i in range(args.batch_size)))
+        added[user_id] = added.get(user_id, 0) + args.batch_size
+
+    async def list_tasks(user_id, n):
+        await start(user_id, "Все задачи")
+
+    async def mark_done(user_id, n):
+        await start(user_id, "Я выполнил задачу")
+        await say(user_id, str(n % args.tasks + 1))
+
+    async def bulk_delete(user_id, n):
+        await start(user_id, "Удалить задания")
+        await say(user_id, ",".join(str(task_id) for task_id in delete_batch(added, user_id, args)))
+
+    async def advice(user_id, n):
+        await start(user_id, "Получить совет")
+        await say(user_id, str(n % args.tasks + 1))
+
+    return {"add_task": add_task, "add_batch": add_batch, "list": list_tasks, "mark_done": mark_done,
+            "bulk_delete": bulk_delete, "advice": advice}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent).stdout.strip()
+    except OSError:
+        return ""
+
+
+def compare(results: dict, baseline: dict) -> None:
+    print(f"\nCompared with {baseline['meta'].get('commit') or 'baseline'} ({baseline['meta']['started']}):")
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        print(f"  {name:18} p50 {change(before['p50_ms'], result['p50_ms'])}  "
+              f"p95 {change(before['p95_ms'], result['p95_ms'])}  "
+              f"throughput {change(before['throughput'], result['throughput'])}")
+
+
+def change(before: float, after: float) -> str:
+    if before == 0:
+        return "    n/a"
+    return f"{(after - before) / before * 100:+6.1f}%"
+
+
+async def run(args) -> None:
+    services.sonar.client = types.SimpleNamespace(
+        chat=types.SimpleNamespace(completions=FakeCompletions(args.sonar_latency)))
+    # A streamed advice is shown in one go, the edit interval only matters for Telegram's limits
+    tg_bot.ADVICE_EDIT_INTERVAL = 0
+
+    meta = {
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        **{key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+    }
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.engine = create_engine(f"sqlite+aiosqlite:///{tmp}/bench.db", PROFILES[args.profile],
+                                        connect_args={"check_same_thread": False})
+        services.advice_cache.engine = database.engine
+        await seed(args)
+
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            flows = api_flows(client, args)
+            for name in [flow for flow in FLOWS if flow in args.flows]:
+                results[f"api.{name}"] = await measure(args, flows[name])
+
+        # The tasks the API flows added and deleted are put back, so both runs see the same data
+        await database.engine.dispose()
+        os.remove(f"{tmp}/bench.db")
+        services.advice_cache._memory.clear()
+        await seed(args)
+
+        session = FakeSession()
+        bot = Bot(token=os.environ["BOT_TOKEN"], session=session)
+        if args.bot_api == "inprocess":
+            api = LocalTaskClient()
+        else:
+            api = TaskAPIClient("http://bench", transport=httpx.ASGITransport(app=main.app))
+
+        flows = bot_flows(bot, api, args)
+        for name in [flow for flow in FLOWS if flow in args.flows]:
+            results[f"bot.{name}"] = await measure(args, flows[name])
+
+        await api.close()
+        await database.engine.dispose()
+
+    print(f"{args.users} users x {args.tasks} tasks, {args.requests} runs per flow, "
+          f"concurrency {args.concurrency}, bot via {args.bot_api}")
+    for name, result in results.items():
+        print(f"  {name:18} {result['throughput']:8.1f}/s  p50={result['p50_ms']:7.1f} ms  "
+              f"p95={result['p95_ms']:7.1f} ms  p99={result['p99_ms']:7.1f} ms")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"meta": meta, "results": results}, file, indent=2, ensure_ascii=False)
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--first-user", type=int, default=900_000_000)
+    parser.add_argument("--tasks", type=int, default=50, help="tasks seeded for every user")
+    parser.add_argument("--requests", type=int, default=500, help="runs of every flow")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=20, help="tasks in one message of the add_batch flow")
+    parser.add_argument("--flows", nargs="+", default=FLOWS, choices=FLOWS)
+    parser.add_argument("--bot-api", default="http", choices=["http", "inprocess"],
+                        help="how the bot reaches the API: main.py over ASGI, or the service layer directly")
+    parser.add_argument("--profile", default="production", choices=list(PROFILES))
+    parser.add_argument("--sonar-latency", type=float, default=0.05, help="seconds the stubbed Sonar takes to answer")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,157 @@
+"""Per-user update queues: ordering and isolation, with and without user_queues.py.
+
+Feeds synthetic updates to the tg_bot.py Dispatcher the way polling does (every
+update in a task of its own, all at once), with a fake Bot and a stubbed Sonar
+taking --sonar-latency seconds, and runs two scenarios:
+
+    ordering   --users users each send a whole "add task" conversation
+               (button, description, days) in one burst; counts the tasks
+               that were saved as sent
+    isolation  one user sends --burst task list requests at once and
+               --advice users ask for advice, while --users other users open
+               their profile; prints the latency of those profile answers
+
+    python benchmarks/update_ordering.py --modes direct queued
+"""
+
+import argparse
+import asyncio
+import collections
+import os
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("PERPLEXITY_API_KEY", "benchmark")
+os.environ.setdefault("BOT_TOKEN", "42:benchmark")
+
+from aiogram import Bot
+from aiogram.methods import EditMessageText, SendMessage
+from aiogram.types import Update
+
+import database
+import services
+import tg_bot
+from local_client import LocalTaskClient
+from storage import PROFILES, create_engine
+from suite import FakeCompletions, FakeSession, percentile
+
+
+# Takes the first message the bot sends to a chat as the answer to the chat's oldest update
+
+class ReplyClock(FakeSession):
+    def __init__(self):
+        super().__init__()
+        self.waiting: dict = collections.defaultdict(collections.deque)
+        self.latencies: dict = collections.defaultdict(list)
+
+    async def make_request(self, bot, method, timeout=None):
+        if isinstance(method, (SendMessage, EditMessageText)) and self.waiting[method.chat_id]:
+            started, label = self.waiting[method.chat_id].popleft()
+            self.latencies[label].append(time.perf_counter() - started)
+        return await super().make_request(bot, method, timeout)
+
+
+def message(update_id: int, user_id: int, text: str, bot: Bot) -> Update:
+    return Update.model_validate({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        },
+    }, context={"bot": bot})
+
+
+async def feed(bot: Bot, api, updates: list[Update]) -> None:
+    tasks = [asyncio.create_task(tg_bot.dp.feed_update(bot, update, api=api)) for update in updates]
+    await asyncio.gather(*tasks)
+    await tg_bot.user_queues.close()
+
+
+async def ordering(bot: Bot, api, args) -> str:
+    first = args.first_user
+    updates = []
+    for user_id in range(first, first + args.users):
+        for text in ("Добавить задачу", f"задача пользователя {user_id}", "3"):
+            updates.append(message(len(updates) + 1, user_id, text, bot))
+
+    await feed(bot, api, updates)
+
+    saved = 0
+    for user_id in range(first, first + args.users):
+        tasks = await api.get_tasks(user_id)
+        saved += any(task["description"] == f"задача пользователя {user_id}" for task in tasks)
+    return f"{saved}/{args.users} conversations saved the task as sent"
+
+
+async def isolation(bot: Bot, api, args) -> str:
+    session: ReplyClock = bot.session
+    first = args.first_user + 100_000
+    chatty, askers, bystanders = first, range(first + 1, first + 1 + args.advice), \
+        range(first + 1 + args.advice, first + 1 + args.advice + args.users)
+
+    for user_id in [chatty, *askers, *bystanders]:
+        await api.register_user(user_id, f"user{user_id}")
+        await api.create_task(user_id, "задача", 3)
+
+    # The advice flow asks for the number first
+    await feed(bot, api, [message(i + 1, user_id, "Получить совет", bot) for i, user_id in enumerate(askers)])
+
+    updates = [message(1000 + i, chatty, "Все задачи", bot) for i in range(args.burst)]
+    updates += [message(5000 + i, user_id, "1", bot) for i, user_id in enumerate(askers)]
+    updates += [message(9000 + i, user_id, "Профиль", bot) for i, user_id in enumerate(bystanders)]
+
+    now = time.perf_counter()
+    for user_id in bystanders:
+        session.waiting[user_id].append((now, "profile"))
+    await feed(bot, api, updates)
+
+    latencies = session.latencies["profile"]
+    return (f"{len(latencies)}/{args.users} profiles answered, "
+            f"p50={percentile(latencies, 0.5) * 1000:.1f} ms p95={percentile(latencies, 0.95) * 1000:.1f} ms "
+            f"p99={percentile(latencies, 0.99) * 1000:.1f} ms")
+
+
+async def run(args) -> None:
+    services.sonar.client = types.SimpleNamespace(
+        chat=types.SimpleNamespace(completions=FakeCompletions(args.sonar_latency)))
+    tg_bot.ADVICE_EDIT_INTERVAL = 0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.engine = create_engine(f"sqlite+aiosqlite:///{tmp}/bench.db", PROFILES["production"],
+                                        connect_args={"check_same_thread": False})
+        services.advice_cache.engine = database.engine
+        await database.create_db_and_tables()
+
+        for mode in args.modes:
+            if mode == "direct":
+                tg_bot.dp.update.outer_middleware.unregister(tg_bot.user_queues)
+            api = LocalTaskClient()
+            bot = Bot(token=os.environ["BOT_TOKEN"], session=ReplyClock())
+
+            print(f"{mode:7} ordering   {await ordering(bot, api, args)}")
+            print(f"{mode:7} isolation  {await isolation(bot, api, args)}")
+
+            if mode == "direct":
+                tg_bot.dp.update.outer_middleware.register(tg_bot.user_queues)
+            args.first_user += 1_000_000
+
+        await database.engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["direct", "queued"], choices=["direct", "queued"],
+                        help="direct: handlers run as soon as updates arrive; queued: through user_queues.py")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--first-user", type=int, default=900_000_000)
+    parser.add_argument("--burst", type=int, default=2000, help="task list requests of the chatty user")
+    parser.add_argument("--advice", type=int, default=20, help="users asking for advice at the same time")
+    parser.add_argument("--sonar-latency", type=float, default=2.0)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,283 @@
+"""Update intake benchmark: polling vs webhook on the same replayed updates.
+
+Starts a fake Telegram Bot API server on localhost, runs the bot against it
+in-process (with the service layer on a temporary database) and replays the
+same updates once through getUpdates and once through the webhook. For every
+update the time from its release to the bot's first reply in that chat is
+measured, and the script prints throughput and latency percentiles:
+
+    python benchmarks/webhook_replay.py --updates 2000 --users 200 --rate 500
+
+By default the updates are "Все задачи" and "Профиль" messages of --users
+users. Recorded updates (raw Telegram Update objects, one JSON per line, e.g.
+saved from getUpdates) can be replayed with --file; updates that get no
+reply from the bot are reported as unanswered.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+import uvicorn
+from fastapi import FastAPI, Request
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("PERPLEXITY_API_KEY", "benchmark")
+os.environ.setdefault("BOT_TOKEN", "42:benchmark")
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.enums import ParseMode
+
+import database
+import tg_bot
+from local_client import LocalTaskClient
+from storage import PROFILES, create_engine
+from webhook import SECRET_HEADER, WebhookUpdates
+
+SECRET = "benchmark-secret"
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def synthetic_updates(args) -> list[dict]:
+    texts = ["Все задачи", "Профиль"]
+    updates = []
+    for i in range(args.updates):
+        user_id = args.first_user + i % args.users
+        updates.append({
+            "update_id": i + 1,
+            "message": {
+                "message_id": i + 1,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+                "text": texts[i % len(texts)],
+            },
+        })
+    return updates
+
+
+def recorded_updates(path: str) -> list[dict]:
+    with open(path) as file:
+        updates = [json.loads(line) for line in file if line.strip()]
+    for i, update in enumerate(updates):
+        update["update_id"] = i + 1
+    return updates
+
+
+def chat_id(update: dict):
+    for value in update.values():
+        if isinstance(value, dict):
+            chat = value.get("chat") or value.get("message", {}).get("chat")
+            if chat:
+                return chat["id"]
+    return None
+
+
+# Stands in for api.telegram.org: hands out released updates through getUpdates,
+# and takes the first message the bot sends to a chat as the answer to its oldest update
+
+class FakeTelegram:
+    def __init__(self, updates: list[dict]):
+        self.updates = updates
+        self.released: list[dict] = []
+        self.changed = asyncio.Condition()
+        self.waiting: dict = collections.defaultdict(collections.deque)
+        self.expected = sum(1 for update in updates if chat_id(update) is not None)
+        self.latencies: list[float] = []
+        self.last_reply = 0.0
+        self.done = asyncio.Event()
+        self.app = FastAPI()
+        self.app.add_api_route("/bot{token}/{method}", self.call, methods=["POST"])
+
+    async def release(self, update: dict) -> None:
+        chat = chat_id(update)
+        if chat is not None:
+            self.waiting[chat].append(time.perf_counter())
+        async with self.changed:
+            self.released.append(update)
+            self.changed.notify_all()
+
+    async def call(self, token: str, method: str, request: Request):
+        form = await request.form()
+        method = method.lower()
+
+        if method == "getme":
+            return {"ok": True, "result": {"id": 42, "is_bot": True, "first_name": "bench", "username": "bench_bot"}}
+
+        if method == "getupdates":
+            offset = int(form.get("offset") or 0)
+            timeout = float(form.get("timeout") or 0)
+            async with self.changed:
+                try:
+                    await asyncio.wait_for(
+                        self.changed.wait_for(lambda: self.released and self.released[-1]["update_id"] >= offset),
+                        timeout)
+                except asyncio.TimeoutError:
+                    pass
+                result = [update for update in self.released if update["update_id"] >= offset][:100]
+            return {"ok": True, "result": result}
+
+        if method in ("sendmessage", "editmessagetext"):
+            chat = int(form["chat_id"])
+            if self.waiting[chat]:
+                self.latencies.append(time.perf_counter() - self.waiting[chat].popleft())
+                self.last_reply = time.perf_counter()
+                if len(self.latencies) == self.expected:
+                    self.done.set()
+            return {"ok": True, "result": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": chat, "type": "private"},
+                "text": form.get("text", ""),
+            }}
+
+        return {"ok": True, "result": True}
+
+
+async def serve(app: FastAPI, port: int) -> tuple[uvicorn.Server, asyncio.Task]:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, lifespan="off", log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server, task
+
+
+async def replay(telegram: FakeTelegram, rate: float, deliver) -> float:
+    started = time.perf_counter()
+    for i, update in enumerate(telegram.updates):
+        if rate > 0:
+            await asyncio.sleep(max(0.0, started + i / rate - time.perf_counter()))
+        await telegram.release(update)
+        await deliver(update)
+    return started
+
+
+async def run_mode(mode: str, updates: list[dict], args) -> dict:
+    telegram = FakeTelegram([dict(update) for update in updates])
+    telegram_server, telegram_task = await serve(telegram.app, args.telegram_port)
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{args.telegram_port}"))
+    bot = Bot(token=os.environ["BOT_TOKEN"], session=session,
+              default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    api = LocalTaskClient()
+    dp = tg_bot.dp
+
+    if mode == "polling":
+        polling = asyncio.create_task(dp.start_polling(bot, api=api, handle_signals=False,
+                                                       close_bot_session=False,
+                                                       tasks_concurrency_limit=args.max_handlers))
+
+        async def deliver(update):
+            pass
+
+        started = await replay(telegram, args.rate, deliver)
+    else:
+        updates_in = WebhookUpdates(dp, bot, secret=SECRET, max_handlers=args.max_handlers, api=api)
+        webhook_app = FastAPI()
+        webhook_app.add_api_route("/webhook", updates_in.handle, methods=["POST"])
+        webhook_server, webhook_task = await serve(webhook_app, args.webhook_port)
+
+        # Like Telegram, at most "connections" deliveries are in flight at once
+        sender = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.connections))
+        webhook_url = f"http://127.0.0.1:{args.webhook_port}/webhook"
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def deliver(update):
+            queue.put_nowait(update)
+
+        async def connection():
+            while True:
+                update = await queue.get()
+                async with sender.post(webhook_url, json=update, headers={SECRET_HEADER: SECRET}) as resp:
+                    resp.raise_for_status()
+                queue.task_done()
+
+        connections = [asyncio.create_task(connection()) for _ in range(args.connections)]
+        started = await replay(telegram, args.rate, deliver)
+
+    try:
+        await asyncio.wait_for(telegram.done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+
+    if mode == "polling":
+        await dp.stop_polling()
+        await polling
+    else:
+        await queue.join()
+        for task in connections:
+            task.cancel()
+        await sender.close()
+        webhook_server.should_exit = True
+        await webhook_task
+        await updates_in.close()
+
+    await bot.session.close()
+    telegram_server.should_exit = True
+    await telegram_task
+
+    latencies = telegram.latencies
+    elapsed = (telegram.last_reply or time.perf_counter()) - started
+    return {
+        "updates": len(updates),
+        "answered": len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "p50": percentile(latencies, 0.5) if latencies else 0.0,
+        "p95": percentile(latencies, 0.95) if latencies else 0.0,
+        "p99": percentile(latencies, 0.99) if latencies else 0.0,
+    }
+
+
+async def run(args) -> None:
+    updates = recorded_updates(args.file) if args.file else synthetic_updates(args)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.engine = create_engine(f"sqlite+aiosqlite:///{tmp}/bench.db", PROFILES["production"],
+                                        connect_args={"check_same_thread": False})
+        await database.create_db_and_tables()
+
+        api = LocalTaskClient()
+        for user_id in {chat_id(update) for update in updates} - {None}:
+            await api.register_user(user_id, f"user{user_id}")
+            for i in range(args.tasks):
+                await api.create_task(user_id, f"task {i}", 3)
+
+        for mode in args.modes:
+            result = await run_mode(mode, updates, args)
+            print(f"{mode:8} {result['answered']}/{result['updates']} answered  "
+                  f"{result['throughput']:7.1f} updates/s  "
+                  f"p50={result['p50'] * 1000:7.1f} ms  p95={result['p95'] * 1000:7.1f} ms  "
+                  f"p99={result['p99'] * 1000:7.1f} ms")
+
+        await database.engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["polling", "webhook"], choices=["polling", "webhook"])
+    parser.add_argument("--file", help="recorded updates, one JSON object per line")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--first-user", type=int, default=900_000_000)
+    parser.add_argument("--tasks", type=int, default=5, help="tasks created for every user beforehand")
+    parser.add_argument("--rate", type=float, default=0, help="updates released per second, 0 releases all at once")
+    parser.add_argument("--max-handlers", type=int, default=tg_bot.BOT_MAX_HANDLERS)
+    parser.add_argument("--connections", type=int, default=40, help="parallel webhook deliveries")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--telegram-port", type=int, default=8781)
+    parser.add_argument("--webhook-port", type=int, default=8782)
+    asyncio.run(run(parser.parse_args()))
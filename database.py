@@ -0,0 +1,255 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, date
+from typing import AsyncIterator, Union
+
+from sqlalchemy import Connection, Index, case, column, delete, inspect, table, text
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import Field, SQLModel, select, func
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from storage import load_storage_profile, create_engine, BEGIN_IMMEDIATE
+from dotenv import load_dotenv
+load_dotenv()
+
+
+
+# Defining SQLModel tables
+
+class Users(SQLModel, table=True):
+    id: Union[int, None] = Field(default=None, primary_key=True)
+    tg_id: int = Field(unique=True)
+    username: Union[str, None] = None
+    user_since: datetime = Field(default_factory=date.today)
+
+# "ordinal" is the task's number as the user sees it. It is assigned once on creation
+# and never changes, so "task N of user X" is a single lookup on the (tg_id, ordinal) index
+
+class TasksDB(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_tasksdb_tg_id_ordinal", "tg_id", "ordinal", unique=True),
+        Index("ix_tasksdb_tg_id_status", "tg_id", "status"),
+        Index("ix_tasksdb_reminder", "reminder_sent", "status", "deadline"),
+        Index("ix_tasksdb_done_at", "done_at"),
+    )
+
+    id: Union[int, None] = Field(default=None, primary_key=True)
+    tg_id: int
+    ordinal: Union[int, None] = Field(default=None)
+    status: str
+    description: Union[str, None] = Field(default=None,
+                                          max_length=1000)
+    created_at: datetime = Field(default_factory=lambda: datetime.now().replace(microsecond=0))
+    deadline: Union[datetime, None] = Field(default=None)
+    reminder_sent: bool = Field(default=False)
+    # When the task was marked as done, archiving goes by it
+    done_at: Union[datetime, None] = Field(default=None)
+
+
+# Full-text index over the task descriptions (SQLite FTS5), see create_search_index.
+# The hidden "tasks_fts" column is the one MATCH and bm25() are applied to
+
+tasks_fts = table("tasks_fts", column("rowid"), column("tasks_fts"), column("words"))
+
+
+# Done tasks are moved here some time after they were done (see services.archive_done_tasks),
+# so the per-user scans of TasksDB only go over tasks that are still of interest.
+# They keep their numbers, which aren't given to new tasks
+
+class ArchivedTask(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_archivedtask_tg_id_ordinal", "tg_id", "ordinal", unique=True),
+    )
+
+    id: Union[int, None] = Field(default=None, primary_key=True)
+    tg_id: int
+    ordinal: int
+    status: str = Field(default="archived")
+    description: Union[str, None] = Field(default=None, max_length=1000)
+    created_at: datetime
+    deadline: Union[datetime, None] = Field(default=None)
+    done_at: Union[datetime, None] = Field(default=None)
+    archived_at: datetime = Field(default_factory=lambda: datetime.now().replace(microsecond=0))
+
+
+# Per-user task statistics, kept up to date in the same transaction as every
+# change to TasksDB, so the profile doesn't have to count the tasks each time.
+# "version" grows with every change to the user's tasks, clients use it to tell
+# whether the list they have is still current.
+# "total" and "done" count the tasks in TasksDB only, archived ones are counted apart
+
+class TaskCounters(SQLModel, table=True):
+    tg_id: int = Field(primary_key=True)
+    total: int = Field(default=0)
+    done: int = Field(default=0)
+    incomplete: int = Field(default=0)
+    archived: int = Field(default=0)
+    version: int = Field(default=0)
+
+
+class UsageLimit(SQLModel, table=True):
+    user_id: int = Field(primary_key=True)
+    day: Union[date, None] = Field(default=None)
+    requests_count: int
+    unlimited: bool = Field(default=False)
+
+
+# One row per reserved advice request, so a repeated reserve or refund
+# with the same request key has no further effect
+
+class QuotaReservation(SQLModel, table=True):
+    request_key: str = Field(primary_key=True)
+    user_id: int
+    day: date = Field(index=True)
+    refunded: bool = Field(default=False)
+
+
+# Tokens spent on precomputing advice per day (see precompute.py), kept here so
+# a restart doesn't start the day's budget over
+
+class AdviceBudget(SQLModel, table=True):
+    day: date = Field(primary_key=True)
+    tokens: int = Field(default=0)
+
+
+# Setting up database
+# The engine is asynchronous (aiosqlite), so a slow query doesn't block the event loop
+# and other requests are served while it runs.
+# SQLite pragmas and pool sizes come from the storage profile (see storage.py)
+
+sqlite_file_name = "database.db"
+sqlite_url = f"sqlite+aiosqlite:///{sqlite_file_name}"
+connect_args = {"check_same_thread": False}
+storage_profile = load_storage_profile()
+engine = create_engine(sqlite_url, storage_profile, connect_args=connect_args)
+
+
+# Database sessions, shared by the API endpoints and the in-process bot (see services.py)
+
+def read_session() -> AsyncSession:
+    return AsyncSession(engine, expire_on_commit=False)
+
+
+# For changing data: the transaction holds the write lock from the start.
+# SQLite allows one writer at a time anyway, so writers of this process wait for their
+# turn on the event loop instead of busy-waiting for the lock inside SQLite.
+# "bind" is for code that was given the engine (e.g. the advice cache), it's the same file
+
+write_lock = asyncio.Lock()
+
+@asynccontextmanager
+async def write_session(bind: Union[AsyncEngine, None] = None) -> AsyncIterator[AsyncSession]:
+    async with write_lock, AsyncSession(bind or engine, expire_on_commit=False) as session:
+        await session.connection(execution_options=BEGIN_IMMEDIATE)
+        yield session
+
+
+async def create_db_and_tables():
+    async with engine.begin() as conn:
+        await conn.run_sync(migrate_db)
+
+
+# Schema creation and migrations run on a plain (synchronous) connection
+
+def migrate_db(conn: Connection):
+    existing_tables = set(inspect(conn).get_table_names())
+    SQLModel.metadata.create_all(conn)
+    migrate_tasks_table(conn)
+
+    if "taskcounters" not in existing_tables:
+        backfill_task_counters(conn)
+    else:
+        migrate_counters_table(conn)
+
+    create_search_index(conn, rebuild="tasks_fts" not in existing_tables)
+
+
+# Databases created before tasks had ordinals get the column added and filled in,
+# numbering each user's existing tasks in creation order.
+# Reminder state is a plain flag, nothing has been sent for existing tasks yet.
+# Tasks done before "done_at" existed count as done when they were created
+
+def migrate_tasks_table(conn: Connection):
+    columns = {column["name"] for column in inspect(conn).get_columns("tasksdb")}
+
+    if "ordinal" not in columns:
+        conn.execute(text("ALTER TABLE tasksdb ADD COLUMN ordinal INTEGER"))
+        conn.execute(text("""
+            UPDATE tasksdb SET ordinal = (
+                SELECT numbered.n FROM (
+                    SELECT id, ROW_NUMBER() OVER (PARTITION BY tg_id ORDER BY id) AS n
+                    FROM tasksdb
+                ) AS numbered
+                WHERE numbered.id = tasksdb.id
+            )
+        """))
+
+    if "reminder_sent" not in columns:
+        conn.execute(text("ALTER TABLE tasksdb ADD COLUMN reminder_sent BOOLEAN NOT NULL DEFAULT 0"))
+
+    if "done_at" not in columns:
+        conn.execute(text("ALTER TABLE tasksdb ADD COLUMN done_at DATETIME"))
+        conn.execute(text("UPDATE tasksdb SET done_at = created_at WHERE status = 'done'"))
+
+    for index in TasksDB.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
+def migrate_counters_table(conn: Connection):
+    columns = {column["name"] for column in inspect(conn).get_columns("taskcounters")}
+
+    if "version" not in columns:
+        conn.execute(text("ALTER TABLE taskcounters ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+
+    if "archived" not in columns:
+        conn.execute(text("ALTER TABLE taskcounters ADD COLUMN archived INTEGER NOT NULL DEFAULT 0"))
+
+
+# The index holds the words of every task tagged with the owner (storage.search_words, a
+# function every connection of the engine has), rowid is the task's id. Triggers keep it in
+# step with every INSERT, DELETE and description change of tasksdb, whichever code makes it.
+# An index created for an existing database is filled from tasksdb once
+
+def create_search_index(conn: Connection, rebuild: bool):
+    conn.execute(text("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS tasks_fts USING fts5(
+            words, tokenize='unicode61 remove_diacritics 2'
+        )
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER IF NOT EXISTS tasksdb_fts_insert AFTER INSERT ON tasksdb BEGIN
+            INSERT INTO tasks_fts(rowid, words) VALUES (new.id, search_words(new.tg_id, new.description));
+        END
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER IF NOT EXISTS tasksdb_fts_delete AFTER DELETE ON tasksdb BEGIN
+            DELETE FROM tasks_fts WHERE rowid = old.id;
+        END
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER IF NOT EXISTS tasksdb_fts_update AFTER UPDATE OF description, tg_id ON tasksdb BEGIN
+            UPDATE tasks_fts SET words = search_words(new.tg_id, new.description) WHERE rowid = new.id;
+        END
+    """))
+
+    if rebuild:
+        conn.execute(text("INSERT INTO tasks_fts(rowid, words) SELECT id, search_words(tg_id, description) FROM tasksdb"))
+
+
+# Filling in the counters with a single GROUP BY on the (tg_id, status) index
+
+def backfill_task_counters(conn: Connection):
+    counts = (select(TasksDB.tg_id,
+                     func.count(),
+                     func.sum(case((TasksDB.status == "done", 1), else_=0)),
+                     func.sum(case((TasksDB.status == "incomplete", 1), else_=0)))
+              .group_by(TasksDB.tg_id))
+    conn.execute(insert(TaskCounters).from_select(["tg_id", "total", "done", "incomplete"], counts))
+
+
+# Request keys only have to be remembered for the day they were used
+
+async def purge_quota_reservations():
+    async with write_session() as session:
+        await session.exec(delete(QuotaReservation).where(QuotaReservation.day < date.today()))
+        await session.commit()
@@ -0,0 +1,231 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from os import getenv
+from typing import Any, Dict, Mapping, Optional, Union
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from sqlalchemy import Column, Float, MetaData, String, Table, Text, delete, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+from metrics import Counter, Gauge
+from storage import load_storage_profile, create_engine
+
+logger = logging.getLogger(__name__)
+
+
+# FSM storage settings (can be tuned through .env)
+
+FSM_MAX_KEYS = int(getenv("FSM_MAX_KEYS", "10000"))
+FSM_TTL = int(getenv("FSM_TTL", str(24 * 3600)))
+FSM_SWEEP_INTERVAL = int(getenv("FSM_SWEEP_INTERVAL", "300"))
+# SQLite file for keeping states over restarts, e.g. fsm.db. Empty keeps them in memory only
+FSM_DB = getenv("FSM_DB", "")
+
+
+resident_states = Gauge("fsm_states_resident", "Users' conversation states kept in memory")
+in_flow_states = Gauge("fsm_states_in_flow", "Conversation states in memory that are in the middle of a flow")
+evicted_states = Counter("fsm_evictions_total", "States dropped from memory to stay within FSM_MAX_KEYS")
+expired_states = Counter("fsm_expirations_total", "States dropped after FSM_TTL seconds without a change")
+loaded_states = Counter("fsm_loads_total", "States read back from SQLite after they were evicted or the bot restarted")
+
+for gauge in (resident_states, in_flow_states):
+    gauge.set(0)
+
+
+metadata = MetaData()
+
+fsm_states = Table(
+    "fsm_state", metadata,
+    Column("key", String, primary_key=True),
+    Column("state", String, nullable=True),
+    Column("data", Text, nullable=False),
+    Column("updated_at", Float, nullable=False, index=True),
+)
+
+
+@dataclass
+class FSMRecord:
+    state: Optional[str] = None
+    data: Dict[str, Any] = field(default_factory=dict)
+    updated_at: float = 0.0
+
+
+def key_id(key: StorageKey) -> str:
+    return ":".join(str(part) for part in (key.bot_id, key.chat_id, key.user_id, key.thread_id,
+                                            key.business_connection_id, key.destiny))
+
+
+# FSM storage with bounded memory, a replacement for aiogram's MemoryStorage.
+# At most "max_keys" users' states are kept in memory, the least recently used ones are
+# evicted first. A state that hasn't changed for "ttl" seconds (a flow the user abandoned)
+# is dropped. Finished flows (no state and no data) don't take any memory at all.
+# With an engine, states are also written to SQLite: an evicted state is read back
+# when the user comes back, and states survive restarts
+
+class BoundedStorage(BaseStorage):
+    def __init__(self, *, max_keys: int = FSM_MAX_KEYS, ttl: int = FSM_TTL,
+                 engine: Union[AsyncEngine, None] = None):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.engine = engine
+        self._records: OrderedDict[StorageKey, FSMRecord] = OrderedDict()
+        # Keys of the records above that have a state, so counting them needs no scan
+        self._in_flow: set[StorageKey] = set()
+        self._table_ready = False
+        self._table_lock = asyncio.Lock()
+
+        self.evictions = 0
+        self.expirations = 0
+        self.loads = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "resident": len(self._records),
+            "in_flow": len(self._in_flow),
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "loads": self.loads,
+        }
+
+    def _expired(self, record: FSMRecord, now: float) -> bool:
+        return self.ttl > 0 and record.updated_at <= now - self.ttl
+
+    def _remember(self, key: StorageKey, record: FSMRecord) -> None:
+        self._records[key] = record
+        self._records.move_to_end(key)
+        if record.state is not None:
+            self._in_flow.add(key)
+        else:
+            self._in_flow.discard(key)
+
+        while len(self._records) > self.max_keys:
+            evicted, _ = self._records.popitem(last=False)
+            self._in_flow.discard(evicted)
+            self.evictions += 1
+            evicted_states.inc()
+        self._update_gauges()
+
+    def _forget(self, key: StorageKey) -> None:
+        self._records.pop(key, None)
+        self._in_flow.discard(key)
+        self._update_gauges()
+
+    def _update_gauges(self) -> None:
+        resident_states.set(len(self._records))
+        in_flow_states.set(len(self._in_flow))
+
+    async def _db(self) -> AsyncEngine:
+        if not self._table_ready:
+            async with self._table_lock:
+                if not self._table_ready:
+                    async with self.engine.begin() as conn:
+                        await conn.run_sync(metadata.create_all)
+                    self._table_ready = True
+        return self.engine
+
+    async def _load(self, key: StorageKey) -> Union[FSMRecord, None]:
+        now = time.time()
+        record = self._records.get(key)
+
+        if record is not None:
+            if not self._expired(record, now):
+                self._records.move_to_end(key)
+                return record
+            self._forget(key)
+            self.expirations += 1
+            expired_states.inc()
+            return None
+
+        if self.engine is None:
+            return None
+
+        async with (await self._db()).connect() as conn:
+            row = (await conn.execute(select(fsm_states).where(fsm_states.c.key == key_id(key)))).first()
+
+        if row is None or self._expired(FSMRecord(updated_at=row.updated_at), now):
+            return None
+
+        record = FSMRecord(row.state, json.loads(row.data), row.updated_at)
+        self._remember(key, record)
+        self.loads += 1
+        loaded_states.inc()
+        return record
+
+    async def _save(self, key: StorageKey, record: FSMRecord) -> None:
+        record.updated_at = time.time()
+        finished = record.state is None and not record.data
+
+        if finished:
+            self._forget(key)
+        else:
+            self._remember(key, record)
+
+        if self.engine is None:
+            return
+
+        async with (await self._db()).begin() as conn:
+            if finished:
+                await conn.execute(delete(fsm_states).where(fsm_states.c.key == key_id(key)))
+            else:
+                row = {"key": key_id(key), "state": record.state,
+                       "data": json.dumps(record.data, ensure_ascii=False), "updated_at": record.updated_at}
+                query = insert(fsm_states).values(**row)
+                await conn.execute(query.on_conflict_do_update(index_elements=[fsm_states.c.key], set_=row))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._load(key) or FSMRecord()
+        record.state = state.state if isinstance(state, State) else state
+        await self._save(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await self._load(key)
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(
+                f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            )
+        record = await self._load(key) or FSMRecord()
+        record.data = data.copy()
+        await self._save(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await self._load(key)
+        return record.data.copy() if record else {}
+
+    # Dropping expired states that nobody asked for since, run periodically
+
+    async def sweep(self) -> None:
+        now = time.time()
+        expired = [key for key, record in self._records.items() if self._expired(record, now)]
+        for key in expired:
+            self._records.pop(key)
+            self._in_flow.discard(key)
+        self.expirations += len(expired)
+        expired_states.inc(amount=len(expired))
+        self._update_gauges()
+
+        if self.engine is not None and self.ttl > 0:
+            async with (await self._db()).begin() as conn:
+                await conn.execute(delete(fsm_states).where(fsm_states.c.updated_at <= now - self.ttl))
+
+        logger.info("FSM storage: %s", self.stats())
+
+    async def close(self) -> None:
+        if self.engine is not None:
+            await self.engine.dispose()
+
+
+def create_fsm_storage() -> BoundedStorage:
+    engine = None
+    if FSM_DB:
+        engine = create_engine(f"sqlite+aiosqlite:///{FSM_DB}", load_storage_profile(),
+                               connect_args={"check_same_thread": False})
+    return BoundedStorage(engine=engine)
@@ -0,0 +1,191 @@
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from typing import AsyncIterator, Iterator
+
+from pydantic import ValidationError
+
+import services
+from api_client import APIError, TaskNotFound, ResponseCache
+from database import read_session, write_session
+from models import TasksInfo, TasksDeleteIn, TasksDeleteOut, TasksBatchIn, Reminder
+from sonar import SonarUnavailable, SonarTimeout
+
+logger = logging.getLogger(__name__)
+
+
+# Service errors are turned into the ones TaskAPIClient raises for the same HTTP answers,
+# so bot handlers don't depend on where the API runs
+
+@contextmanager
+def api_errors() -> Iterator[None]:
+    try:
+        yield
+    except services.TaskNotFound as exc:
+        raise TaskNotFound(404, str(exc)) from exc
+    except ValidationError as exc:
+        raise APIError(422, exc.errors()) from exc
+    except SonarUnavailable as exc:
+        raise APIError(503, str(exc)) from exc
+    except SonarTimeout as exc:
+        raise APIError(504, str(exc)) from exc
+    except APIError:
+        raise
+    except Exception as exc:
+        logger.exception("Service call failed")
+        raise APIError(500, str(exc)) from exc
+
+
+# Task rows in the shape they have after a trip through JSON: datetimes as ISO strings
+
+def json_row(row: dict) -> dict:
+    return {key: value.isoformat() if isinstance(value, datetime) else value for key, value in row.items()}
+
+
+# The same interface as TaskAPIClient, for a bot running in the API's process:
+# calls go straight to the service layer, without HTTP and JSON in between.
+# Data is returned in the same shape as the HTTP API returns it
+
+class LocalTaskClient:
+    def __init__(self):
+        # Task lists and pages, stored with the version of the user's tasks they were read at
+        self.cache = ResponseCache()
+
+    async def close(self) -> None:
+        pass
+
+    async def __aenter__(self) -> "LocalTaskClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+
+    # Users
+
+    async def register_user(self, tg_id: int, name: str) -> None:
+        with api_errors():
+            async with write_session() as session:
+                await services.register_user(session, tg_id, name)
+
+    async def get_user_info(self, user_id: int) -> TasksInfo:
+        with api_errors():
+            async with read_session() as session:
+                return await services.tasks_info(session, user_id)
+
+
+    # Tasks
+
+    async def get_tasks(self, tg_id: int) -> list[dict]:
+        with api_errors():
+            async with read_session() as session:
+                version = (await services.get_task_counters(session, tg_id)).version
+                cached = self.cache.get(tg_id)
+                if cached and cached[0] == version:
+                    return cached[1]
+
+                tasks = [json_row(task) for task in await services.list_tasks(session, tg_id)]
+
+        self.cache.set(tg_id, version, tasks)
+        return tasks
+
+    async def get_tasks_page(self, tg_id: int, offset: int, limit: int) -> tuple[list[dict], int]:
+        key = (tg_id, offset, limit)
+        with api_errors():
+            async with read_session() as session:
+                counters = await services.get_task_counters(session, tg_id)
+                cached = self.cache.get(key)
+                if cached and cached[0] == counters.version:
+                    return cached[1]
+
+                tasks = await services.list_tasks(session, tg_id, limit=limit, offset=offset)
+
+        page = ([json_row(task) for task in tasks], counters.total)
+        self.cache.set(key, counters.version, page)
+        return page
+
+    async def get_tasks_count(self, tg_id: int) -> int:
+        with api_errors():
+            async with read_session() as session:
+                return await services.tasks_count(session, tg_id)
+
+    async def search_tasks(self, tg_id: int, query: str, limit: int) -> list[dict]:
+        with api_errors():
+            async with read_session() as session:
+                tasks = await services.search_tasks(session, tg_id, query, limit)
+        return [json_row(task) for task in tasks]
+
+    async def create_task(self, tg_id: int, description: str, deadline: int) -> dict:
+        with api_errors():
+            async with write_session() as session:
+                await services.create_task(session, tg_id, description, deadline)
+        return {"description": description, "deadline": deadline}
+
+    async def create_tasks(self, tg_id: int, tasks: list[dict]) -> list[int]:
+        with api_errors():
+            items = TasksBatchIn.model_validate({"tg_id": tg_id, "tasks": tasks})
+            async with write_session() as session:
+                return await services.create_tasks(session, items)
+
+    async def mark_done(self, user_id: int, task_id: int) -> dict:
+        with api_errors():
+            async with write_session() as session:
+                task = await services.mark_done(session, user_id, task_id)
+
+        deadline = task.deadline.isoformat() if task.deadline is not None else None
+        return {"description": task.description, "deadline": deadline}
+
+    async def delete_task(self, item_id: int) -> None:
+        with api_errors():
+            async with write_session() as session:
+                await services.delete_task(session, item_id)
+
+    async def delete_tasks(self, tg_id: int, task_ids: list[int]) -> TasksDeleteOut:
+        with api_errors():
+            async with write_session() as session:
+                return await services.delete_tasks(session, TasksDeleteIn(tg_id=tg_id, task_ids=task_ids))
+
+
+    # Reminders
+
+    async def get_due_reminders(self, limit: int) -> list[Reminder]:
+        with api_errors():
+            async with read_session() as session:
+                return await services.due_reminders(session, limit)
+
+    async def mark_reminders_sent(self, ids: list[int]) -> None:
+        with api_errors():
+            async with write_session() as session:
+                await services.mark_reminders_sent(session, ids)
+
+
+    # AI advice
+
+    async def reserve_quota(self, user_id: int, request_key: str) -> bool:
+        with api_errors():
+            async with write_session() as session:
+                return await services.reserve_quota(session, user_id, request_key)
+
+    async def refund_quota(self, request_key: str) -> None:
+        with api_errors():
+            async with write_session() as session:
+                await services.refund_quota(session, request_key)
+
+    async def get_advice(self, user_id: int, task_id: int) -> str:
+        with api_errors():
+            async with read_session() as session:
+                description = await services.task_description(session, user_id, task_id)
+            content = await services.get_advice(description)
+        return f"Совет: {content}"
+
+    async def stream_advice(self, user_id: int, task_id: int) -> AsyncIterator[str]:
+        with api_errors():
+            async with read_session() as session:
+                description = await services.task_description(session, user_id, task_id)
+            pieces = await services.stream_advice(description)
+
+        try:
+            async for piece in pieces:
+                yield piece
+        except Exception as exc:
+            raise APIError(502, "Sonar request failed") from exc
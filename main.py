@@ -1,65 +1,62 @@
-from fastapi import FastAPI, Depends, Body, Query, status, responses, HTTPException, Response, Path, File, UploadFile, Request
+from fastapi import FastAPI, Depends, Body, Query, Header, status, responses, HTTPException, Response, Path, File, UploadFile, Request
 import json
+import orjson
 from fastapi.exceptions import RequestValidationError
 from fastapi.encoders import jsonable_encoder
 from pydantic import HttpUrl, BaseModel
-from datetime import datetime, date, timedelta
-from sqlmodel import Field, Session, SQLModel, create_engine, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from typing import Annotated, Any, Union, List
 from contextlib import asynccontextmanager
-from models import TaskIn, TaskInDB, Status, TasksInfo
+from models import TaskIn, TaskInDB, Status, TasksInfo, TasksDeleteIn, TasksDeleteOut, Reminder, RemindersSentIn, TaskOut, TasksPageOut, TasksBatchIn, TasksBatchOut, ArchivePageOut
+from database import read_session, write_session
+from sonar import SonarUnavailable, SonarTimeout
+import services
+import metrics
 from dotenv import load_dotenv
-from perplexity import Perplexity
 load_dotenv()
 
 
 
-# Defining SQLModel tables
+# The endpoints only translate between HTTP and the service layer (see services.py),
+# which also serves the bot when both run in one process
 
-class Users(SQLModel, table=True):
-    id: Union[int, None] = Field(default=None, primary_key=True)
-    tg_id: int = Field(unique=True)
-    username: Union[str, None] = None
-    user_since: datetime = Field(default_factory=date.today)
 
-class TasksDB(SQLModel, table=True):
-    id: Union[int, None] = Field(default=None, primary_key=True)
-    tg_id: int
-    status: str
-    description: Union[str, None] = Field(default=None,
-                                          max_length=1000)
-    created_at: datetime = Field(default_factory=lambda: datetime.now().replace(microsecond=0))
-    deadline: Union[datetime, None] = Field(default=None)
+# Streaming advice for /sonar/?stream=true: one JSON object per line,
+# {"text": "..."} for each piece of the answer and {"error": "..."} if Sonar fails midway
 
+async def stream_advice(description: str) -> responses.StreamingResponse:
+    try:
+        pieces = await services.stream_advice(description)
+    except SonarUnavailable as exc:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(exc))
+    except SonarTimeout as exc:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=str(exc))
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="Sonar request failed")
 
-class UsageLimit(SQLModel, table=True):
-    user_id: int = Field(primary_key=True)
-    day: Union[date, None] = Field(default=None)
-    requests_count: int
-    unlimited: bool = Field(default=False)
+    async def body():
+        try:
+            async for piece in pieces:
+                yield json.dumps({"text": piece}, ensure_ascii=False) + "\n"
+        except Exception:
+            yield json.dumps({"error": "Sonar request failed"}) + "\n"
 
-
-# Setting up database
-
-sqlite_file_name = "database.db"
-sqlite_url = f"sqlite:///{sqlite_file_name}"
-connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, connect_args=connect_args)
-
-# A client for working with Perplexity's "Sonar" model
-
-client = Perplexity()
+    return responses.StreamingResponse(body(), media_type="application/x-ndjson")
 
 
 # Defining database session dependencies
 
-def get_session():
-    with Session(engine) as session:
+async def get_session():
+    async with read_session() as session:
         yield session
-SessionDep = Annotated[Session, Depends(get_session)]
+SessionDep = Annotated[AsyncSession, Depends(get_session)]
 
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+# For endpoints that change data, see database.write_session
+
+async def get_write_session():
+    async with write_session() as session:
+        yield session
+WriteSessionDep = Annotated[AsyncSession, Depends(get_write_session)]
 
 
 
@@ -69,15 +66,20 @@ def create_db_and_tables():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("App has started")
-    create_db_and_tables()
-    yield
+    async with services.running():
+        yield
     print("App has stopped")
 
 
 
 
 
-app = FastAPI(lifespan=lifespan)
+# Responses are encoded with orjson. Endpoints sending many rows return ORJSONResponse
+# themselves, which also skips validating every row against the response model
+
+app = FastAPI(lifespan=lifespan, default_response_class=responses.ORJSONResponse)
+# Latency of every request, see /metrics
+app.add_middleware(metrics.RequestTimer)
 
 
 
@@ -91,211 +93,262 @@ async def validation_exception_error(request, exc):
     )
 
 
+# A task the user asked for by number doesn't exist
+
+@app.exception_handler(services.TaskNotFound)
+async def task_not_found_error(request, exc):
+    return responses.JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"detail": str(exc)})
+
+
 
 # API for whenever a user makes new AI advice request
 
 @app.put("/new_request/")
-async def new_user_request(user_id: int, session: SessionDep) -> Any:
-    query = select(UsageLimit).where(UsageLimit.user_id==user_id)
-    resp = session.exec(query).one()
-    
-    resp.requests_count += 1
-    session.commit()
-    session.refresh(resp)
+async def new_user_request(user_id: int, session: WriteSessionDep) -> Any:
+    await services.count_request(session, user_id)
     return responses.JSONResponse(content=f"User id{user_id} has successfully made a new request")
 
 
 # API for checking user's daily AI advice feature limit
 
 @app.get("/check_limit/")
-async def limit_check(user_id: int, session: SessionDep) -> Any:
+async def limit_check(user_id: int, session: WriteSessionDep) -> Any:
+    if await services.check_limit(session, user_id):
+        return responses.JSONResponse(content={"limit": "good"})
+    return responses.JSONResponse(content={"limit": "bad"})
 
-    today = date.today()
-    query=select(UsageLimit).where(UsageLimit.user_id==user_id)
-    resp = session.exec(query).one()
 
-    if resp.unlimited:
-        return responses.JSONResponse(content={"limit": "good"})
+# API for reserving one AI advice request
 
-    if resp.day != today:
-        resp.sqlmodel_update({"day": today, "requests_count": 0})
-        session.commit()
+@app.post("/quota/reserve/")
+async def reserve_quota(user_id: int, request_key: str, session: WriteSessionDep) -> Any:
+    reserved = await services.reserve_quota(session, user_id, request_key)
+    return responses.JSONResponse(content={"reserved": reserved})
 
-    if(resp.requests_count >= 5):
-        return responses.JSONResponse(content={"limit": "bad"})
 
-    
-    return responses.JSONResponse(content={"limit": "good"})
+# API for giving a reserved request back when the advice couldn't be delivered
+
+@app.post("/quota/refund/")
+async def refund_quota(request_key: str, session: WriteSessionDep) -> Any:
+    refunded = await services.refund_quota(session, request_key)
+    return responses.JSONResponse(content={"refunded": refunded})
 
 
 # API for granting unlimited rights on requesting AI advice
 
 @app.post("/give_unlimited/")
-async def set_unlimited(user_id: int, session: SessionDep) -> Any:
-    query = select(UsageLimit).where(UsageLimit.user_id==user_id)
-    resp = session.exec(query).one()
-    resp.sqlmodel_update({"unlimited": True})
-    session.commit()
-
+async def set_unlimited(user_id: int, session: WriteSessionDep) -> Any:
+    await services.set_unlimited(session, user_id)
     return responses.JSONResponse(content=f"User id{user_id} has been granted unlimited role")    
 
 
 # API for requesting an advice from Sonar
 
 @app.get("/sonar/")
-async def sonar_response(user_id: int, task_id: int, session: SessionDep):
-    query = select(TasksDB).where(TasksDB.tg_id == user_id)
-    result = session.exec(query).all()
+async def sonar_response(user_id: int, task_id: int, session: SessionDep, stream: bool = False):
+    taskDescription = await services.task_description(session, user_id, task_id)
 
-    for i, item in enumerate(result):
-        if i+1 == task_id:
-            description = item.description
-            break
+    # The database connection isn't needed while waiting for Sonar
+    await session.close()
 
+    if stream:
+        return await stream_advice(taskDescription)
 
-    taskDescription = description
-    prompt = "Give a concise (no more than 70 words! and no text formatting, but separate paragrphs, also dont include resource links or hyperlinks. plain text only) but insightful advice for this task(explain how to plan, what steps to take, how to achieve the best result). Do not give help on anythin illegal, discriminating ( race, religion, etc., " + "details: " + str(taskDescription)  + " Answer in RUSSIAN" 
-    
-    answer = client.chat.completions.create(
-        messages=[
-            {
-                "role": "user",
-                "content": prompt,
-            }
-        ],
-        model="sonar",
-    )
+    try:
+        content = await services.get_advice(taskDescription)
+    except SonarUnavailable as exc:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(exc))
+    except SonarTimeout as exc:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=str(exc))
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="Sonar request failed")
 
-    advice = f"Совет: {answer.choices[0].message.content}"
+    advice = f"Совет: {content}"
 
     return responses.JSONResponse(content=advice, status_code=status.HTTP_202_ACCEPTED)
 
 
-# Creating and adding a new user to database
+# Request, SQL, Sonar and (in the in-process mode) bot handler metrics in Prometheus format
 
-@app.post("/user/new/")
-async def new_user(tg_id: int, name: str, session: SessionDep):
-    exists1 = session.scalar(select(Users).where(Users.tg_id == tg_id))
-    exists2 = session.scalar(select(UsageLimit).where(UsageLimit.user_id==tg_id))
+app.add_api_route("/metrics", metrics.metrics_endpoint, methods=["GET"], include_in_schema=False)
 
 
-    if not exists1:
-        userN = Users(tg_id=tg_id, username=name)
-        session.add(userN)
-        session.commit()
+# API for checking how often advice is served from the cache
 
-    if not exists2:
-        userUL = UsageLimit(user_id=tg_id, requests_count=0)
-        session.add(userUL)
-        session.commit()
+@app.get("/sonar/cache/")
+async def advice_cache_stats() -> Any:
+    return responses.JSONResponse(content=services.advice_cache.stats())
+
+
+# Creating and adding a new user to database
+
+@app.post("/user/new/")
+async def new_user(tg_id: int, name: str, session: WriteSessionDep):
+    await services.register_user(session, tg_id, name)
 
 
 # API for getting the amount of total, done, and incomplete tasks
 
 @app.get("/tasks/user/")
 async def tasks_info(user_id: int, session: SessionDep) -> TasksInfo:
-    query = select(TasksDB).where(TasksDB.tg_id == user_id)
-    resp = session.exec(query).all()
+    return await services.tasks_info(session, user_id)
 
-    total = len(resp)
-    done = 0
-    incomplete = 0
+    
+# API for getting tasks of all users
 
-    for item in resp:
-        if item.status == "done":
-            done += 1
-        
-        elif item.status == "incomplete":
-            incomplete += 1
+# Tasks are returned page by page in id order: pass "next_cursor" of a page as "cursor"
+# to get the next one. With stream=true all tasks after the cursor are sent as NDJSON
+# (one task per line) while they are read from the database
 
-    return TasksInfo(total=total, done=done, incomplete=incomplete)
+@app.get("/tasks/all", response_model=TasksPageOut)
+async def get_all_tasks(session: SessionDep,
+                        cursor: Annotated[int, Query(ge=0)] = 0,
+                        limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+                        stream: bool = False):
+    if stream:
+        await session.close()
+        return responses.StreamingResponse(stream_all_tasks(cursor), media_type="application/x-ndjson")
+
+    items, next_cursor = await services.tasks_page(session, cursor, limit)
+    return responses.ORJSONResponse(content={"items": items, "next_cursor": next_cursor})
 
-    
-# API for getting tasks of all users
 
-@app.get("/tasks/all")
-async def get_all_tasks(session: SessionDep):
-    query = select(TasksDB)
-    result = session.exec(query).all()
+async def stream_all_tasks(cursor: int):
+    async for batch in services.export_tasks(cursor):
+        yield b"".join(orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE) for row in batch)
 
-    return result
 
 
+# API for searching user's tasks by description
+
+# Every word of "q" has to be found (as the beginning of a word), best matches come first
+
+@app.get("/tasks/search", response_model=list[TaskOut])
+async def search_tasks(tg_id: int, q: Annotated[str, Query(min_length=1, max_length=200)], session: SessionDep,
+                       limit: Annotated[int, Query(ge=1, le=100)] = 20):
+    return responses.ORJSONResponse(content=await services.search_tasks(session, tg_id, q, limit))
+
+
+# API for browsing user's archived tasks (done tasks are archived some time after they were done)
+
+# Tasks are returned page by page in the order of their numbers:
+# pass "next_cursor" of a page as "cursor" to get the next one
+
+@app.get("/tasks/archive/{tg_id}", response_model=ArchivePageOut)
+async def get_archive(tg_id: int, session: SessionDep,
+                      cursor: Annotated[int, Query(ge=0)] = 0,
+                      limit: Annotated[int, Query(ge=1, le=100)] = 20):
+    items, next_cursor = await services.archive_page(session, tg_id, cursor, limit)
+    return responses.ORJSONResponse(content={"items": items, "next_cursor": next_cursor})
+
+
+
+# User's task list and count are tagged with the version of the user's tasks.
+# A client that sends the tag back in If-None-Match gets 304 with no body while the
+# version is the same, and the tasks aren't even read from the database.
+# "representation" tells apart what was sent for the same version (the count, the whole
+# list, one page), so a tag from one URL never matches another
+
+def tasks_etag(tg_id: int, version: int, representation: str) -> str:
+    return f'"{tg_id}-{version}-{representation}"'
+
+
+def not_modified(etag: str, if_none_match: Union[str, None]) -> bool:
+    if if_none_match is None:
+        return False
+    return if_none_match.strip() == "*" or etag in (tag.strip() for tag in if_none_match.split(","))
+
 
 # API for getting user's tasks amount
 
+# "count" is how many tasks the user has (archived ones aside), "max_id" is the highest
+# number among them. Numbers have gaps, so the two differ once a task was deleted or archived
+
 @app.get("/tasks/count/{tg_id}", status_code=status.HTTP_200_OK)
-async def get_tasks_count(tg_id: int, session: SessionDep) -> Any:
-    query = select(TasksDB).where(TasksDB.tg_id==tg_id)
-    allTasks = list(session.exec(query).all())
-    return responses.JSONResponse(content={"max_id": len(allTasks)})
+async def get_tasks_count(tg_id: int, session: SessionDep,
+                          if_none_match: Annotated[Union[str, None], Header()] = None) -> Any:
+    counters = await services.get_task_counters(session, tg_id)
+    etag = tasks_etag(tg_id, counters.version, "count")
+
+    if not_modified(etag, if_none_match):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    max_id = await services.max_ordinal(session, tg_id)
+    return responses.JSONResponse(content={"max_id": max_id, "count": counters.total}, headers={"ETag": etag})
 
 
 # API for changing task's status from incomplete to done
 
 @app.put("/tasks/")
-async def change_status(user_id: int, task_id: int, session: SessionDep) -> Any:
-    query = select(TasksDB).where(TasksDB.tg_id==user_id)
-    resp = session.exec(query).all()
-    for i, item in enumerate(resp):
-        if i+1 == task_id:
-            task = item
-            break
-
-    task.sqlmodel_update({"status": "done"})
-    session.commit()
-    dt = task.deadline
-    if dt is None:
-        return
-    s = dt.isoformat()
-    return responses.JSONResponse(content={"description": task.description, "deadline": s})
+async def change_status(user_id: int, task_id: int, session: WriteSessionDep) -> Any:
+    task = await services.mark_done(session, user_id, task_id)
+    deadline = task.deadline.isoformat() if task.deadline is not None else None
+    return responses.JSONResponse(content={"description": task.description, "deadline": deadline})
 
 
 # API for getting all user's tasks
 
-@app.get("/tasks/{tg_id}", response_model=list[TasksDB], status_code=status.HTTP_200_OK)
-async def get_tasks(tg_id: int, session: SessionDep) -> Any:
-    query = select(TasksDB).where(TasksDB.tg_id==tg_id)
-    allTasks = list(session.exec(query).all())
-    return allTasks
+# With "limit" only one page of tasks is returned, starting at "offset".
+# X-Total-Count tells how many tasks the user has in all
+
+@app.get("/tasks/{tg_id}", response_model=list[TaskOut], status_code=status.HTTP_200_OK)
+async def get_tasks(tg_id: int, session: SessionDep,
+                    limit: Annotated[Union[int, None], Query(ge=1, le=100)] = None,
+                    offset: Annotated[int, Query(ge=0)] = 0,
+                    if_none_match: Annotated[Union[str, None], Header()] = None) -> Any:
+    # The version is read first: if a change slips in before the list is read,
+    # the client gets the newer list under the older tag and simply re-reads it next time
+    counters = await services.get_task_counters(session, tg_id)
+    etag = tasks_etag(tg_id, counters.version, f"list-{limit or 'all'}-{offset}")
+
+    if not_modified(etag, if_none_match):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    tasks = await services.list_tasks(session, tg_id, limit=limit, offset=offset)
+    return responses.ORJSONResponse(content=tasks, headers={"ETag": etag, "X-Total-Count": str(counters.total)})
         
 
 # API for creating a new task
 
 @app.post("/tasks/", response_model_exclude={"tg_id"} ,status_code=status.HTTP_201_CREATED)
 async def create_task(item: Annotated[TaskIn, Body(title="get_task_data",
-                                                 description="receiving a json with item's data")], session: SessionDep) -> TaskIn:
-    deadline = None
+                                                 description="receiving a json with item's data")], session: WriteSessionDep) -> TaskIn:
+    await services.create_task(session, item.tg_id, item.description, item.deadline)
+    return item
 
-    if(item.deadline):
-        deadline = datetime.now().replace(microsecond=0) + timedelta(days=item.deadline)
 
-    taskDB = TasksDB(
-       tg_id =item.tg_id,
-       status = "incomplete",
-       description = item.description,
-       deadline = deadline,
-    )
-        
+# API for creating many tasks of a user in one transaction
 
-    session.add(taskDB)
-    session.commit()
-    return item
+@app.post("/tasks/batch", status_code=status.HTTP_201_CREATED)
+async def create_tasks(items: TasksBatchIn, session: WriteSessionDep) -> TasksBatchOut:
+    return TasksBatchOut(ordinals=await services.create_tasks(session, items))
 
 
 # API for deleting a task
 
 @app.delete("/tasks/delete/", status_code=status.HTTP_200_OK)
-async def delete_task(item_id: Annotated[int, Query()], session: SessionDep) -> Any:
-    query = select(TasksDB).where(TasksDB.id == item_id)
-    result = session.exec(query)
-    task = result.one()
-    session.delete(task)
-    session.commit()
+async def delete_task(item_id: Annotated[int, Query()], session: WriteSessionDep) -> Any:
+    await services.delete_task(session, item_id)
+    return responses.JSONResponse(content="Task has been deleted")
 
 
-    
-    return responses.JSONResponse(content="Task has been deleted")
-    
+# API for deleting many tasks of a user in one transaction
+
+@app.post("/tasks/delete/bulk/", status_code=status.HTTP_200_OK)
+async def delete_tasks(items: TasksDeleteIn, session: WriteSessionDep) -> TasksDeleteOut:
+    return await services.delete_tasks(session, items)
+
+
+# API for getting incomplete tasks whose reminder is due and hasn't been sent yet
+
+@app.get("/reminders/due/")
+async def get_due_reminders(session: SessionDep,
+                            limit: Annotated[int, Query(ge=1, le=1000)] = 100) -> list[Reminder]:
+    return await services.due_reminders(session, limit)
+
 
+# API for marking reminders as sent
 
+@app.post("/reminders/sent/")
+async def mark_reminders_sent(items: RemindersSentIn, session: WriteSessionDep) -> Any:
+    await services.mark_reminders_sent(session, items.ids)
+    return responses.JSONResponse(content=f"{len(items.ids)} reminders marked as sent")
@@ -0,0 +1,159 @@
+import bisect
+import time
+from typing import Awaitable, Callable
+
+from fastapi import Response
+
+
+# Metrics in the Prometheus text format, served on /metrics.
+# Only counters and histograms with fixed buckets are needed here. Recording a value is
+# a dict lookup and a bisect, cheap enough to stay on in production.
+# Everything is recorded on the event loop thread (SQLAlchemy's events included,
+# they run in the loop's greenlet), so no locking is needed
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a quick SQLite lookup to a slow Sonar answer
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0)
+
+registry: dict[str, "Metric"] = {}
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def label_pairs(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    return ",".join(f'{name}="{escape(str(value))}"' for name, value in zip(names, values))
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        if name in registry:
+            raise ValueError(f"Metric {name!r} is already registered")
+        self.name = name
+        self.description = description
+        self.labels = labels
+        registry[name] = self
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {escape(self.description)}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{{{label_pairs(self.labels, labels)}}} {value}" if labels
+                         else f"{self.name} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *labels: str) -> None:
+        self._values[labels] = value
+
+    def dec(self, *labels: str, amount: float = 1.0) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+# Counts per bucket are kept apart and only added up when rendered,
+# so an observation touches a single bucket
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+        # Per label values: counts per bucket (the last one is +Inf) and the sum
+        self._series: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        for labels, (counts, total) in self._series.items():
+            pairs = label_pairs(self.labels, labels)
+            prefix = pairs + "," if pairs else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {cumulative}')
+            suffix = f"{{{pairs}}}" if pairs else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in registry.values():
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# The /metrics endpoint, for the API and for the bot's own HTTP server
+
+async def metrics_endpoint() -> Response:
+    return Response(content=render(), media_type=CONTENT_TYPE)
+
+
+# HTTP request latency
+
+http_request_latency = Histogram(
+    "http_request_duration_seconds",
+    "Time from receiving an HTTP request to sending the last byte of the response",
+    ("method", "route", "status"),
+)
+
+
+# ASGI middleware timing every request until its response is sent completely (streamed
+# ones included). Requests are labelled with the route's path template, not the actual
+# path, so "/tasks/{tg_id}" is one series for all users
+
+class RequestTimer:
+    def __init__(self, app: Callable[..., Awaitable[None]]):
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_timed(message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            route = scope.get("route")
+            http_request_latency.observe(time.perf_counter() - started, scope["method"],
+                                         route.path if route is not None else "unmatched", str(status_code))
@@ -20,15 +20,100 @@ class TaskIn(SQLModel):
 
     
 
+# Creating many tasks of one user at once, "deadline" is in days like in TaskIn
+
+class TaskItem(SQLModel):
+    description: Annotated[str, Field(min_length=1, max_length=5000)]
+    deadline: Annotated[Union[int, None], Field(default=None, gt=0)]
+
+
+class TasksBatchIn(SQLModel):
+    tg_id: int
+    tasks: Annotated[list[TaskItem], Field(min_length=1, max_length=100)]
+
+
+class TasksBatchOut(BaseModel):
+    # Numbers of the new tasks, in the order they were sent
+    ordinals: list[int]
+
+
 class TaskInDB(TaskIn):
     id: int
     deadline: Union[datetime, None] = None
     status: Annotated[Status, Field(default="incomplete")]
 
 
+# What the task list endpoints send: only the columns clients use.
+# They are read as plain rows (see services.TASK_COLUMNS), without building ORM objects
+
+class TaskOut(BaseModel):
+    id: int
+    ordinal: int
+    description: Union[str, None] = None
+    deadline: Union[datetime, None] = None
+    status: Status
+
+
+# Tasks of all users, as /tasks/all pages through them by id
+
+class TaskExport(TaskOut):
+    tg_id: int
+    created_at: datetime
+
+
+class TasksPageOut(BaseModel):
+    items: list[TaskExport]
+    next_cursor: Union[int, None] = None
+
+
+# User's archived tasks, as /tasks/archive/{tg_id} pages through them by number
+
+class ArchivedTaskOut(BaseModel):
+    ordinal: int
+    description: Union[str, None] = None
+    deadline: Union[datetime, None] = None
+    status: Status
+    created_at: datetime
+    done_at: Union[datetime, None] = None
+    archived_at: datetime
+
+
+class ArchivePageOut(BaseModel):
+    items: list[ArchivedTaskOut]
+    next_cursor: Union[int, None] = None
+
+
+# "total" and "done" include the archived tasks
+
 class TasksInfo(BaseModel):
     total: int
     done: int
     incomplete: int
-    
-    
\ No newline at end of file
+    archived: int = 0
+
+
+# Deleting several tasks of one user at once,
+# either by the numbers the user sees ("task_ids") or by database ids ("ids")
+
+class TasksDeleteIn(SQLModel):
+    tg_id: int
+    task_ids: Annotated[list[int], Field(default=[], max_length=1000)]
+    ids: Annotated[list[int], Field(default=[], max_length=1000)]
+
+
+class TasksDeleteOut(BaseModel):
+    deleted: list[int]
+    not_deleted: list[int]
+    deleted_ids: list[int]
+    not_deleted_ids: list[int]
+
+
+class Reminder(BaseModel):
+    id: int
+    tg_id: int
+    description: Union[str, None] = None
+    deadline: datetime
+
+
+class RemindersSentIn(BaseModel):
+    ids: Annotated[list[int], Field(max_length=1000)]
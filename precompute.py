@@ -0,0 +1,165 @@
+import asyncio
+import logging
+from datetime import date
+from os import getenv
+from typing import Awaitable, Callable
+
+from sqlalchemy import delete, or_
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import select, func
+
+import database
+from database import TasksDB, UsageLimit, AdviceBudget
+from metrics import Counter, Gauge
+from sonar import SonarUnavailable
+
+logger = logging.getLogger(__name__)
+
+
+# Precomputation settings (can be tuned through .env)
+
+# Tokens a day that may be spent on advice nobody has asked for yet. 0 turns precomputation off
+ADVICE_PRECOMPUTE_TOKENS = int(getenv("ADVICE_PRECOMPUTE_TOKENS", "0"))
+# Sonar calls the worker makes at the same time, out of SONAR_MAX_CONCURRENCY
+ADVICE_PRECOMPUTE_CONCURRENCY = int(getenv("ADVICE_PRECOMPUTE_CONCURRENCY", "1"))
+ADVICE_PRECOMPUTE_BATCH_SIZE = int(getenv("ADVICE_PRECOMPUTE_BATCH_SIZE", "100"))
+
+
+# "outcome" is ok, cached (someone asked first or the same description was answered before),
+# budget (the day's tokens are used up), unavailable (Sonar's breaker isn't closed) or error
+
+precomputed = Counter("advice_precomputed_total", "New tasks the advice worker looked at", ("outcome",))
+tokens_today = Gauge("advice_precompute_tokens_today", "Tokens spent on precomputed advice today")
+
+
+# Background worker asking Sonar for advice on new tasks before their owners do, so
+# "Получить совет" is answered from the advice cache right away.
+#
+# "advise" gets a task description, caches the answer and returns the tokens it took
+# (0 if nothing had to be asked, see services.precompute_advice). The worker only picks
+# tasks created after it started, and only of users who can still ask for advice today.
+# It never touches UsageLimit: asking for a precomputed answer costs the user one request,
+# like any other cached answer. Up to "concurrency" calls run at the same time, and a new
+# one is only started while the day's spending is below "daily_tokens", so the budget
+# is overshot by at most "concurrency" answers
+
+class AdvicePrecompute:
+    def __init__(self, advise: Callable[[str], Awaitable[int]], *, daily_limit: int,
+                 daily_tokens: int = ADVICE_PRECOMPUTE_TOKENS,
+                 concurrency: int = ADVICE_PRECOMPUTE_CONCURRENCY,
+                 batch_size: int = ADVICE_PRECOMPUTE_BATCH_SIZE):
+        self.advise = advise
+        self.daily_limit = daily_limit
+        self.daily_tokens = daily_tokens
+        self.batch_size = batch_size
+        self.cursor = 0
+        self._slots = asyncio.Semaphore(concurrency)
+        self._calls: set[asyncio.Task] = set()
+        self._new_tasks = asyncio.Event()
+        self._day = date.today()
+        self._spent = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.daily_tokens > 0
+
+    # Called after new tasks are committed
+
+    def wake(self) -> None:
+        self._new_tasks.set()
+
+    async def run(self) -> None:
+        await self._start()
+        try:
+            while True:
+                await self._new_tasks.wait()
+                self._new_tasks.clear()
+                try:
+                    await self._sweep()
+                except Exception:
+                    logger.exception("Advice precomputation failed, tasks up to id %s are skipped", self.cursor)
+        finally:
+            for call in self._calls:
+                call.cancel()
+            await asyncio.gather(*self._calls, return_exceptions=True)
+
+    async def _start(self) -> None:
+        async with database.write_session() as session:
+            self.cursor = (await session.exec(select(func.coalesce(func.max(TasksDB.id), 0)))).one()
+            await session.exec(delete(AdviceBudget).where(AdviceBudget.day < self._day))
+            budget = await session.get(AdviceBudget, self._day)
+            await session.commit()
+        self._spent = budget.tokens if budget is not None else 0
+        tokens_today.set(self._spent)
+
+    async def _sweep(self) -> None:
+        while True:
+            async with database.read_session() as session:
+                rows = (await session.exec(self._candidates())).all()
+
+            for task_id, description in rows:
+                self.cursor = task_id
+                # Checked once the slot is free, when the earlier calls have been paid for
+                await self._slots.acquire()
+                if not self._budget_left():
+                    self._slots.release()
+                    precomputed.inc("budget")
+                    continue
+                call = asyncio.create_task(self._precompute(description))
+                self._calls.add(call)
+                call.add_done_callback(self._calls.discard)
+
+            if len(rows) < self.batch_size:
+                return
+
+    # Incomplete tasks after the cursor whose owners haven't used up today's requests
+
+    def _candidates(self):
+        today = date.today()
+        return (select(TasksDB.id, TasksDB.description)
+                .join(UsageLimit, UsageLimit.user_id == TasksDB.tg_id)
+                .where(TasksDB.id > self.cursor,
+                       TasksDB.status == "incomplete",
+                       or_(UsageLimit.unlimited,
+                           UsageLimit.day.is_(None),
+                           UsageLimit.day != today,
+                           UsageLimit.requests_count < self.daily_limit))
+                .order_by(TasksDB.id)
+                .limit(self.batch_size))
+
+    def _budget_left(self) -> bool:
+        if self._day != date.today():
+            self._day, self._spent = date.today(), 0
+            tokens_today.set(0)
+        return self._spent < self.daily_tokens
+
+    async def _precompute(self, description: str) -> None:
+        try:
+            tokens = await self.advise(description)
+        except SonarUnavailable:
+            precomputed.inc("unavailable")
+            return
+        except Exception:
+            precomputed.inc("error")
+            logger.warning("Couldn't precompute advice", exc_info=True)
+            return
+        finally:
+            self._slots.release()
+
+        if tokens == 0:
+            precomputed.inc("cached")
+            return
+
+        precomputed.inc("ok")
+        await self._spend(tokens)
+
+    async def _spend(self, tokens: int) -> None:
+        self._spent += tokens
+        tokens_today.set(self._spent)
+
+        query = insert(AdviceBudget).values(day=self._day, tokens=tokens)
+        query = query.on_conflict_do_update(index_elements=[AdviceBudget.day],
+                                            set_={"tokens": AdviceBudget.tokens + tokens})
+        async with database.write_session() as session:
+            await session.exec(query)
+            await session.commit()
@@ -0,0 +1,62 @@
+import logging
+from datetime import datetime
+from os import getenv
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest, TelegramRetryAfter
+from api_client import TaskAPIClient
+from models import Reminder
+
+logger = logging.getLogger(__name__)
+
+
+# Sweeper settings (can be tuned through .env)
+
+REMINDER_SWEEP_INTERVAL = int(getenv("REMINDER_SWEEP_INTERVAL", "60"))
+REMINDER_BATCH_SIZE = int(getenv("REMINDER_BATCH_SIZE", "100"))
+
+
+# The reminder says how much time is really left: a sweep can be late,
+# and after a restart the deadline may already be behind
+
+def reminder_text(reminder: Reminder, now: datetime) -> str:
+    minutes = int((reminder.deadline - now).total_seconds() // 60)
+    if minutes <= 0:
+        return f"Дедлайн уже прошёл\n\nОписание: {reminder.description}"
+
+    hours, minutes = divmod(minutes, 60)
+    left = f"{hours} ч {minutes} мин" if hours and minutes else f"{hours} ч" if hours else f"{minutes} мин"
+    return f"До дедлайна осталось {left}\n\nОписание: {reminder.description}"
+
+
+# A single periodic job sends every reminder that is due.
+# Which reminders were sent is stored in the database, so nothing is lost
+# when the bot restarts: reminders that fell due while it was down go out on the first sweep
+
+async def sweep_reminders(bot: Bot, api: TaskAPIClient, batch_size: int = REMINDER_BATCH_SIZE) -> None:
+    while True:
+        reminders = await api.get_due_reminders(batch_size)
+        sent = []
+
+        try:
+            for reminder in reminders:
+                try:
+                    await bot.send_message(
+                        reminder.tg_id,
+                        reminder_text(reminder, datetime.now()),
+                        parse_mode=None,
+                    )
+                except (TelegramForbiddenError, TelegramBadRequest) as exc:
+                    # The user blocked the bot or the chat is gone, there is no point in retrying
+                    logger.info("Reminder for task %s was not delivered: %s", reminder.id, exc)
+                sent.append(reminder.id)
+        except TelegramRetryAfter as exc:
+            logger.warning("Telegram asked to wait %s s, the rest is left for the next sweep", exc.retry_after)
+            return
+        finally:
+            # Whatever was delivered before an error is never sent twice
+            if sent:
+                await api.mark_reminders_sent(sent)
+
+        if len(reminders) < batch_size:
+            return
@@ -0,0 +1,643 @@
+import asyncio
+import logging
+from contextlib import aclosing, asynccontextmanager
+from datetime import datetime, date, timedelta
+from os import getenv
+from typing import AsyncIterator, Union
+
+from sqlalchemy import case, delete, or_, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import select, func
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import database
+from database import tasks_fts, Users, TasksDB, ArchivedTask, TaskCounters, UsageLimit, QuotaReservation, read_session, write_session
+from advice_cache import AdviceCache, prompt_version
+from models import TasksInfo, TasksDeleteIn, TasksDeleteOut, TasksBatchIn, Reminder
+from precompute import AdvicePrecompute
+from sonar import SonarClient, SingleFlight, SonarUnavailable
+from storage import checkpoint, checkpoint_loop, search_words
+
+logger = logging.getLogger(__name__)
+
+
+# The application logic behind the API endpoints.
+# Functions take the caller's session and don't know about HTTP, so the same code
+# serves main.py and the bot running in the same process (see local_client.py).
+# Functions that change data commit the session themselves
+
+
+class TaskNotFound(Exception):
+    pass
+
+
+DAILY_ADVICE_LIMIT = 5
+
+# Reminders are sent by the bot this long before a task's deadline
+
+REMINDER_LEAD = timedelta(hours=24)
+
+
+# Archiving settings (can be tuned through .env)
+
+# Done tasks are moved to the archive this many days after they were done. 0 turns archiving off
+TASK_ARCHIVE_AFTER_DAYS = int(getenv("TASK_ARCHIVE_AFTER_DAYS", "30"))
+TASK_ARCHIVE_INTERVAL = int(getenv("TASK_ARCHIVE_INTERVAL", "3600"))
+# Tasks moved in one transaction, the write lock is let go between batches
+TASK_ARCHIVE_BATCH_SIZE = int(getenv("TASK_ARCHIVE_BATCH_SIZE", "500"))
+
+
+# A client for working with Perplexity's "Sonar" model
+
+# Calls are asynchronous, limited in concurrency and time, and fail fast
+# while Sonar is down (see sonar.py)
+
+sonar = SonarClient()
+
+ADVICE_PROMPT = "Give a concise (no more than 70 words! and no text formatting, but separate paragrphs, also dont include resource links or hyperlinks. plain text only) but insightful advice for this task(explain how to plan, what steps to take, how to achieve the best result). Do not give help on anythin illegal, discriminating ( race, religion, etc., " + "details: {description}" + " Answer in RUSSIAN"
+
+# Answers are cached by task description and prompt version (see advice_cache.py)
+
+advice_cache = AdviceCache(database.engine, prompt_version(ADVICE_PROMPT))
+
+# Simultaneous requests for the same task description share one lookup and one Sonar call
+
+advice_flights = SingleFlight()
+
+
+# Optional background worker asking for advice on new tasks ahead of time (see precompute.py)
+
+async def precompute_advice(description: str) -> int:
+    key = advice_cache.key(description)
+    if advice_flights.running(key) is not None or await advice_cache.has(description):
+        return 0
+    # A trial call after an outage is left to the users
+    if sonar.breaker.state != "closed":
+        raise SonarUnavailable("Sonar is unavailable")
+
+    tokens = 0
+
+    async def call() -> str:
+        nonlocal tokens
+        content, tokens = await sonar.complete_with_usage(ADVICE_PROMPT.format(description=description))
+        await cache_advice(description, content)
+        return content
+
+    # Users asking for the same advice meanwhile wait for this call instead of making their own
+    await advice_flights.do(key, call)
+    return tokens
+
+
+advice_precompute = AdvicePrecompute(precompute_advice, daily_limit=DAILY_ADVICE_LIMIT)
+
+
+# Startup and shutdown of everything above, for whichever process hosts it
+
+@asynccontextmanager
+async def running() -> AsyncIterator[None]:
+    await database.create_db_and_tables()
+    await advice_cache.purge()
+    await database.purge_quota_reservations()
+
+    profile = database.storage_profile
+    checkpoints = None
+    if profile.journal_mode == "WAL" and profile.checkpoint_interval > 0:
+        checkpoints = asyncio.create_task(checkpoint_loop(database.engine, profile.checkpoint_interval))
+
+    precomputing = asyncio.create_task(advice_precompute.run()) if advice_precompute.enabled else None
+    archiving = asyncio.create_task(archive_loop(TASK_ARCHIVE_INTERVAL)) if TASK_ARCHIVE_AFTER_DAYS > 0 else None
+
+    try:
+        yield
+    finally:
+        if checkpoints:
+            checkpoints.cancel()
+        for job in (precomputing, archiving):
+            if job:
+                job.cancel()
+                await asyncio.gather(job, return_exceptions=True)
+        if profile.journal_mode == "WAL":
+            await checkpoint(database.engine, "TRUNCATE")
+        await sonar.close()
+        await database.engine.dispose()
+
+
+# Shifting user's counters with a single upsert, inside the caller's transaction.
+# Every shift is a change to the user's tasks, so it also bumps the version
+
+async def shift_task_counters(session: AsyncSession, user_id: int, *, total: int = 0, done: int = 0, incomplete: int = 0,
+                              archived: int = 0):
+    query = insert(TaskCounters).values(tg_id=user_id, total=total, done=done, incomplete=incomplete,
+                                        archived=archived, version=1)
+    query = query.on_conflict_do_update(
+        index_elements=[TaskCounters.tg_id],
+        set_={
+            "total": TaskCounters.total + total,
+            "done": TaskCounters.done + done,
+            "incomplete": TaskCounters.incomplete + incomplete,
+            "archived": TaskCounters.archived + archived,
+            "version": TaskCounters.version + 1,
+        },
+    )
+    await session.exec(query)
+
+
+# User's counters, all zero for a user without tasks
+
+async def get_task_counters(session: AsyncSession, tg_id: int) -> TaskCounters:
+    counters = await session.get(TaskCounters, tg_id)
+    return counters if counters is not None else TaskCounters(tg_id=tg_id)
+
+
+def status_delta(task_status: str, sign: int) -> dict[str, int]:
+    if task_status in ("done", "incomplete"):
+        return {task_status: sign}
+    return {}
+
+
+# The user's last task number, archived tasks included, so numbers are never given out twice
+
+def last_ordinal(tg_id: int):
+    live = select(func.max(TasksDB.ordinal)).where(TasksDB.tg_id == tg_id).scalar_subquery()
+    archived = select(func.max(ArchivedTask.ordinal)).where(ArchivedTask.tg_id == tg_id).scalar_subquery()
+    return select(func.max(func.coalesce(live, 0), func.coalesce(archived, 0))).scalar_subquery()
+
+
+# Looking up a task by the number the user sees
+
+async def get_user_task(session: AsyncSession, user_id: int, task_id: int) -> TasksDB:
+    query = select(TasksDB).where(TasksDB.tg_id == user_id, TasksDB.ordinal == task_id)
+    task = (await session.exec(query)).first()
+
+    if task is None:
+        raise TaskNotFound(f"Task {task_id} does not exist")
+    return task
+
+
+# Users
+
+async def register_user(session: AsyncSession, tg_id: int, name: str) -> None:
+    exists1 = await session.scalar(select(Users).where(Users.tg_id == tg_id))
+    exists2 = await session.scalar(select(UsageLimit).where(UsageLimit.user_id==tg_id))
+
+
+    if not exists1:
+        userN = Users(tg_id=tg_id, username=name)
+        session.add(userN)
+        await session.commit()
+
+    if not exists2:
+        userUL = UsageLimit(user_id=tg_id, requests_count=0)
+        session.add(userUL)
+        await session.commit()
+
+
+# AI advice limits
+
+async def count_request(session: AsyncSession, user_id: int) -> None:
+    query = select(UsageLimit).where(UsageLimit.user_id==user_id)
+    resp = (await session.exec(query)).one()
+
+    resp.requests_count += 1
+    await session.commit()
+
+
+async def check_limit(session: AsyncSession, user_id: int) -> bool:
+    today = date.today()
+    query=select(UsageLimit).where(UsageLimit.user_id==user_id)
+    resp = (await session.exec(query)).one()
+
+    if resp.unlimited:
+        return True
+
+    if resp.day != today:
+        resp.sqlmodel_update({"day": today, "requests_count": 0})
+        await session.commit()
+
+    return resp.requests_count < DAILY_ADVICE_LIMIT
+
+
+async def set_unlimited(session: AsyncSession, user_id: int) -> None:
+    query = select(UsageLimit).where(UsageLimit.user_id==user_id)
+    resp = (await session.exec(query)).one()
+    resp.sqlmodel_update({"unlimited": True})
+    await session.commit()
+
+
+# Reserving one AI advice request.
+# The day rollover, the limit check and the increment are one conditional UPDATE,
+# so two simultaneous requests can't both take the last one.
+# A request key belongs to the user who used it first, another user gets nothing for it.
+# Keys of earlier days are dropped along the way, so the table only holds today's
+
+async def reserve_quota(session: AsyncSession, user_id: int, request_key: str) -> bool:
+    reservation = await session.get(QuotaReservation, request_key)
+    if reservation is not None:
+        return reservation.user_id == user_id and not reservation.refunded
+
+    today = date.today()
+    await session.exec(delete(QuotaReservation).where(QuotaReservation.day < today))
+    query = (update(UsageLimit)
+             .where(UsageLimit.user_id == user_id,
+                    or_(UsageLimit.unlimited,
+                        UsageLimit.day.is_(None),
+                        UsageLimit.day != today,
+                        UsageLimit.requests_count < DAILY_ADVICE_LIMIT))
+             .values(requests_count=case((UsageLimit.day == today, UsageLimit.requests_count + 1), else_=1),
+                     day=today))
+    result = await session.exec(query)
+
+    if result.rowcount == 0:
+        return False
+
+    session.add(QuotaReservation(request_key=request_key, user_id=user_id, day=today))
+    await session.commit()
+    return True
+
+
+# Giving a reserved request back when the advice couldn't be delivered
+
+async def refund_quota(session: AsyncSession, request_key: str) -> bool:
+    reservation = await session.get(QuotaReservation, request_key)
+    if reservation is None or reservation.refunded:
+        return False
+
+    reservation.refunded = True
+    await session.exec(update(UsageLimit)
+                       .where(UsageLimit.user_id == reservation.user_id,
+                              UsageLimit.day == reservation.day,
+                              UsageLimit.requests_count > 0)
+                       .values(requests_count=UsageLimit.requests_count - 1))
+    await session.commit()
+    return True
+
+
+# AI advice
+
+async def task_description(session: AsyncSession, user_id: int, task_id: int) -> str:
+    return str((await get_user_task(session, user_id, task_id)).description)
+
+
+async def _get_advice(description: str) -> str:
+    content = await advice_cache.get(description)
+
+    if content is None:
+        content = await sonar.complete(ADVICE_PROMPT.format(description=description))
+        await cache_advice(description, content)
+
+    return content
+
+
+# A failed cache write doesn't fail the request: the answer is there, it just isn't kept
+
+async def cache_advice(description: str, content: str) -> None:
+    try:
+        await advice_cache.set(description, content)
+    except Exception:
+        logger.exception("Couldn't cache advice")
+
+
+# Advice functions don't take a session: the database connection isn't needed while waiting for Sonar
+
+async def get_advice(description: str) -> str:
+    return await advice_flights.do(advice_cache.key(description), lambda: _get_advice(description))
+
+
+# Streaming variant: the Sonar call is started (and can fail with SonarUnavailable/SonarTimeout)
+# before the iterator is returned. A complete answer is cached once the stream ends.
+# A stream is a flight like any other call: requests for the same description made
+# meanwhile (streamed, plain or precomputing) wait for its answer instead of calling
+# Sonar again, and get it in one piece
+
+async def stream_advice(description: str) -> AsyncIterator[str]:
+    content = await advice_cache.get(description)
+    if content is not None:
+        return _cached_advice(content)
+
+    call = advice_flights.running(advice_cache.key(description))
+    if call is not None:
+        try:
+            return _cached_advice(await asyncio.shield(call))
+        except Exception:
+            # The other call failed, this request gets a call of its own
+            pass
+
+    pieces = _streamed_advice(description, advice_flights.lead(advice_cache.key(description)))
+    # Runs up to the first "yield", once the Sonar call is started
+    await pieces.__anext__()
+    return pieces
+
+
+async def _cached_advice(content: str) -> AsyncIterator[str]:
+    yield content
+
+
+# "flight" is None when another call for the description has started in the meantime;
+# then this stream just isn't shared
+
+async def _streamed_advice(description: str, flight: Union[asyncio.Future, None]) -> AsyncIterator[str]:
+    try:
+        async with aclosing(await sonar.stream(ADVICE_PROMPT.format(description=description))) as pieces:
+            yield ""
+            answer = []
+            async for piece in pieces:
+                answer.append(piece)
+                yield piece
+
+        content = "".join(answer)
+        await cache_advice(description, content)
+        if flight is not None:
+            flight.set_result(content)
+    except Exception as exc:
+        if flight is not None and not flight.done():
+            flight.set_exception(exc)
+        raise
+    finally:
+        # Closed before the end: the ones waiting make calls of their own
+        if flight is not None and not flight.done():
+            flight.set_exception(SonarUnavailable("The advice stream was closed before it ended"))
+
+
+# Tasks
+
+# Archived tasks are done tasks as far as the profile is concerned
+
+async def tasks_info(session: AsyncSession, user_id: int) -> TasksInfo:
+    counters = await get_task_counters(session, user_id)
+    return TasksInfo(total=counters.total + counters.archived, done=counters.done + counters.archived,
+                     incomplete=counters.incomplete, archived=counters.archived)
+
+
+async def tasks_count(session: AsyncSession, tg_id: int) -> int:
+    return (await get_task_counters(session, tg_id)).total
+
+
+# Numbers have gaps once tasks are deleted or archived, so the highest one isn't the count.
+# A single step down the (tg_id, ordinal) index
+
+async def max_ordinal(session: AsyncSession, tg_id: int) -> int:
+    query = select(func.coalesce(func.max(TasksDB.ordinal), 0)).where(TasksDB.tg_id == tg_id)
+    return (await session.exec(query)).one()
+
+
+# User's tasks in the order of their numbers, or one page of them.
+# Pages are read straight off the (tg_id, ordinal) index
+
+# Task lists are read as plain dicts of the columns below (see models.TaskOut and TaskExport):
+# no ORM objects to build and no fields the clients don't use
+
+TASK_COLUMNS = (TasksDB.id, TasksDB.ordinal, TasksDB.description, TasksDB.deadline, TasksDB.status)
+EXPORT_COLUMNS = (*TASK_COLUMNS, TasksDB.tg_id, TasksDB.created_at)
+
+
+async def list_tasks(session: AsyncSession, tg_id: int, *, limit: Union[int, None] = None, offset: int = 0) -> list[dict]:
+    query = select(*TASK_COLUMNS).where(TasksDB.tg_id==tg_id).order_by(TasksDB.ordinal).offset(offset).limit(limit)
+    return [dict(row) for row in (await session.exec(query)).mappings()]
+
+
+# Searching user's tasks by description (see database.create_search_index).
+# Every word of the query has to be found, the last ones typed may be unfinished:
+# each word is matched as a prefix. Best matches (bm25) come first
+
+SEARCH_MAX_WORDS = 8
+
+
+# Words are quoted, so nothing the user types is taken for FTS5 query syntax
+
+def search_expression(tg_id: int, text: str) -> Union[str, None]:
+    words = search_words(tg_id, text).split()[:SEARCH_MAX_WORDS]
+    if not words:
+        return None
+    return " AND ".join(f'"{word}"*' for word in words)
+
+
+# The words carry the owner, so the index only gives back the user's tasks
+
+async def search_tasks(session: AsyncSession, tg_id: int, text: str, limit: int) -> list[dict]:
+    expression = search_expression(tg_id, text)
+    if expression is None:
+        return []
+
+    query = (select(*TASK_COLUMNS)
+             .join(tasks_fts, tasks_fts.c.rowid == TasksDB.id)
+             .where(tasks_fts.c.tasks_fts.match(expression))
+             .order_by(func.bm25(tasks_fts.c.tasks_fts), TasksDB.ordinal)
+             .limit(limit))
+    return [dict(row) for row in (await session.exec(query)).mappings()]
+
+
+# Tasks of all users, page by page in id order
+
+async def tasks_page(session: AsyncSession, cursor: int, limit: int) -> tuple[list[dict], Union[int, None]]:
+    query = select(*EXPORT_COLUMNS).where(TasksDB.id > cursor).order_by(TasksDB.id).limit(limit)
+    result = [dict(row) for row in (await session.exec(query)).mappings()]
+
+    next_cursor = result[-1]["id"] if len(result) == limit else None
+    return result, next_cursor
+
+
+# All tasks after the cursor as plain dicts, read from the database in batches.
+# The export has its own session, so it can outlive the caller's one
+
+EXPORT_BATCH_SIZE = 500
+
+async def export_tasks(cursor: int) -> AsyncIterator[list[dict]]:
+    query = (select(*EXPORT_COLUMNS)
+             .where(TasksDB.id > cursor)
+             .order_by(TasksDB.id)
+             .execution_options(yield_per=EXPORT_BATCH_SIZE))
+
+    async with read_session() as session:
+        rows = await session.stream(query)
+        async for partition in rows.partitions():
+            yield [dict(row._mapping) for row in partition]
+
+
+async def create_task(session: AsyncSession, tg_id: int, description: str, deadline: Union[int, None]) -> None:
+    deadline_at = None
+
+    if(deadline):
+        deadline_at = datetime.now().replace(microsecond=0) + timedelta(days=deadline)
+
+    # The next number is computed inside the INSERT itself, so two concurrent
+    # requests of the same user can't get the same one
+    taskDB = TasksDB(
+       tg_id = tg_id,
+       ordinal = last_ordinal(tg_id) + 1,
+       status = "incomplete",
+       description = description,
+       deadline = deadline_at,
+    )
+
+    session.add(taskDB)
+    await shift_task_counters(session, tg_id, total=1, incomplete=1)
+    await session.commit()
+    advice_precompute.wake()
+
+
+# Creating many tasks in one transaction: the rows go to SQLite in a single executemany.
+# Write sessions hold the write lock from the start (see database.write_session),
+# so the numbers after the user's last one can't be taken by anyone else meanwhile.
+# Reminders need nothing extra: the reminder sweep finds the new tasks by their deadlines
+
+async def create_tasks(session: AsyncSession, items: TasksBatchIn) -> list[int]:
+    now = datetime.now().replace(microsecond=0)
+    last = (await session.exec(select(last_ordinal(items.tg_id)))).one()
+    ordinals = list(range(last + 1, last + 1 + len(items.tasks)))
+
+    rows = [{
+        "tg_id": items.tg_id,
+        "ordinal": ordinal,
+        "status": "incomplete",
+        "description": item.description,
+        "created_at": now,
+        "deadline": now + timedelta(days=item.deadline) if item.deadline else None,
+        "reminder_sent": False,
+    } for ordinal, item in zip(ordinals, items.tasks)]
+
+    await session.exec(insert(TasksDB), params=rows)
+    await shift_task_counters(session, items.tg_id, total=len(rows), incomplete=len(rows))
+    await session.commit()
+    advice_precompute.wake()
+    return ordinals
+
+
+# Changing task's status from incomplete to done
+
+async def mark_done(session: AsyncSession, user_id: int, task_id: int) -> TasksDB:
+    task = await get_user_task(session, user_id, task_id)
+
+    if task.status != "done":
+        await shift_task_counters(session, user_id, done=1, **status_delta(task.status, -1))
+        task.sqlmodel_update({"status": "done", "done_at": datetime.now().replace(microsecond=0)})
+    await session.commit()
+    return task
+
+
+async def delete_task(session: AsyncSession, item_id: int) -> None:
+    query = select(TasksDB).where(TasksDB.id == item_id)
+    result = await session.exec(query)
+    task = result.one()
+    await session.delete(task)
+    await shift_task_counters(session, task.tg_id, total=-1, **status_delta(task.status, -1))
+    await session.commit()
+
+
+# Deleting many tasks of a user in one transaction with a single DELETE statement
+
+async def delete_tasks(session: AsyncSession, items: TasksDeleteIn) -> TasksDeleteOut:
+    query = (delete(TasksDB)
+             .where(TasksDB.tg_id == items.tg_id,
+                    or_(TasksDB.ordinal.in_(items.task_ids), TasksDB.id.in_(items.ids)))
+             .returning(TasksDB.id, TasksDB.ordinal, TasksDB.status))
+    removed = (await session.exec(query)).all()
+
+    if removed:
+        statuses = [row.status for row in removed]
+        await shift_task_counters(session, items.tg_id,
+                                  total=-len(removed),
+                                  done=-statuses.count("done"),
+                                  incomplete=-statuses.count("incomplete"))
+    await session.commit()
+
+    removed_ordinals = {row.ordinal for row in removed}
+    removed_ids = {row.id for row in removed}
+    return TasksDeleteOut(
+        deleted=[i for i in items.task_ids if i in removed_ordinals],
+        not_deleted=[i for i in items.task_ids if i not in removed_ordinals],
+        deleted_ids=[i for i in items.ids if i in removed_ids],
+        not_deleted_ids=[i for i in items.ids if i not in removed_ids],
+    )
+
+
+# Archive
+
+# Moving one batch of tasks done before "done_before" to the archive, oldest first.
+# Counters of the owners are shifted in the same transaction. Returns the number of tasks moved
+
+ARCHIVE_COLUMNS = (TasksDB.tg_id, TasksDB.ordinal, TasksDB.description, TasksDB.created_at,
+                   TasksDB.deadline, TasksDB.done_at)
+
+async def archive_done_tasks(session: AsyncSession, done_before: datetime, limit: int) -> int:
+    query = (select(TasksDB.id, *ARCHIVE_COLUMNS)
+             .where(TasksDB.done_at < done_before, TasksDB.status == "done")
+             .order_by(TasksDB.done_at)
+             .limit(limit))
+    rows = [dict(row) for row in (await session.exec(query)).mappings()]
+    if not rows:
+        return 0
+
+    now = datetime.now().replace(microsecond=0)
+    ids = [row.pop("id") for row in rows]
+    await session.exec(insert(ArchivedTask), params=[{**row, "status": "archived", "archived_at": now} for row in rows])
+    await session.exec(delete(TasksDB).where(TasksDB.id.in_(ids)))
+
+    moved: dict[int, int] = {}
+    for row in rows:
+        moved[row["tg_id"]] = moved.get(row["tg_id"], 0) + 1
+    for tg_id, count in moved.items():
+        await shift_task_counters(session, tg_id, total=-count, done=-count, archived=count)
+
+    await session.commit()
+    return len(rows)
+
+
+# Periodic job moving everything that is due, batch by batch
+
+async def archive_loop(interval: float, after_days: int = TASK_ARCHIVE_AFTER_DAYS,
+                       batch_size: int = TASK_ARCHIVE_BATCH_SIZE) -> None:
+    while True:
+        done_before = datetime.now() - timedelta(days=after_days)
+        try:
+            while True:
+                async with write_session() as session:
+                    moved = await archive_done_tasks(session, done_before, batch_size)
+                if moved < batch_size:
+                    break
+        except Exception:
+            logger.exception("Archiving done tasks failed")
+        await asyncio.sleep(interval)
+
+
+# User's archived tasks page by page in the order of their numbers:
+# pass "next_cursor" of a page as "cursor" to get the next one
+
+async def archive_page(session: AsyncSession, tg_id: int, cursor: int, limit: int) -> tuple[list[dict], Union[int, None]]:
+    query = (select(ArchivedTask.ordinal, ArchivedTask.description, ArchivedTask.deadline, ArchivedTask.status,
+                    ArchivedTask.created_at, ArchivedTask.done_at, ArchivedTask.archived_at)
+             .where(ArchivedTask.tg_id == tg_id, ArchivedTask.ordinal > cursor)
+             .order_by(ArchivedTask.ordinal)
+             .limit(limit))
+    result = [dict(row) for row in (await session.exec(query)).mappings()]
+
+    next_cursor = result[-1]["ordinal"] if len(result) == limit else None
+    return result, next_cursor
+
+
+# Reminders
+
+# Incomplete tasks whose reminder is due and hasn't been sent yet.
+# Tasks whose deadline passed while the bot was down are included too (the bot says they are overdue),
+# but only for REMINDER_LEAD after the deadline: older tasks never had their reminder tracked
+
+async def due_reminders(session: AsyncSession, limit: int) -> list[Reminder]:
+    now = datetime.now()
+    query = (select(TasksDB.id, TasksDB.tg_id, TasksDB.description, TasksDB.deadline)
+             .where(TasksDB.reminder_sent == False,
+                    TasksDB.status == "incomplete",
+                    TasksDB.deadline > now - REMINDER_LEAD,
+                    TasksDB.deadline <= now + REMINDER_LEAD)
+             .order_by(TasksDB.deadline)
+             .limit(limit))
+    rows = (await session.exec(query)).all()
+
+    return [Reminder(id=row.id, tg_id=row.tg_id, description=row.description, deadline=row.deadline)
+            for row in rows]
+
+
+# The flag isn't part of the task list (see TASK_COLUMNS), so the owners' versions stay
+# as they are and the clients' cached lists stay valid
+
+async def mark_reminders_sent(session: AsyncSession, ids: list[int]) -> None:
+    await session.exec(update(TasksDB).where(TasksDB.id.in_(ids)).values(reminder_sent=True))
+    await session.commit()
@@ -0,0 +1,310 @@
+import asyncio
+import logging
+import time
+from os import getenv
+from typing import AsyncIterator, Awaitable, Callable, TypeVar, Union
+
+from perplexity import AsyncPerplexity
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+# Sonar call settings (can be tuned through .env)
+
+SONAR_MAX_CONCURRENCY = int(getenv("SONAR_MAX_CONCURRENCY", "4"))
+SONAR_TIMEOUT = float(getenv("SONAR_TIMEOUT", "25"))
+SONAR_BREAKER_FAILURES = int(getenv("SONAR_BREAKER_FAILURES", "5"))
+SONAR_BREAKER_RESET = float(getenv("SONAR_BREAKER_RESET", "30"))
+
+
+# Call metrics. "outcome" is ok, timeout, unavailable (the breaker is open), error or
+# cancelled (the caller went away); a stream is timed until its last piece
+
+sonar_latency = Histogram(
+    "sonar_request_duration_seconds",
+    "Time a Sonar call takes, including the wait for a free slot",
+    ("mode", "outcome"),
+)
+sonar_errors = Counter(
+    "sonar_errors_total",
+    "Sonar calls that failed, by the error raised",
+    ("mode", "error"),
+)
+
+
+def record_call(mode: str, started: float, outcome: str, error: Union[BaseException, None] = None) -> None:
+    sonar_latency.observe(time.perf_counter() - started, mode, outcome)
+    if error is not None:
+        sonar_errors.inc(mode, type(error).__name__)
+
+
+# Tokens as reported by Sonar, or roughly four characters per token if it doesn't say
+
+def used_tokens(answer, prompt: str, content: str) -> int:
+    usage = getattr(answer, "usage", None)
+    if usage is not None and getattr(usage, "total_tokens", None):
+        return usage.total_tokens
+    return (len(prompt) + len(content or "")) // 4
+
+
+class SonarUnavailable(Exception):
+    pass
+
+
+class SonarTimeout(Exception):
+    pass
+
+
+# After "failure_threshold" failures in a row the breaker opens and calls fail at once.
+# Once "reset_timeout" seconds have passed, a single trial call is let through:
+# its success closes the breaker again, its failure keeps it open for another period
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = SONAR_BREAKER_FAILURES,
+                 reset_timeout: float = SONAR_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Union[float, None] = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self._trial or time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if not self._trial and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._trial = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._trial = False
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    # A call that was cancelled tells nothing about Sonar's health,
+    # it only gives the trial slot back
+
+    def record_cancel(self) -> None:
+        self._trial = False
+
+
+# Callers asking for the same key while a call is running share its result
+# instead of starting a call of their own
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        call = self._calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(fn())
+            self._calls[key] = call
+            call.add_done_callback(lambda _: self._calls.pop(key, None))
+
+        # A caller that goes away (e.g. the client disconnected) doesn't cancel the call for the others
+        return await asyncio.shield(call)
+
+    def running(self, key: str) -> Union[asyncio.Future, None]:
+        return self._calls.get(key)
+
+    # For a caller that makes the result itself (e.g. from a stream it reads): the returned
+    # future is what the others wait for, and the caller sets its result or exception.
+    # None if a call for the key is already running
+
+    def lead(self, key: str) -> Union[asyncio.Future, None]:
+        if key in self._calls:
+            return None
+        call = asyncio.get_running_loop().create_future()
+        self._calls[key] = call
+        call.add_done_callback(lambda _: self._calls.pop(key, None))
+        # Nobody may be waiting for it, its exception isn't worth a warning then
+        call.add_done_callback(lambda done: done.cancelled() or done.exception())
+        return call
+
+
+# Asynchronous Sonar client: at most "max_concurrency" calls run at the same time,
+# and each one (including the wait for a free slot) must finish within "timeout" seconds
+
+class SonarClient:
+    def __init__(self, client: Union[AsyncPerplexity, None] = None, *,
+                 model: str = "sonar",
+                 max_concurrency: int = SONAR_MAX_CONCURRENCY,
+                 timeout: float = SONAR_TIMEOUT,
+                 breaker: Union[CircuitBreaker, None] = None):
+        self.client = client or AsyncPerplexity()
+        self.model = model
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    # Waiting for a free slot is part of the timeout, but running out of time there says
+    # nothing about Sonar's health: it only gives the breaker's trial back
+
+    async def _acquire_slot(self, mode: str, started: float) -> None:
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError as exc:
+            self.breaker.record_cancel()
+            record_call(mode, started, "timeout", exc)
+            raise SonarTimeout(f"No free slot for a Sonar call within {self.timeout} seconds")
+        except asyncio.CancelledError:
+            self.breaker.record_cancel()
+            record_call(mode, started, "cancelled")
+            raise
+
+    async def _complete(self, prompt: str) -> tuple[str, int]:
+        answer = await self.client.chat.completions.create(
+            messages=[
+                {
+                    "role": "user",
+                    "content": prompt,
+                }
+            ],
+            model=self.model,
+        )
+        content = answer.choices[0].message.content
+        return content, used_tokens(answer, prompt, content)
+
+    async def complete(self, prompt: str) -> str:
+        content, _ = await self.complete_with_usage(prompt)
+        return content
+
+    # The answer and the number of tokens it took
+
+    async def complete_with_usage(self, prompt: str) -> tuple[str, int]:
+        started = time.perf_counter()
+        if not self.breaker.allow():
+            record_call("complete", started, "unavailable")
+            raise SonarUnavailable("Sonar is unavailable, try again later")
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        await self._acquire_slot("complete", started)
+
+        try:
+            content, tokens = await asyncio.wait_for(self._complete(prompt), deadline - loop.time())
+        except asyncio.TimeoutError as exc:
+            self.breaker.record_failure()
+            record_call("complete", started, "timeout", exc)
+            raise SonarTimeout(f"Sonar didn't answer within {self.timeout} seconds")
+        except asyncio.CancelledError:
+            self.breaker.record_cancel()
+            record_call("complete", started, "cancelled")
+            raise
+        except Exception as exc:
+            self.breaker.record_failure()
+            record_call("complete", started, "error", exc)
+            logger.exception("Sonar call failed")
+            raise
+        finally:
+            self._semaphore.release()
+
+        self.breaker.record_success()
+        record_call("complete", started, "ok")
+        return content, tokens
+
+    # Streaming variant: the answer is returned piece by piece as Sonar generates it.
+    # The call is started (and can fail with SonarUnavailable/SonarTimeout) before
+    # the iterator is returned; the same timeout covers the whole stream.
+    # The slot and the upstream response belong to the generator, which is already
+    # running when it is returned: closing it, or just dropping it unread, gives both back
+
+    async def stream(self, prompt: str) -> AsyncIterator[str]:
+        started = time.perf_counter()
+        if not self.breaker.allow():
+            record_call("stream", started, "unavailable")
+            raise SonarUnavailable("Sonar is unavailable, try again later")
+
+        pieces = self._stream(prompt, started)
+        # Runs up to the first "yield", once the call is started
+        await pieces.__anext__()
+        return pieces
+
+    async def _stream(self, prompt: str, started: float) -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        await self._acquire_slot("stream", started)
+
+        try:
+            try:
+                upstream = await asyncio.wait_for(
+                    self.client.chat.completions.create(
+                        messages=[
+                            {
+                                "role": "user",
+                                "content": prompt,
+                            }
+                        ],
+                        model=self.model,
+                        stream=True,
+                    ),
+                    deadline - loop.time(),
+                )
+            except asyncio.CancelledError:
+                self.breaker.record_cancel()
+                record_call("stream", started, "cancelled")
+                raise
+            except Exception as exc:
+                self.breaker.record_failure()
+                if isinstance(exc, asyncio.TimeoutError):
+                    record_call("stream", started, "timeout", exc)
+                    raise SonarTimeout(f"Sonar didn't answer within {self.timeout} seconds")
+                record_call("stream", started, "error", exc)
+                logger.exception("Sonar call failed")
+                raise
+
+            finished = False
+            try:
+                yield ""
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(upstream.__anext__(), deadline - loop.time())
+                    except StopAsyncIteration:
+                        break
+
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+
+                finished = True
+                self.breaker.record_success()
+                record_call("stream", started, "ok")
+            except asyncio.TimeoutError as exc:
+                finished = True
+                self.breaker.record_failure()
+                record_call("stream", started, "timeout", exc)
+                raise SonarTimeout(f"Sonar didn't finish within {self.timeout} seconds")
+            except Exception as exc:
+                finished = True
+                self.breaker.record_failure()
+                record_call("stream", started, "error", exc)
+                logger.exception("Sonar stream failed")
+                raise
+            finally:
+                if not finished:
+                    self.breaker.record_cancel()
+                    record_call("stream", started, "cancelled")
+                await upstream.close()
+        finally:
+            self._semaphore.release()
+
+    async def close(self) -> None:
+        await self.client.close()
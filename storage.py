@@ -0,0 +1,204 @@
+import asyncio
+import functools
+import logging
+import re
+import time
+from os import getenv
+from pathlib import Path
+from typing import Union
+
+from pydantic import BaseModel
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+
+# SQLite settings applied to every new connection.
+# A value of None leaves SQLite's own default in place
+
+class StorageProfile(BaseModel):
+    journal_mode: Union[str, None] = None
+    synchronous: Union[str, None] = None
+    busy_timeout: Union[int, None] = None       # milliseconds
+    mmap_size: Union[int, None] = None          # bytes
+    cache_size: Union[int, None] = None         # pages, or KiB when negative
+    temp_store: Union[str, None] = None
+    wal_autocheckpoint: Union[int, None] = None # pages
+
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_timeout: float = 30.0
+
+    # Seconds between background PASSIVE checkpoints, 0 turns them off
+    checkpoint_interval: float = 0
+
+
+PROFILES = {
+    # Plain SQLite: rollback journal, synchronous=FULL
+    "default": StorageProfile(),
+
+    # WAL lets readers work while a write is in progress, and synchronous=NORMAL
+    # only syncs the WAL on checkpoints instead of on every commit
+    "production": StorageProfile(
+        journal_mode="WAL",
+        synchronous="NORMAL",
+        busy_timeout=5000,
+        mmap_size=256 * 1024 * 1024,
+        cache_size=-64 * 1024,
+        temp_store="MEMORY",
+        wal_autocheckpoint=1000,
+        pool_size=10,
+        max_overflow=20,
+        checkpoint_interval=300,
+    ),
+}
+
+
+# Picking a profile with DB_PROFILE and overriding single settings,
+# e.g. SQLITE_BUSY_TIMEOUT=10000 or DB_POOL_SIZE=20
+
+ENV_OVERRIDES = {
+    "journal_mode": "SQLITE_JOURNAL_MODE",
+    "synchronous": "SQLITE_SYNCHRONOUS",
+    "busy_timeout": "SQLITE_BUSY_TIMEOUT",
+    "mmap_size": "SQLITE_MMAP_SIZE",
+    "cache_size": "SQLITE_CACHE_SIZE",
+    "temp_store": "SQLITE_TEMP_STORE",
+    "wal_autocheckpoint": "SQLITE_WAL_AUTOCHECKPOINT",
+    "pool_size": "DB_POOL_SIZE",
+    "max_overflow": "DB_MAX_OVERFLOW",
+    "pool_timeout": "DB_POOL_TIMEOUT",
+    "checkpoint_interval": "SQLITE_CHECKPOINT_INTERVAL",
+}
+
+
+def load_storage_profile() -> StorageProfile:
+    name = getenv("DB_PROFILE", "production")
+    if name not in PROFILES:
+        raise ValueError(f"Unknown DB_PROFILE {name!r}, expected one of {sorted(PROFILES)}")
+
+    overrides = {field: getenv(var) for field, var in ENV_OVERRIDES.items() if getenv(var) is not None}
+    return PROFILES[name].model_copy(update=StorageProfile.model_validate(overrides).model_dump(exclude_unset=True))
+
+
+# Sessions that write pass this execution option to take the write lock up front
+# (BEGIN IMMEDIATE). In WAL mode a deferred transaction that reads first and then
+# writes fails with "database is locked" if another writer committed in between,
+# without waiting for busy_timeout
+
+BEGIN_IMMEDIATE = {"sqlite_begin_immediate": True}
+
+
+# Statement timing, per database file, kind of statement and the table it works on
+
+sql_latency = Histogram(
+    "sql_statement_duration_seconds",
+    "Time SQLite takes to execute a statement",
+    ("db", "operation", "table"),
+)
+sql_errors = Counter(
+    "sql_statement_errors_total",
+    "Statements that failed",
+    ("db", "operation", "table"),
+)
+
+STATEMENT_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+\"?(\w+)", re.IGNORECASE)
+
+
+# Statements are compiled once and cached by SQLAlchemy, so there are few different
+# strings, and each one is parsed only once
+
+@functools.lru_cache(maxsize=1024)
+def statement_labels(statement: str) -> tuple[str, str]:
+    operation = statement.split(None, 1)[0].upper() if statement.strip() else ""
+    table = STATEMENT_TABLE.search(statement)
+    return operation, table.group(1).lower() if table else ""
+
+
+# Words of a task description for the search index (see database.create_search_index),
+# each one tagged with the owner: "7zмолоко" is "молоко" in a task of user 7. The index then
+# has separate terms for every user, so a search (prefixes and ranking included) only reads
+# the user's own part of it, however many tasks the others have. "ё" is searched as "е"
+
+SEARCH_WORD = re.compile(r"[^\W_]+")
+
+
+def search_words(tg_id: int, text: Union[str, None]) -> str:
+    owner = str(tg_id).replace("-", "n")
+    words = SEARCH_WORD.findall((text or "").lower().replace("ё", "е"))
+    return " ".join(f"{owner}z{word}" for word in words)
+
+
+PRAGMAS = ("journal_mode", "synchronous", "busy_timeout", "mmap_size",
+           "cache_size", "temp_store", "wal_autocheckpoint")
+
+
+def create_engine(url: str, profile: StorageProfile, **kwargs) -> AsyncEngine:
+    engine = create_async_engine(url,
+                                 pool_size=profile.pool_size,
+                                 max_overflow=profile.max_overflow,
+                                 pool_timeout=profile.pool_timeout,
+                                 **kwargs)
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in PRAGMAS:
+            value = getattr(profile, pragma)
+            if value is not None:
+                cursor.execute(f"PRAGMA {pragma}={value}")
+        cursor.close()
+        # The search index triggers call it
+        dbapi_connection.create_function("search_words", 2, search_words, deterministic=True)
+
+    @event.listens_for(engine.sync_engine, "begin")
+    def begin_transaction(conn):
+        # Other transactions are left to the sqlite3 driver, which begins them
+        # right before the first write, so plain reads don't hold any lock
+        if conn.get_execution_options().get("sqlite_begin_immediate"):
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    db = Path(engine.url.database or "memory").name
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("statement_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def record_time(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["statement_started"].pop()
+        sql_latency.observe(time.perf_counter() - started, db, *statement_labels(statement))
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def record_error(context):
+        conn = context.connection
+        if conn is None or not conn.info.get("statement_started"):
+            return
+        conn.info["statement_started"].pop()
+        sql_errors.inc(db, *statement_labels(context.statement or ""))
+
+    return engine
+
+
+# Checkpoint policy: SQLite checkpoints by itself every wal_autocheckpoint pages,
+# the loop below adds a PASSIVE checkpoint on a timer so the WAL doesn't grow
+# during quiet periods, and TRUNCATE on shutdown leaves an empty WAL behind
+
+async def checkpoint(engine: AsyncEngine, mode: str = "PASSIVE") -> None:
+    async with engine.connect() as conn:
+        result = await conn.execute(text(f"PRAGMA wal_checkpoint({mode})"))
+        busy, wal_pages, checkpointed = result.one()
+        logger.debug("WAL checkpoint %s: busy=%s, wal pages=%s, checkpointed=%s",
+                     mode, busy, wal_pages, checkpointed)
+
+
+async def checkpoint_loop(engine: AsyncEngine, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await checkpoint(engine)
+        except Exception:
+            logger.exception("WAL checkpoint failed")
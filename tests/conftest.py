@@ -0,0 +1,32 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("PERPLEXITY_API_KEY", "test")
+os.environ.setdefault("BOT_TOKEN", "42:test")
+
+import database
+import services
+from storage import PROFILES, create_engine
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+# A fresh SQLite database for every test, with the production pragmas
+
+@pytest.fixture
+async def db(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite+aiosqlite:///{tmp_path}/test.db", PROFILES["production"],
+                           connect_args={"check_same_thread": False})
+    monkeypatch.setattr(database, "engine", engine)
+    monkeypatch.setattr(services.advice_cache, "engine", engine)
+    monkeypatch.setattr(services.advice_cache, "_memory", type(services.advice_cache._memory)())
+    await database.create_db_and_tables()
+    yield engine
+    await engine.dispose()
@@ -0,0 +1,34 @@
+import asyncio
+
+import pytest
+
+import database
+from advice_cache import AdviceCache
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_answers_survive_a_restart_and_expire(db):
+    cache = AdviceCache(db, "v1", ttl=60)
+    await cache.set("Купить  Молоко", "совет")
+    assert await cache.get("купить молоко") == "совет"
+
+    restarted = AdviceCache(db, "v1", ttl=60)
+    assert await restarted.get("купить молоко") == "совет"
+    assert restarted.stats()["db_hits"] == 1
+
+    other_prompt = AdviceCache(db, "v2", ttl=60)
+    assert await other_prompt.get("купить молоко") is None
+    await other_prompt.purge()
+    assert await AdviceCache(db, "v1", ttl=60).get("купить молоко") is None
+
+
+async def test_writes_wait_for_the_write_lock(db):
+    cache = AdviceCache(db, "v1")
+    # Only the lock, SQLite itself is free: the write waits for its turn on the event loop
+    async with database.write_lock:
+        write = asyncio.create_task(cache.set("a", "b"))
+        await asyncio.sleep(0.05)
+        assert not write.done()
+    await write
+    assert await AdviceCache(db, "v1").get("a") == "b"
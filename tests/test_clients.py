@@ -0,0 +1,171 @@
+import itertools
+import time
+from typing import Any
+
+import httpx
+import pytest
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import EditMessageText, SendMessage
+from aiogram.types import Message, Update
+
+import main
+import tg_bot
+from api_client import APIError, TaskAPIClient
+from local_client import LocalTaskClient
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(params=["http", "inprocess"])
+async def api(request, db):
+    if request.param == "http":
+        client = TaskAPIClient("http://test", transport=httpx.ASGITransport(app=main.app))
+    else:
+        client = LocalTaskClient()
+    yield client
+    await client.close()
+
+
+# The HTTP API and the in-process client answer the same
+
+async def test_marking_a_task_without_deadline_done(api):
+    await api.register_user(1, "user")
+    await api.create_task(1, "без срока", None)
+    await api.create_task(1, "со сроком", 2)
+
+    assert await api.mark_done(1, 1) == {"description": "без срока", "deadline": None}
+    done = await api.mark_done(1, 2)
+    assert done["description"] == "со сроком"
+    assert done["deadline"] is not None
+
+
+async def test_count_is_the_number_of_tasks(api):
+    await api.register_user(1, "user")
+    for description in "abc":
+        await api.create_task(1, description, None)
+    await api.delete_tasks(1, [1])
+    assert await api.get_tasks_count(1) == 2
+
+
+async def test_count_endpoint_reports_the_highest_number(db):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+        for description in "abc":
+            await client.post("/tasks/", json={"tg_id": 1, "description": description})
+        await client.post("/tasks/delete/bulk/", json={"tg_id": 1, "task_ids": [1]})
+        assert (await client.get("/tasks/count/1")).json() == {"max_id": 3, "count": 2}
+        assert (await client.get("/tasks/count/2")).json() == {"max_id": 0, "count": 0}
+
+
+# The bot, fed synthetic updates; whatever it sends is recorded
+
+class RecordingSession(BaseSession):
+    def __init__(self):
+        super().__init__()
+        self.sent: list[str] = []
+        self.message_ids = itertools.count(1)
+
+    async def make_request(self, bot: Bot, method, timeout=None) -> Any:
+        if isinstance(method, (SendMessage, EditMessageText)):
+            self.sent.append(method.text)
+            return Message.model_validate({
+                "message_id": getattr(method, "message_id", None) or next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": method.chat_id, "type": "private"},
+                "text": method.text,
+            }, context={"bot": bot})
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        return
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+
+def chat(api, bot: Bot, user_id: int):
+    update_ids = itertools.count(1)
+
+    async def say(text: str) -> None:
+        update = Update.model_validate({
+            "update_id": next(update_ids),
+            "message": {
+                "message_id": next(update_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+                "text": text,
+            },
+        }, context={"bot": bot})
+        await tg_bot.dp.feed_update(bot, update, api=api)
+        await tg_bot.user_queues.join(user_id)
+
+    return say
+
+
+async def test_bot_answers_marking_a_task_without_deadline_done(api):
+    session = RecordingSession()
+    bot = Bot(token="42:test", session=session)
+    user_id = 700
+    say = chat(api, bot, user_id)
+
+    await api.register_user(user_id, "user")
+    await api.create_task(user_id, "Купить молоко", None)
+
+    await say("Я выполнил задачу")
+    await say("1")
+
+    assert session.sent[-1] == 'Задача номер 1\n\n"Купить молоко"\n\nВыполнена успешно'
+    state = tg_bot.dp.fsm.get_context(bot, chat_id=user_id, user_id=user_id)
+    assert await state.get_state() is None
+
+
+async def test_bot_answers_a_rejected_delete(api):
+    session = RecordingSession()
+    bot = Bot(token="42:test", session=session)
+    user_id = 701
+    say = chat(api, bot, user_id)
+
+    await api.register_user(user_id, "user")
+    await api.create_task(user_id, "Купить молоко", None)
+
+    await say("Удалить задания")
+    await say(",".join(["1"] * 1001))
+    assert session.sent[-1].startswith("Не получилось разобрать номера")
+
+    # The user can try again right away
+    await say("1")
+    assert session.sent[-1].startswith("Удалены задания с номером: [1]")
+
+
+async def test_deleting_is_not_retried(db):
+    calls = 0
+
+    async def lost_answer(request: httpx.Request) -> httpx.Response:
+        nonlocal calls
+        calls += 1
+        raise httpx.ReadError("connection reset", request=request)
+
+    client = TaskAPIClient("http://test", transport=httpx.MockTransport(lost_answer))
+    with pytest.raises(APIError) as exc_info:
+        await client.delete_tasks(1, [1])
+    await client.close()
+    assert exc_info.value.status_code == 503
+    assert calls == 1
+
+
+async def test_a_tag_only_matches_the_url_it_came_from(db):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+        for description in "abc":
+            await client.post("/tasks/", json={"tg_id": 1, "description": description})
+
+        urls = ["/tasks/count/1", "/tasks/1", "/tasks/1?limit=2", "/tasks/1?limit=2&offset=2"]
+        tags = [(await client.get(url)).headers["ETag"] for url in urls]
+        assert len(set(tags)) == len(urls)
+
+        for url, tag in zip(urls, tags):
+            assert (await client.get(url, headers={"If-None-Match": tag})).status_code == 304
+            for other in urls:
+                if other != url:
+                    assert (await client.get(other, headers={"If-None-Match": tag})).status_code == 200
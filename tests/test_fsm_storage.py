@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+
+from fsm_storage import BoundedStorage
+from storage import PROFILES, create_engine
+
+pytestmark = pytest.mark.anyio
+
+
+def key(n: int) -> StorageKey:
+    return StorageKey(bot_id=1, chat_id=n, user_id=n)
+
+
+async def test_least_recently_used_states_are_evicted():
+    storage = BoundedStorage(max_keys=2, ttl=0)
+    for n in range(3):
+        await storage.set_state(key(n), "Flow:step")
+    # Reading keeps a state in memory
+    await storage.get_state(key(1))
+    await storage.set_state(key(3), "Flow:step")
+
+    assert await storage.get_state(key(0)) is None
+    assert await storage.get_state(key(2)) is None
+    assert await storage.get_state(key(1)) == "Flow:step"
+    assert storage.stats()["evictions"] == 2
+    assert storage.stats()["resident"] == 2
+
+
+async def test_finished_flows_take_no_memory():
+    storage = BoundedStorage(max_keys=10, ttl=0)
+    await storage.set_state(key(1), "Flow:step")
+    await storage.set_data(key(1), {"description": "a"})
+    assert storage.stats()["in_flow"] == 1
+
+    await storage.set_state(key(1), None)
+    assert storage.stats()["in_flow"] == 0
+    await storage.set_data(key(1), {})
+    assert storage.stats()["resident"] == 0
+
+
+async def test_abandoned_flows_expire():
+    storage = BoundedStorage(max_keys=10, ttl=0.01)
+    await storage.set_state(key(1), "Flow:step")
+    await storage.set_state(key(2), "Flow:step")
+    await asyncio.sleep(0.02)
+
+    assert await storage.get_state(key(1)) is None
+    await storage.sweep()
+    assert storage.stats() == {"resident": 0, "in_flow": 0, "evictions": 0, "expirations": 2, "loads": 0}
+
+
+async def test_evicted_states_are_read_back_from_sqlite(tmp_path):
+    engine = create_engine(f"sqlite+aiosqlite:///{tmp_path}/fsm.db", PROFILES["production"],
+                           connect_args={"check_same_thread": False})
+    storage = BoundedStorage(max_keys=1, ttl=0, engine=engine)
+    await storage.set_state(key(1), "Flow:step")
+    await storage.set_data(key(1), {"description": "a"})
+    await storage.set_state(key(2), "Flow:other")
+
+    assert await storage.get_data(key(1)) == {"description": "a"}
+    assert storage.stats()["loads"] == 1
+
+    # A new storage on the same file is a restart
+    restarted = BoundedStorage(max_keys=10, ttl=0, engine=engine)
+    assert await restarted.get_state(key(2)) == "Flow:other"
+    await storage.close()
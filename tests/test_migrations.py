@@ -0,0 +1,62 @@
+import sqlite3
+
+import pytest
+from sqlmodel import select
+
+import database
+import services
+from database import TaskCounters, read_session
+from storage import PROFILES, create_engine
+
+pytestmark = pytest.mark.anyio
+
+
+# The schema before task numbers, counters, reminders, archiving and search
+
+OLD_SCHEMA = """
+    CREATE TABLE users (id INTEGER PRIMARY KEY, tg_id INTEGER UNIQUE NOT NULL, username VARCHAR, user_since DATETIME NOT NULL);
+    CREATE TABLE tasksdb (id INTEGER PRIMARY KEY, tg_id INTEGER NOT NULL, status VARCHAR NOT NULL,
+                          description VARCHAR, created_at DATETIME NOT NULL, deadline DATETIME);
+    CREATE TABLE usagelimit (user_id INTEGER PRIMARY KEY, day DATE, requests_count INTEGER NOT NULL, unlimited BOOLEAN NOT NULL);
+"""
+
+
+@pytest.fixture
+async def old_db(tmp_path, monkeypatch):
+    path = tmp_path / "old.db"
+    with sqlite3.connect(path) as conn:
+        conn.executescript(OLD_SCHEMA)
+        conn.executemany("INSERT INTO tasksdb (tg_id, status, description, created_at) VALUES (?, ?, ?, '2024-01-01 10:00:00')",
+                         [(1, "incomplete", "первая"), (2, "done", "чужая"), (1, "done", "вторая"), (1, "incomplete", "третья")])
+    conn.close()
+
+    engine = create_engine(f"sqlite+aiosqlite:///{path}", PROFILES["production"],
+                           connect_args={"check_same_thread": False})
+    monkeypatch.setattr(database, "engine", engine)
+    yield engine
+    await engine.dispose()
+
+
+async def test_existing_tasks_are_numbered_counted_and_indexed(old_db):
+    await database.create_db_and_tables()
+
+    async with read_session() as session:
+        tasks = await services.list_tasks(session, 1)
+        counters = (await session.exec(select(TaskCounters).order_by(TaskCounters.tg_id))).all()
+        found = await services.search_tasks(session, 1, "вторая", 10)
+
+    assert [(task["ordinal"], task["description"]) for task in tasks] == [(1, "первая"), (2, "вторая"), (3, "третья")]
+    assert [(c.tg_id, c.total, c.done, c.incomplete) for c in counters] == [(1, 3, 1, 2), (2, 1, 1, 0)]
+    assert [task["ordinal"] for task in found] == [2]
+
+
+async def test_migrating_twice_changes_nothing(old_db):
+    await database.create_db_and_tables()
+    await database.create_db_and_tables()
+
+    async with read_session() as session:
+        tasks = await services.list_tasks(session, 1)
+        found = await services.search_tasks(session, 1, "третья", 10)
+    assert [task["ordinal"] for task in tasks] == [1, 2, 3]
+    # The index isn't filled a second time
+    assert len(found) == 1
@@ -0,0 +1,21 @@
+from datetime import datetime, timedelta
+
+from models import Reminder
+from reminders import reminder_text
+
+NOW = datetime(2024, 5, 1, 12, 0)
+
+
+def reminder(left: timedelta) -> Reminder:
+    return Reminder(id=1, tg_id=1, description="Сдать отчёт", deadline=NOW + left)
+
+
+def test_the_reminder_says_how_much_time_is_left():
+    assert reminder_text(reminder(timedelta(hours=24)), NOW) == "До дедлайна осталось 24 ч\n\nОписание: Сдать отчёт"
+    assert reminder_text(reminder(timedelta(hours=5, minutes=30)), NOW).startswith("До дедлайна осталось 5 ч 30 мин\n")
+    assert reminder_text(reminder(timedelta(minutes=40)), NOW).startswith("До дедлайна осталось 40 мин\n")
+
+
+def test_a_late_reminder_says_the_deadline_has_passed():
+    assert reminder_text(reminder(-timedelta(hours=2)), NOW) == "Дедлайн уже прошёл\n\nОписание: Сдать отчёт"
+    assert reminder_text(reminder(timedelta(seconds=20)), NOW).startswith("Дедлайн уже прошёл\n")
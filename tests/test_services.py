@@ -0,0 +1,243 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlmodel import select
+
+import services
+from database import ArchivedTask, QuotaReservation, TaskCounters, TasksDB, UsageLimit, read_session, write_session
+from models import TaskItem, TasksBatchIn, TasksDeleteIn
+
+pytestmark = pytest.mark.anyio
+
+
+async def add_tasks(tg_id: int, *descriptions: str, deadline=None) -> None:
+    for description in descriptions:
+        async with write_session() as session:
+            await services.create_task(session, tg_id, description, deadline)
+
+
+async def ordinals(tg_id: int) -> list[int]:
+    async with read_session() as session:
+        return [task["ordinal"] for task in await services.list_tasks(session, tg_id)]
+
+
+async def counters(tg_id: int) -> TaskCounters:
+    async with read_session() as session:
+        return await services.get_task_counters(session, tg_id)
+
+
+# Task numbers
+
+async def test_numbers_are_per_user_and_stay_after_deletes(db):
+    await add_tasks(1, "a", "b", "c")
+    await add_tasks(2, "x")
+
+    async with write_session() as session:
+        result = await services.delete_tasks(session, TasksDeleteIn(tg_id=1, task_ids=[2, 9]))
+    assert result.deleted == [2]
+    assert result.not_deleted == [9]
+
+    await add_tasks(1, "d")
+    assert await ordinals(1) == [1, 3, 4]
+    assert await ordinals(2) == [1]
+
+    async with read_session() as session:
+        assert await services.max_ordinal(session, 1) == 4
+        assert await services.tasks_count(session, 1) == 3
+
+
+async def test_batch_continues_after_the_last_number(db):
+    await add_tasks(1, "a")
+    async with write_session() as session:
+        numbers = await services.create_tasks(session, TasksBatchIn(tg_id=1, tasks=[
+            TaskItem(description="b", deadline=2), TaskItem(description="c")]))
+    assert numbers == [2, 3]
+    assert (await counters(1)).total == 3
+
+
+async def test_archived_numbers_are_not_given_again(db):
+    await add_tasks(1, "a", "b")
+    async with write_session() as session:
+        await services.mark_done(session, 1, 2)
+    async with write_session() as session:
+        moved = await services.archive_done_tasks(session, datetime.now() + timedelta(days=1), 100)
+    assert moved == 1
+
+    await add_tasks(1, "c")
+    assert await ordinals(1) == [1, 3]
+
+    info = await counters(1)
+    assert (info.total, info.done, info.archived) == (2, 0, 1)
+    async with read_session() as session:
+        archived = (await session.exec(select(ArchivedTask.ordinal))).all()
+    assert archived == [2]
+
+
+async def test_mark_done_without_deadline(db):
+    await add_tasks(1, "no deadline")
+    async with write_session() as session:
+        task = await services.mark_done(session, 1, 1)
+    assert task.deadline is None
+    assert task.status == "done"
+
+    info = await counters(1)
+    assert (info.done, info.incomplete) == (1, 0)
+
+    # Marking it again doesn't count it twice
+    async with write_session() as session:
+        await services.mark_done(session, 1, 1)
+    assert (await counters(1)).done == 1
+
+
+async def test_unknown_task_is_not_found(db):
+    async with write_session() as session:
+        with pytest.raises(services.TaskNotFound):
+            await services.mark_done(session, 1, 5)
+
+
+# Advice quota
+
+async def test_reserve_is_idempotent_and_refund_gives_one_back(db, monkeypatch):
+    monkeypatch.setattr(services, "DAILY_ADVICE_LIMIT", 2)
+    async with write_session() as session:
+        await services.register_user(session, 1, "user")
+
+    async def reserve(key: str) -> bool:
+        async with write_session() as session:
+            return await services.reserve_quota(session, 1, key)
+
+    async def refund(key: str) -> bool:
+        async with write_session() as session:
+            return await services.refund_quota(session, key)
+
+    async def used() -> int:
+        async with read_session() as session:
+            return (await session.get(UsageLimit, 1)).requests_count
+
+    assert await reserve("a")
+    assert await reserve("a")
+    assert await used() == 1
+
+    assert await reserve("b")
+    assert not await reserve("c")
+    assert await used() == 2
+
+    assert await refund("a")
+    assert not await refund("a")
+    assert await used() == 1
+    # A refunded key stays refunded
+    assert not await reserve("a")
+    assert await reserve("c")
+
+
+async def test_a_request_key_belongs_to_its_first_user(db):
+    for user_id in (1, 2):
+        async with write_session() as session:
+            await services.register_user(session, user_id, "user")
+
+    async with write_session() as session:
+        assert await services.reserve_quota(session, 1, "key")
+    async with write_session() as session:
+        assert not await services.reserve_quota(session, 2, "key")
+    async with read_session() as session:
+        assert (await session.get(UsageLimit, 2)).requests_count == 0
+
+
+async def test_old_request_keys_are_dropped_on_reserve(db):
+    async with write_session() as session:
+        await services.register_user(session, 1, "user")
+        session.add(QuotaReservation(request_key="yesterday", user_id=1, day=date.today() - timedelta(days=1)))
+        await session.commit()
+
+    async with write_session() as session:
+        assert await services.reserve_quota(session, 1, "today")
+    async with read_session() as session:
+        keys = (await session.exec(select(QuotaReservation.request_key))).all()
+    assert keys == ["today"]
+
+
+# Search
+
+async def test_search_only_finds_the_users_own_tasks(db):
+    await add_tasks(1, "Купить молоко", "Позвонить маме")
+    await add_tasks(2, "Купить хлеб")
+
+    async with read_session() as session:
+        found = await services.search_tasks(session, 1, "куп", 10)
+        other = await services.search_tasks(session, 2, "молоко", 10)
+        folded = await services.search_tasks(session, 1, "МОЛОКО", 10)
+    assert [task["description"] for task in found] == ["Купить молоко"]
+    assert other == []
+    assert [task["ordinal"] for task in folded] == [1]
+
+
+async def test_search_index_follows_edits_and_deletes(db):
+    await add_tasks(1, "старое описание")
+    async with write_session() as session:
+        task = await services.get_user_task(session, 1, 1)
+        task.description = "новое описание"
+        await session.commit()
+
+    async with read_session() as session:
+        assert await services.search_tasks(session, 1, "старое", 10) == []
+        assert len(await services.search_tasks(session, 1, "новое", 10)) == 1
+
+    async with write_session() as session:
+        await services.delete_tasks(session, TasksDeleteIn(tg_id=1, task_ids=[1]))
+    async with read_session() as session:
+        assert await services.search_tasks(session, 1, "новое", 10) == []
+
+
+async def test_search_of_nothing_but_punctuation(db):
+    await add_tasks(1, "a")
+    async with read_session() as session:
+        assert await services.search_tasks(session, 1, "?!", 10) == []
+
+
+# Counters
+
+async def test_counters_follow_every_change(db):
+    await add_tasks(1, "a", "b", "c")
+    async with write_session() as session:
+        await services.mark_done(session, 1, 1)
+    async with write_session() as session:
+        await services.delete_tasks(session, TasksDeleteIn(tg_id=1, task_ids=[1, 2]))
+
+    info = await counters(1)
+    assert (info.total, info.done, info.incomplete) == (1, 0, 1)
+
+    async with read_session() as session:
+        rows = (await session.exec(select(TasksDB.status))).all()
+    assert rows == ["incomplete"]
+
+
+# Reminders
+
+async def test_sending_reminders_keeps_the_task_lists_current(db):
+    await add_tasks(1, "скоро", deadline=1)
+    version = (await counters(1)).version
+
+    async with read_session() as session:
+        due = await services.due_reminders(session, 10)
+    assert [reminder.description for reminder in due] == ["скоро"]
+
+    async with write_session() as session:
+        await services.mark_reminders_sent(session, [reminder.id for reminder in due])
+    async with read_session() as session:
+        assert await services.due_reminders(session, 10) == []
+    assert (await counters(1)).version == version
+
+
+async def test_reminders_that_fell_due_while_the_bot_was_down_are_sent(db):
+    await add_tasks(1, "просрочена вчера", "просрочена давно", "через неделю", deadline=1)
+    now = datetime.now()
+    async with write_session() as session:
+        for ordinal, deadline in [(1, now - timedelta(hours=3)), (2, now - timedelta(days=30)), (3, now + timedelta(days=7))]:
+            task = (await session.exec(select(TasksDB).where(TasksDB.tg_id == 1, TasksDB.ordinal == ordinal))).one()
+            task.deadline = deadline
+            session.add(task)
+        await session.commit()
+
+    async with read_session() as session:
+        due = await services.due_reminders(session, 10)
+    assert [reminder.description for reminder in due] == ["просрочена вчера"]
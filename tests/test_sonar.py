@@ -0,0 +1,178 @@
+import asyncio
+import types
+from typing import Union
+
+import pytest
+
+from sonar import CircuitBreaker, SingleFlight, SonarClient, SonarTimeout, SonarUnavailable
+
+pytestmark = pytest.mark.anyio
+
+NS = types.SimpleNamespace
+
+
+# Stand-in for the Perplexity client: answers after "delay" seconds (or once "answer" is set),
+# streams "pieces"
+
+class FakeCompletions:
+    def __init__(self, pieces=("a", "b"), delay: float = 0.0, answer: Union[asyncio.Event, None] = None):
+        self.pieces = pieces
+        self.delay = delay
+        self.answer = answer
+        self.calls = 0
+        self.closed = 0
+
+    async def create(self, stream: bool = False, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.answer is not None:
+            await self.answer.wait()
+        if not stream:
+            return NS(choices=[NS(message=NS(content="".join(self.pieces)))], usage=None)
+
+        completions = self
+        pieces = iter(self.pieces)
+
+        class Stream:
+            async def __anext__(self):
+                try:
+                    return NS(choices=[NS(delta=NS(content=next(pieces)))])
+                except StopIteration:
+                    raise StopAsyncIteration
+
+            async def close(self):
+                completions.closed += 1
+
+        return Stream()
+
+
+def sonar_client(completions: FakeCompletions, **kwargs) -> SonarClient:
+    return SonarClient(NS(chat=NS(completions=completions)), **kwargs)
+
+
+# SingleFlight
+
+async def test_same_key_shares_one_call():
+    flights = SingleFlight()
+    calls = 0
+
+    def call(result: str):
+        async def run():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return result
+        return run
+
+    results = await asyncio.gather(*(flights.do("k", call(f"k{n}")) for n in range(5)),
+                                   flights.do("other", call("other")))
+    assert results == ["k0"] * 5 + ["other"]
+    assert calls == 2
+    assert flights.running("k") is None
+
+
+async def test_a_caller_going_away_doesnt_cancel_the_call():
+    flights = SingleFlight()
+
+    async def call():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    first = asyncio.create_task(flights.do("k", call))
+    second = asyncio.create_task(flights.do("k", call))
+    await asyncio.sleep(0)
+    first.cancel()
+    assert await second == "done"
+
+
+async def test_a_led_flight_is_waited_for():
+    flights = SingleFlight()
+    flight = flights.lead("k")
+    assert flights.lead("k") is None
+
+    waiter = asyncio.create_task(flights.do("k", lambda: asyncio.sleep(0, "own call")))
+    await asyncio.sleep(0)
+    flight.set_result("led")
+    assert await waiter == "led"
+    assert flights.running("k") is None
+
+
+# CircuitBreaker
+
+async def test_breaker_opens_and_lets_one_trial_through(monkeypatch):
+    now = 100.0
+    monkeypatch.setattr("sonar.time.monotonic", lambda: now)
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    now += 10
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_cancel()
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+async def test_open_breaker_fails_calls_at_once():
+    completions = FakeCompletions()
+    client = sonar_client(completions, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=60))
+    client.breaker.record_failure()
+
+    with pytest.raises(SonarUnavailable):
+        await client.complete("prompt")
+    with pytest.raises(SonarUnavailable):
+        await client.stream("prompt")
+    assert completions.calls == 0
+
+
+# Streams
+
+async def test_unread_streams_give_their_slot_back():
+    completions = FakeCompletions()
+    client = sonar_client(completions, max_concurrency=2, timeout=0.5)
+
+    for _ in range(5):
+        await (await client.stream("prompt")).aclose()
+    for _ in range(5):
+        await client.stream("prompt")
+        # Dropped at once, the event loop closes it
+        await asyncio.sleep(0.01)
+
+    assert client._semaphore._value == 2
+    assert completions.closed == 10
+    assert [piece async for piece in await client.stream("prompt")] == ["a", "b"]
+
+
+async def test_no_free_slot_is_a_timeout():
+    client = sonar_client(FakeCompletions(), max_concurrency=1, timeout=0.05)
+    held = await client.stream("prompt")
+
+    with pytest.raises(SonarTimeout):
+        await client.stream("prompt")
+    await held.aclose()
+    assert client.breaker.failures == 0
+
+
+async def test_waiting_for_a_slot_doesnt_open_the_breaker():
+    answer = asyncio.Event()
+    client = sonar_client(FakeCompletions(answer=answer), max_concurrency=1, timeout=1,
+                          breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+    busy = asyncio.create_task(client.complete("prompt"))
+    await asyncio.sleep(0)
+
+    client.timeout = 0.02
+    for _ in range(3):
+        with pytest.raises(SonarTimeout):
+            await client.complete("prompt")
+    assert client.breaker.failures == 0
+    assert client.breaker.state == "closed"
+
+    answer.set()
+    assert await busy == "ab"
+    assert client._semaphore._value == 1
@@ -0,0 +1,87 @@
+import asyncio
+import random
+import types
+
+import pytest
+from aiogram.types import Update
+
+from user_queues import UserQueues
+
+pytestmark = pytest.mark.anyio
+
+
+def update(n: int) -> Update:
+    return Update(update_id=n)
+
+
+def user(user_id: int):
+    return types.SimpleNamespace(id=user_id)
+
+
+async def test_each_users_updates_are_handled_in_order():
+    queues = UserQueues(max_in_flight=4, max_per_user=100)
+    handled: dict[int, list[int]] = {1: [], 2: [], 3: []}
+
+    async def handler(event, data):
+        # Later updates finishing sooner mustn't overtake earlier ones of the same user
+        await asyncio.sleep(random.random() / 500)
+        handled[data["event_from_user"].id].append(event.update_id)
+
+    for n in range(60):
+        user_id = n % 3 + 1
+        await queues(handler, update(n), {"event_from_user": user(user_id)})
+    for user_id in handled:
+        await queues.join(user_id)
+
+    assert handled == {user_id: list(range(user_id - 1, 60, 3)) for user_id in handled}
+
+
+async def test_at_most_max_in_flight_run_at_once():
+    queues = UserQueues(max_in_flight=2)
+    running = peak = 0
+
+    async def handler(event, data):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    for user_id in range(6):
+        await queues(handler, update(user_id), {"event_from_user": user(user_id)})
+    await queues.close()
+    assert peak == 2
+
+
+async def test_a_full_user_queue_drops_new_updates():
+    queues = UserQueues(max_in_flight=1, max_per_user=2)
+    handled = []
+    release = asyncio.Event()
+
+    async def handler(event, data):
+        await release.wait()
+        handled.append(event.update_id)
+
+    # The first one is taken off the queue as soon as the worker starts
+    await queues(handler, update(0), {"event_from_user": user(1)})
+    await asyncio.sleep(0)
+    for n in range(1, 5):
+        await queues(handler, update(n), {"event_from_user": user(1)})
+    release.set()
+    await queues.join(1)
+    assert handled == [0, 1, 2]
+
+
+async def test_a_failing_update_doesnt_stop_the_queue():
+    queues = UserQueues(max_in_flight=1)
+    handled = []
+
+    async def handler(event, data):
+        if event.update_id == 0:
+            raise RuntimeError("handler failed")
+        handled.append(event.update_id)
+
+    for n in range(3):
+        await queues(handler, update(n), {"event_from_user": user(1)})
+    await queues.join(1)
+    assert handled == [1, 2]
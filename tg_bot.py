@@ -1,30 +1,71 @@
 import asyncio
+import contextlib
 import logging
+import re
 import sys
+import time
 from os import getenv
 from dotenv import load_dotenv
-import httpx
-from datetime import datetime, date, timedelta
-from aiogram import Bot, Dispatcher, html, F, flags
+from datetime import datetime, date
+from typing import Any, Awaitable, Callable, Union
+from aiogram import BaseMiddleware, Bot, Dispatcher, html, F, flags
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.filters import CommandStart
+from aiogram.filters import Command, CommandObject, CommandStart
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from api_client import TaskAPIClient, APIError, TaskNotFound
+from reminders import sweep_reminders, REMINDER_SWEEP_INTERVAL
+from fsm_storage import create_fsm_storage, FSM_SWEEP_INTERVAL
+from metrics import Histogram, metrics_endpoint
+from user_queues import UserQueues
 
 load_dotenv()
 TOKEN = getenv("BOT_TOKEN")
-dp = Dispatcher()
+# Conversation states are kept in bounded memory, see fsm_storage.py
+fsm_storage = create_fsm_storage()
+dp = Dispatcher(storage=fsm_storage)
 scheduler = AsyncIOScheduler()
-API_BASE_URL = "http://localhost:8000"
+
+
+# Handler timing, served on /metrics together with the API's metrics in the in-process mode,
+# next to the webhook, or on BOT_METRICS_PORT
+
+handler_latency = Histogram(
+    "bot_handler_duration_seconds",
+    "Time a bot handler takes to answer an update",
+    ("handler", "outcome"),
+)
+
+class HandlerTimer(BaseMiddleware):
+    async def __call__(self, handler: Callable[[Any, dict[str, Any]], Awaitable[Any]],
+                       event: Any, data: dict[str, Any]) -> Any:
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await handler(event, data)
+            outcome = "ok"
+            return result
+        finally:
+            handler_latency.observe(time.perf_counter() - started, data["handler"].callback.__name__, outcome)
+
+dp.message.middleware(HandlerTimer())
+dp.callback_query.middleware(HandlerTimer())
+
+# Telegram limits how often a message can be edited,
+# so a streamed advice is shown at most once per this many seconds
+ADVICE_EDIT_INTERVAL = float(getenv("ADVICE_EDIT_INTERVAL", "1.0"))
 
 main_kb = ReplyKeyboardMarkup(
     keyboard=[
         [KeyboardButton(text="Добавить задачу"), KeyboardButton(text="Все задачи")],
         [KeyboardButton(text="Получить совет"), KeyboardButton(text="Я выполнил задачу")],
         [KeyboardButton(text="Удалить задания"), KeyboardButton(text="Профиль")],
+        [KeyboardButton(text="Добавить несколько задач"), KeyboardButton(text="Найти задачу")],
     ],
     resize_keyboard=True,
     one_time_keyboard=False
@@ -43,6 +84,9 @@ class AddTask(StatesGroup):
     waiting_for_description = State()
     waiting_for_deadline = State()
 
+class AddTasks(StatesGroup):
+    waiting_for_lines = State()
+
 class getHelp(StatesGroup):
     waiting_for_id = State()
 
@@ -55,18 +99,18 @@ class UserInfo(StatesGroup):
 class DeleteTask(StatesGroup):
     waiting_for_id = State()
 
+class SearchTasks(StatesGroup):
+    waiting_for_query = State()
+
 
 
 @dp.message(CommandStart())
-async def command_start_handler(message: Message) -> None:
+async def command_start_handler(message: Message, api: TaskAPIClient) -> None:
     if message.from_user is None:
         await message.answer("Не удалось определить пользователя ")
         return
 
-    async with httpx.AsyncClient() as client:
-        await client.post(
-            f"{API_BASE_URL}/user/new/?tg_id={message.from_user.id}&name={message.from_user.full_name}"
-        )
+    await api.register_user(message.from_user.id, message.from_user.full_name)
 
 
     await message.answer(html.bold("Добро пожаловать!") + "\n\nЯ помогу тебе с планированием дел\nТакже, я могу дать хороший совет по выполнению задачи 💡",
@@ -86,65 +130,42 @@ async def task_done(message: Message, state: FSMContext):
     await state.set_state(TaskDone.waiting_for_id)
 
 @dp.message(F.text=="Профиль")
-async def get_user_info(message: Message, state: FSMContext):
+async def get_user_info(message: Message, state: FSMContext, api: TaskAPIClient):
     if message.from_user is None:
         await message.answer("Не удалось определить пользователя")
         return
 
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{API_BASE_URL}/tasks/user/?user_id={message.from_user.id}"
-        )
-    
-    data = resp.json()
+    data = await api.get_user_info(message.from_user.id)
 
-    await message.answer(html.bold(f"Всего задач: {data['total']}") + "\n\n" + html.bold(f"Выполнено: {data['done']} ✅") + "\n" +html.bold(f"Не выполнено: {data['incomplete']} ❌"))
+    text = html.bold(f"Всего задач: {data.total}") + "\n\n" + html.bold(f"Выполнено: {data.done} ✅") + "\n" +html.bold(f"Не выполнено: {data.incomplete} ❌")
+    if data.archived:
+        text += "\n" + html.bold(f"Из выполненных в архиве: {data.archived} 🗄")
+    await message.answer(text)
     await state.clear()
 
 
 
 @dp.message(TaskDone.waiting_for_id)
-async def change_status(message: Message, state: FSMContext):
+async def change_status(message: Message, state: FSMContext, api: TaskAPIClient):
     if message.from_user is None:
         await message.answer("Не удалось определить пользователя")
         return
     
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{API_BASE_URL}/tasks/count/{message.from_user.id}",
-            timeout=10.0
-        )
-
-    data = resp.json()
-    max_id = data['max_id']
-
     if message.text is None:
         await message.answer("Введи номер задачи")
         return
 
     try:
-
         task_id = int(message.text)
-        if task_id <= 0 or task_id > max_id:
+        if task_id <= 0:
             raise ValueError
-    except ValueError:
-        await message.answer(f"Задача номер {task_id} не существует\nВведите правильный номер")
-        return
-    
-    if message.from_user is None:
-        await message.answer("Не удалось определить пользователя")
+        data = await api.mark_done(message.from_user.id, task_id)
+    except (ValueError, TaskNotFound):
+        await message.answer(f"Задача номер {message.text} не существует\nВведите правильный номер")
         return
 
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.put(
-            f"{API_BASE_URL}/tasks/?user_id={message.from_user.id}&task_id={task_id}"
-        )
-
-    data = resp.json()
-    scheduler.remove_job(f"reminder_{message.from_user.id}_{data['description']}")
-
     await message.answer(f"Задача номер {task_id}\n\n\"{data['description']}\"\n\nВыполнена успешно")
     await state.clear()
 
@@ -153,107 +174,150 @@ async def change_status(message: Message, state: FSMContext):
 
 
 
-@dp.message(F.text == "Все задачи")
-async def get_all_tasks(message: Message):
-    if message.from_user is None:
-        await message.answer("Не удалось определить пользователя")
-        return
-    
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{API_BASE_URL}/tasks/{message.from_user.id}",
-            timeout=10.0,
-        )
+# Tasks are shown one page at a time, with buttons for the previous and next pages.
+# Long descriptions are cut, so a full page always fits in one Telegram message (4096 characters)
 
-        allTasks = resp.json()
-        result =""
+TASKS_PAGE_SIZE = int(getenv("BOT_TASKS_PAGE_SIZE", "10"))
+TASK_PREVIEW_LENGTH = max(20, 3800 // TASKS_PAGE_SIZE - 60)
 
-    if len(allTasks) == 0:
-        result = "У вас нет задач"
-    else:
-        for i, item in enumerate(allTasks):
-            result += f"{i+1}\nЗадача: {item['description']}\nДедлайн: {item['deadline'][:10]}\n\n"
 
-    await message.answer(result)
+class TasksPage(CallbackData, prefix="tasks"):
+    offset: int
 
 
+def render_tasks_page(tasks: list[dict], offset: int, total: int) -> tuple[str, Union[InlineKeyboardMarkup, None]]:
+    if total == 0:
+        return "У вас нет задач", None
 
-@dp.message(F.text == "Получить совет")
-async def get_help(message: Message, state: FSMContext):
+    parts = [html.bold(f"Задачи {offset + 1}–{offset + len(tasks)} из {total}"), "\n\n"]
+    for item in tasks:
+        description = item['description'] or ""
+        if len(description) > TASK_PREVIEW_LENGTH:
+            description = description[:TASK_PREVIEW_LENGTH - 1] + "…"
+        parts += [str(item['ordinal']), "\nЗадача: ", html.quote(description),
+                  "\nДедлайн: ", (item['deadline'] or "-")[:10], "\n\n"]
+
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton(text="◀️ Назад",
+                                            callback_data=TasksPage(offset=max(0, offset - TASKS_PAGE_SIZE)).pack()))
+    if offset + len(tasks) < total:
+        buttons.append(InlineKeyboardButton(text="Вперёд ▶️",
+                                            callback_data=TasksPage(offset=offset + TASKS_PAGE_SIZE).pack()))
+
+    markup = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return "".join(parts), markup
+
+
+async def load_tasks_page(api: TaskAPIClient, user_id: int, offset: int) -> tuple[list[dict], int, int]:
+    tasks, total = await api.get_tasks_page(user_id, offset, TASKS_PAGE_SIZE)
+
+    # Tasks were deleted since the buttons were shown, going to the last page that is left
+    if not tasks and offset > 0 and total > 0:
+        offset = (total - 1) // TASKS_PAGE_SIZE * TASKS_PAGE_SIZE
+        tasks, total = await api.get_tasks_page(user_id, offset, TASKS_PAGE_SIZE)
+
+    return tasks, offset, total
+
+
+@dp.message(F.text == "Все задачи")
+async def get_all_tasks(message: Message, api: TaskAPIClient):
     if message.from_user is None:
         await message.answer("Не удалось определить пользователя")
         return
-    
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{API_BASE_URL}/check_limit/?user_id={message.from_user.id}",
-            timeout=10.0,
-        )
-    
-    data = resp.json()
 
-    if data['limit'] == 'bad':
-        await message.answer("Лимит на получение советов: 5 запросов в день\nВы превысили лимит на сегодня, попробуйте завтра")
+    tasks, offset, total = await load_tasks_page(api, message.from_user.id, 0)
+    text, markup = render_tasks_page(tasks, offset, total)
+
+    await message.answer(text, reply_markup=markup)
+
+
+@dp.callback_query(TasksPage.filter())
+async def get_tasks_page(callback: CallbackQuery, callback_data: TasksPage, api: TaskAPIClient):
+    if not isinstance(callback.message, Message):
+        await callback.answer("Сообщение устарело, нажмите «Все задачи»")
         return
 
+    tasks, offset, total = await load_tasks_page(api, callback.from_user.id, callback_data.offset)
+    text, markup = render_tasks_page(tasks, offset, total)
+
+    try:
+        await callback.message.edit_text(text, reply_markup=markup)
+    except TelegramBadRequest:
+        # The page hasn't changed since it was shown
+        pass
+    await callback.answer()
+
+
 
+@dp.message(F.text == "Получить совет")
+async def get_help(message: Message, state: FSMContext):
     await message.answer("Введите номер задачи, чтобы получить совет")
     await state.set_state(getHelp.waiting_for_id)
 
 
 @dp.message(getHelp.waiting_for_id)
-async def get_AI_response(message: Message, state: FSMContext):
+async def get_AI_response(message: Message, state: FSMContext, api: TaskAPIClient):
     if message.from_user is None:
         await message.answer("Не удалось определить пользователя")
         return
     
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{API_BASE_URL}/tasks/count/{message.from_user.id}",
-            timeout=10.0
-        )
-
-    data = resp.json()
-    maxId = int(data['max_id'])
-
     if message.text is None:
         await message.answer("Введите номер задачи")
         return
 
     try:
         task_id = int(message.text)
-        if task_id <= 0 or task_id > int(maxId):
+        if task_id <= 0:
             raise ValueError
     except ValueError:
         await message.answer(f"Задача с номером {message.text} не существует\nВведите правильный номер")
         return
     
-    
+    # The key is the same if the bot gets this message again, so it can't take two requests
+    request_key = f"{message.chat.id}:{message.message_id}"
+
+    if not await api.reserve_quota(message.from_user.id, request_key):
+        await message.answer("Лимит на получение советов: 5 запросов в день\nВы превысили лимит на сегодня, попробуйте завтра")
+        await state.clear()
+        return
     
     loading_msg = await message.answer("Готовлю совет...")
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{API_BASE_URL}/sonar/?user_id={message.from_user.id}&task_id={task_id}",
-            timeout=30.0
-        )
-
-    if resp.status_code == 202:
-        async with httpx.AsyncClient() as client:
-            await client.put(
-                f"{API_BASE_URL}/new_request/?user_id={message.from_user.id}",
-                timeout=10.0
-            )
+    loop = asyncio.get_running_loop()
+    advice = "Совет: "
+    shown = ""
+    next_edit = 0.0
 
-        await loading_msg.edit_text("Совет готов!")
-        advice = resp.json()
-        await message.answer(advice)
-
-    else:
-        await loading_msg.edit_text("Ошибка. Попробуйте еще раз")
+    try:
+        async for piece in api.stream_advice(message.from_user.id, task_id):
+            advice += piece
+            if loop.time() < next_edit:
+                continue
+
+            try:
+                await loading_msg.edit_text(advice, parse_mode=None)
+                shown = advice
+                next_edit = loop.time() + ADVICE_EDIT_INTERVAL
+            except TelegramRetryAfter as exc:
+                next_edit = loop.time() + exc.retry_after
+    except TaskNotFound:
+        await api.refund_quota(request_key)
+        await loading_msg.edit_text(f"Задача с номером {message.text} не существует\nВведите правильный номер")
+        return
+    except APIError as exc:
+        await api.refund_quota(request_key)
+        if exc.status_code == 503:
+            await loading_msg.edit_text("Сервис советов временно недоступен, попробуйте позже")
+        else:
+            await loading_msg.edit_text("Ошибка. Попробуйте еще раз")
         await state.clear()
         return
 
+    if advice != shown:
+        await asyncio.sleep(max(0.0, next_edit - loop.time()))
+        await loading_msg.edit_text(advice, parse_mode=None)
+
 
 
 @dp.message(AddTask.waiting_for_description)
@@ -266,7 +330,7 @@ async def receive_description(message: Message, state: FSMContext):
     await state.set_state(AddTask.waiting_for_deadline)
 
 @dp.message(AddTask.waiting_for_deadline)
-async def receive_deadline(message: Message, state: FSMContext):
+async def receive_deadline(message: Message, state: FSMContext, api: TaskAPIClient):
     try:
         days=int(str(message.text))
         if days <= 0:
@@ -282,39 +346,15 @@ async def receive_deadline(message: Message, state: FSMContext):
 
     data = await state.get_data()
     description = data["description"]
-    deadline = data["deadline"]
     user_id = message.from_user.id
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            f"{API_BASE_URL}/tasks/",
-            json={
-                "description": description,
-                "deadline": days,
-                "tg_id": user_id,
-            },
-            timeout=10.0,
-        )
-
-    if resp.status_code != 201:
+    try:
+        task = await api.create_task(user_id, description, days)
+    except APIError:
         await message.answer("Не удалось создать задачу, попробуйте снова")
         await state.clear()
         return
     
-    task = resp.json()
-    dt = datetime.now().replace(microsecond=0) + timedelta(days=deadline) - timedelta(days=1)
-    async def remind():
-        await message.answer(f"Дедлайн уже через 24 часа\n\nОписание: {task['deadline']}")
-
-
-    scheduler.add_job(
-        remind,
-        "date",
-        run_date=dt,
-        id=f"reminder_{message.from_user.id}_{task['description']}"
-    )
-    
-    
     await message.answer(
         f"Описание: {task['description']}\n"
         f"Дедлайн: {task['deadline']} дня\n\n"
@@ -325,96 +365,326 @@ async def receive_deadline(message: Message, state: FSMContext):
 
 
 
-@dp.message(F.text=="Удалить задания")
-async def get_to_delete_task(message: Message, state: FSMContext):
+# Several tasks in one message: one per line, a line may end with "; N" - the deadline in days
 
-    await message.answer("Введите номера заданий, которые вы хотите удалить, через запятую (1,2,3)\nЛибо просто одну цифру")
-    await state.set_state(DeleteTask.waiting_for_id)
+BATCH_MAX_TASKS = 100
+TASK_LINE = re.compile(r"^(?P<description>.+?)\s*;\s*(?P<days>\d+)\s*(?:д|дн|день|дня|дней)?\.?$")
 
-@dp.message(DeleteTask.waiting_for_id)
-async def delete_task(message: Message, state: FSMContext):
+
+def parse_task_lines(text: str) -> tuple[list[dict], list[str]]:
+    tasks, bad_lines = [], []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+
+        match = TASK_LINE.match(line)
+        if match is None:
+            tasks.append({"description": line, "deadline": None})
+        elif int(match["days"]) > 0:
+            tasks.append({"description": match["description"], "deadline": int(match["days"])})
+        else:
+            bad_lines.append(line)
+    return tasks, bad_lines
+
+
+@dp.message(F.text=="Добавить несколько задач")
+async def add_tasks(message: Message, state: FSMContext):
+    await message.answer(html.bold("Отправь задачи одним сообщением, каждую с новой строки 📝") + "\n\n"
+                         "В конце строки можно указать дедлайн в днях через «;», например:\n"
+                         + html.code("Купить продукты; 1\nПодготовить отчёт; 5\nПрочитать книгу"))
+    await state.set_state(AddTasks.waiting_for_lines)
+
+@dp.message(AddTasks.waiting_for_lines)
+async def receive_task_lines(message: Message, state: FSMContext, api: TaskAPIClient):
     if message.from_user is None:
-        await message.answer("Не удадось определить пользователя")
+        await message.answer("Не удалось определить пользователя")
+        return
+
+    tasks, bad_lines = parse_task_lines(message.text or "")
+
+    if bad_lines:
+        await message.answer("Дедлайн должен быть положительным числом дней, проверь строки:\n"
+                             + html.quote("\n".join(bad_lines)))
+        return
+    if not tasks:
+        await message.answer("Отправь задачи текстом, каждую с новой строки")
+        return
+    if len(tasks) > BATCH_MAX_TASKS:
+        await message.answer(f"За один раз можно добавить не больше {BATCH_MAX_TASKS} задач")
+        return
+
+    try:
+        ordinals = await api.create_tasks(message.from_user.id, tasks)
+    except APIError:
+        await message.answer("Не удалось добавить задачи, попробуйте снова")
+        await state.clear()
         return
-    
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{API_BASE_URL}/tasks/{message.from_user.id}",
-            timeout=10.0
-        )
+    await message.answer(f"Добавлено задач: {len(ordinals)}\nНомера: {ordinals[0]}–{ordinals[-1]}"
+                         if len(ordinals) > 1 else f"Задача добавлена под номером {ordinals[0]}")
+    await state.clear()
+
+
+
+# Search by description: "Найти задачу" asks for the words, "/search words" searches right away
+
+SEARCH_RESULTS = 10
+SEARCH_MAX_QUERY = 200
 
-    tasks = resp.json()
 
+def render_search_results(tasks: list[dict], query: str) -> str:
+    if not tasks:
+        return f"Ничего не нашлось по запросу «{html.quote(query)}»"
 
+    parts = [html.bold(f"Найдено по запросу «{html.quote(query)}»:"), "\n\n"]
+    for item in tasks:
+        description = item['description'] or ""
+        if len(description) > TASK_PREVIEW_LENGTH:
+            description = description[:TASK_PREVIEW_LENGTH - 1] + "…"
+        status = " ✅" if item['status'] == "done" else ""
+        parts += [str(item['ordinal']), status, "\nЗадача: ", html.quote(description),
+                  "\nДедлайн: ", (item['deadline'] or "-")[:10], "\n\n"]
+    return "".join(parts)
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{API_BASE_URL}/tasks/count/{message.from_user.id}",
-            timeout=10.0
-        )
 
-    max_id = resp.json()["max_id"]
-    tasks_to_delete = []
-    tasks_to_delete_DB_id = []
-    deleted = []
-    not_deleted = []
+async def answer_search(message: Message, api: TaskAPIClient, query: str) -> None:
+    if message.from_user is None:
+        await message.answer("Не удалось определить пользователя")
+        return
 
+    query = query.strip()[:SEARCH_MAX_QUERY]
+    try:
+        tasks = await api.search_tasks(message.from_user.id, query, SEARCH_RESULTS)
+    except APIError:
+        await message.answer("Не удалось выполнить поиск, попробуйте снова")
+        return
+    await message.answer(render_search_results(tasks, query))
 
 
+@dp.message(Command("search"))
+async def search_command(message: Message, command: CommandObject, state: FSMContext, api: TaskAPIClient):
+    if command.args:
+        await state.clear()
+        await answer_search(message, api, command.args)
+        return
+
+    await message.answer(html.bold("Какую задачу найти? Напиши слова из её описания 🔍"))
+    await state.set_state(SearchTasks.waiting_for_query)
+
+@dp.message(F.text=="Найти задачу")
+async def search_tasks(message: Message, state: FSMContext):
+    await message.answer(html.bold("Какую задачу найти? Напиши слова из её описания 🔍"))
+    await state.set_state(SearchTasks.waiting_for_query)
+
+@dp.message(SearchTasks.waiting_for_query)
+async def receive_search_query(message: Message, state: FSMContext, api: TaskAPIClient):
+    if not (message.text or "").strip():
+        await message.answer("Напиши слова из описания задачи текстом")
+        return
+
+    await answer_search(message, api, message.text or "")
+    await state.clear()
+
+
+
+@dp.message(F.text=="Удалить задания")
+async def get_to_delete_task(message: Message, state: FSMContext):
+
+    await message.answer("Введите номера заданий, которые вы хотите удалить, через запятую (1,2,3)\nЛибо просто одну цифру")
+    await state.set_state(DeleteTask.waiting_for_id)
+
+@dp.message(DeleteTask.waiting_for_id)
+async def delete_task(message: Message, state: FSMContext, api: TaskAPIClient):
+    if message.from_user is None:
+        await message.answer("Не удадось определить пользователя")
+        return
+    
+
     if message.text is None:
         await message.answer("Сообщение не получено")
         return
     
     try:
-        for i in message.text.strip().split(","):
-            if int(i) > 0 and int(i) <= max_id:
-                tasks_to_delete.append(int(i))
-            else: 
-                not_deleted.append(int(i))
- 
+        tasks_to_delete = [int(i) for i in message.text.strip().split(",")]
     except ValueError:
         await message.answer("Введите номера в правильном виде (1,2,3)")
         return
     
+    try:
+        result = await api.delete_tasks(message.from_user.id, tasks_to_delete)
+    except APIError as exc:
+        if exc.status_code == 422:
+            # Too many numbers (more than 1000) or a number out of range
+            await message.answer("Не получилось разобрать номера, введите их снова (не больше 1000 за раз)")
+            return
+        await message.answer("Не удалось удалить задания, проверьте список задач и попробуйте снова")
+        await state.clear()
+        return
 
-    for i, item in enumerate(tasks):
-        if i+1 in tasks_to_delete:
-            tasks_to_delete_DB_id.append(item["id"])
+    await message.answer(f"Удалены задания с номером: {result.deleted}\nНе получилось удалить: {result.not_deleted}")
+    await state.clear()
 
 
 
+    
 
 
+       
 
-    
-    for i in tasks_to_delete_DB_id:
-        async with httpx.AsyncClient() as client:
-            await client.delete(
-                f"{API_BASE_URL}/tasks/delete/?item_id={i}",
-                timeout=10.0
-            )
-
-    await message.answer(f"Удалены задания с номером: {tasks_to_delete}\nНе получилось удалить: {not_deleted}")
-    await state.clear()
 
 
 
-    
+# "http" talks to a separately started API (fastapi dev main.py),
+# "inprocess" runs the API in this process: the bot calls the service layer directly,
+# and the HTTP API is served on API_HOST:API_PORT for other clients
+BOT_API_MODE = getenv("BOT_API_MODE", "http")
+API_HOST = getenv("API_HOST", "127.0.0.1")
+API_PORT = int(getenv("API_PORT", "8000"))
 
+# "polling" asks Telegram for updates, "webhook" lets Telegram send them to WEBHOOK_URL.
+# The webhook is served on WEBHOOK_HOST:WEBHOOK_PORT, or together with the API in "inprocess" mode.
+# In both modes at most BOT_MAX_HANDLERS updates are handled at the same time
+BOT_UPDATE_MODE = getenv("BOT_UPDATE_MODE", "polling")
+BOT_MAX_HANDLERS = int(getenv("BOT_MAX_HANDLERS", "50"))
+WEBHOOK_URL = getenv("WEBHOOK_URL")
+WEBHOOK_PATH = getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(getenv("WEBHOOK_PORT", "8080"))
+# A polling bot in "http" mode has no HTTP server of its own; with a port set here,
+# one is started just for /metrics. 0 turns it off
+BOT_METRICS_PORT = int(getenv("BOT_METRICS_PORT", "0"))
 
-       
+# Every user's updates are handled in the order they came in, see user_queues.py
+user_queues = UserQueues(max_in_flight=BOT_MAX_HANDLERS)
+dp.update.outer_middleware(user_queues)
+dp.shutdown.register(user_queues.close)
 
 
+async def run_bot(bot: Bot, api: TaskAPIClient, app=None, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT) -> None:
+    # One job sends all due reminders, see reminders.py
+    scheduler.add_job(
+        sweep_reminders,
+        "interval",
+        seconds=REMINDER_SWEEP_INTERVAL,
+        kwargs={"bot": bot, "api": api},
+        id="reminder_sweeper",
+        max_instances=1,
+        coalesce=True,
+        next_run_time=datetime.now(),
+    )
+    # Abandoned conversations are dropped after FSM_TTL seconds
+    scheduler.add_job(
+        fsm_storage.sweep,
+        "interval",
+        seconds=FSM_SWEEP_INTERVAL,
+        id="fsm_sweeper",
+        max_instances=1,
+        coalesce=True,
+    )
+    scheduler.start()
+
+    if app is None and BOT_UPDATE_MODE == "polling" and BOT_METRICS_PORT:
+        from fastapi import FastAPI
+        app = FastAPI()
+        app.add_api_route("/metrics", metrics_endpoint, methods=["GET"], include_in_schema=False)
+        port = BOT_METRICS_PORT
+
+    try:
+        if BOT_UPDATE_MODE == "webhook":
+            await run_webhook(bot, api, app, host, port)
+        else:
+            await run_polling(bot, api, app, host, port)
+    finally:
+        scheduler.shutdown(wait=False)
+
+
+# "app" is the HTTP app to serve in the same process (the API, or just /metrics), if any
+
+async def run_polling(bot: Bot, api: TaskAPIClient, app, host: str, port: int) -> None:
+    # Telegram doesn't give out updates while a webhook is set
+    await bot.delete_webhook()
+
+    if app is None:
+        await dp.start_polling(bot, api=api, tasks_concurrency_limit=BOT_MAX_HANDLERS)
+        return
+
+    import uvicorn
+
+    # Ctrl+C is handled by the bot's polling, which then stops the server
+    class APIServer(uvicorn.Server):
+        @contextlib.contextmanager
+        def capture_signals(self):
+            yield
+
+    server = APIServer(uvicorn.Config(app, host=host, port=port, lifespan="off"))
+    serving = asyncio.create_task(server.serve())
+    try:
+        await dp.start_polling(bot, api=api, tasks_concurrency_limit=BOT_MAX_HANDLERS)
+    finally:
+        server.should_exit = True
+        await serving
+
+
+async def run_webhook(bot: Bot, api: TaskAPIClient, app, host: str, port: int) -> None:
+    import uvicorn
+    from fastapi import FastAPI
+    from webhook import WebhookUpdates
+
+    if app is None:
+        app = FastAPI()
+        app.add_api_route("/metrics", metrics_endpoint, methods=["GET"], include_in_schema=False)
+
+    updates = WebhookUpdates(dp, bot, secret=WEBHOOK_SECRET, max_handlers=BOT_MAX_HANDLERS, api=api)
+    app.add_api_route(WEBHOOK_PATH, updates.handle, methods=["POST"], include_in_schema=False)
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, lifespan="off"))
+
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        # Telegram's own limit for parallel webhook connections is 100
+        max_connections=min(BOT_MAX_HANDLERS, 100),
+    )
+    await dp.emit_startup(bot=bot, api=api)
+    try:
+        await server.serve()
+    finally:
+        await updates.close()
+        await dp.emit_shutdown(bot=bot, api=api)
+        await bot.session.close()
+
+
+async def run_in_process(bot: Bot) -> None:
+    # Imported here, so the bot in "http" mode doesn't need the database or Sonar
+    import services
+    from local_client import LocalTaskClient
+    from main import app
+
+    # The service layer is started here instead of in the app's lifespan,
+    # so it is ready before the first update arrives
+    async with services.running():
+        await run_bot(bot, LocalTaskClient(), app, API_HOST, API_PORT)
 
 
 async def main() -> None:
     if TOKEN is None:
         raise RuntimeError("BOT_TOKEN is not set in environment")
+    if BOT_UPDATE_MODE not in ("polling", "webhook"):
+        raise RuntimeError(f"Unknown BOT_UPDATE_MODE {BOT_UPDATE_MODE!r}, expected \"polling\" or \"webhook\"")
+    if BOT_UPDATE_MODE == "webhook" and not (WEBHOOK_URL and WEBHOOK_SECRET):
+        raise RuntimeError("WEBHOOK_URL and WEBHOOK_SECRET must be set in webhook mode")
 
     bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    scheduler.start()
-    await dp.start_polling(bot)
+
+    if BOT_API_MODE == "inprocess":
+        await run_in_process(bot)
+    elif BOT_API_MODE == "http":
+        async with TaskAPIClient() as api:
+            await run_bot(bot, api)
+    else:
+        raise RuntimeError(f"Unknown BOT_API_MODE {BOT_API_MODE!r}, expected \"http\" or \"inprocess\"")
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from os import getenv
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+
+# Update queue settings (can be tuned through .env)
+
+# Updates of one user waiting for their turn; more are dropped
+BOT_USER_QUEUE = int(getenv("BOT_USER_QUEUE", "10"))
+# Updates of all users waiting for their turn; while there are this many, new ones wait to get in
+BOT_MAX_QUEUED = int(getenv("BOT_MAX_QUEUED", "1000"))
+
+
+queue_depth = Gauge("bot_update_queue_depth", "Updates waiting for an earlier update of the same user")
+queue_users = Gauge("bot_update_queue_users", "Users whose updates are being handled or waiting")
+in_flight = Gauge("bot_updates_in_flight", "Updates being handled right now")
+queue_wait = Histogram("bot_update_queue_wait_seconds", "Time an update waits before its handler starts")
+user_queue_length = Histogram(
+    "bot_user_queue_length",
+    "Updates of the user already waiting when another one arrives",
+    buckets=tuple(float(n) for n in range(BOT_USER_QUEUE + 1)),
+)
+dropped = Counter("bot_updates_dropped_total", "Updates that were never handled", ("reason",))
+
+for gauge in (queue_depth, queue_users, in_flight):
+    gauge.set(0)
+
+
+Handler = Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]]
+
+
+@dataclass
+class Pending:
+    handler: Handler
+    update: Update
+    data: Dict[str, Any]
+    queued_at: float = field(default_factory=time.perf_counter)
+
+
+# Outer middleware on dp.update that puts every user's updates in a queue of their own.
+# A user's updates are handled one after another in the order they came in, so the steps
+# of a conversation (FSM) never overtake each other; different users' updates are handled
+# at the same time, at most "max_in_flight" of them. Registered after aiogram's own
+# middlewares, so the user is known, and the filters are only checked when the update's
+# turn comes (the state is read again then).
+#
+# A user's queue holds at most "max_per_user" updates, later ones are dropped. A press on
+# an inline button replaces a press on the same message that is still waiting, since only
+# the latest one matters. While "max_queued" updates wait in all, the middleware doesn't
+# return, which slows down polling and webhook deliveries
+
+class UserQueues(BaseMiddleware):
+    def __init__(self, *, max_in_flight: int, max_per_user: int = BOT_USER_QUEUE,
+                 max_queued: int = BOT_MAX_QUEUED):
+        self.max_per_user = max_per_user
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._room = asyncio.Semaphore(max_queued)
+        self._queues: dict[int, deque[Pending]] = {}
+        self._workers: dict[int, asyncio.Task] = {}
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        if user is None or not isinstance(event, Update):
+            async with self._slots:
+                in_flight.inc()
+                try:
+                    return await handler(event, data)
+                finally:
+                    in_flight.dec()
+
+        pending = Pending(handler, event, data)
+        queue = self._queues.get(user.id)
+        if queue is not None:
+            user_queue_length.observe(len(queue))
+            if await self._coalesce(queue, pending):
+                return None
+            if len(queue) >= self.max_per_user:
+                dropped.inc("user_queue_full")
+                logger.debug("Update %s of user %s dropped, %s are waiting already",
+                             event.update_id, user.id, len(queue))
+                return None
+
+        # Waiting for room keeps the order: the semaphore lets waiters in first come, first served
+        await self._room.acquire()
+        queue_depth.inc()
+
+        queue = self._queues.get(user.id)
+        if queue is None:
+            queue = self._queues[user.id] = deque()
+            queue_users.inc()
+            self._workers[user.id] = asyncio.create_task(self._drain(user.id, queue))
+        queue.append(pending)
+        return None
+
+    async def _coalesce(self, queue: deque[Pending], pressed: Pending) -> bool:
+        callback = pressed.update.callback_query
+        if callback is None or callback.message is None:
+            return False
+
+        for i, pending in enumerate(queue):
+            waiting = pending.update.callback_query
+            if waiting is not None and waiting.message is not None \
+                    and waiting.message.message_id == callback.message.message_id:
+                pressed.queued_at = pending.queued_at
+                queue[i] = pressed
+                dropped.inc("coalesced")
+                # Stops the spinner on the button of the press that won't be handled
+                try:
+                    await waiting.answer()
+                except Exception:
+                    logger.debug("Couldn't answer callback query %s", waiting.id, exc_info=True)
+                return True
+        return False
+
+    async def _drain(self, user_id: int, queue: deque[Pending]) -> None:
+        try:
+            while queue:
+                pending = queue.popleft()
+                self._room.release()
+                queue_depth.dec()
+
+                async with self._slots:
+                    queue_wait.observe(time.perf_counter() - pending.queued_at)
+                    in_flight.inc()
+                    try:
+                        # aiogram read the state when the update came in, earlier updates may have changed it since
+                        state = pending.data.get("state")
+                        if state is not None:
+                            pending.data["raw_state"] = await state.get_state()
+                        await pending.handler(pending.update, pending.data)
+                    except Exception:
+                        logger.exception("Update %s of user %s failed", pending.update.update_id, user_id)
+                    finally:
+                        in_flight.dec()
+        finally:
+            del self._queues[user_id]
+            del self._workers[user_id]
+            queue_users.dec()
+
+    # Waiting until all accepted updates of the user are handled
+
+    async def join(self, user_id: int) -> None:
+        worker = self._workers.get(user_id)
+        if worker is not None:
+            await asyncio.gather(worker, return_exceptions=True)
+
+    # Letting updates that were already accepted finish on shutdown
+
+    async def close(self) -> None:
+        if self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
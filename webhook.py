@@ -0,0 +1,59 @@
+import asyncio
+import hmac
+import logging
+from typing import Any
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from fastapi import Request, Response, status
+
+logger = logging.getLogger(__name__)
+
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+# Receives updates that Telegram POSTs to the webhook URL.
+# An update is acknowledged as soon as it is accepted, and handled in the background
+# by at most "max_handlers" tasks at a time. While all of them are busy, the request waits
+# for a free one, so Telegram (which keeps a limited number of connections open,
+# see max_connections of setWebhook) slows down instead of the bot piling up work
+
+class WebhookUpdates:
+    def __init__(self, dp: Dispatcher, bot: Bot, *, secret: str, max_handlers: int, **data: Any):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.data = data
+        self._slots = asyncio.Semaphore(max_handlers)
+        self._tasks: set[asyncio.Task] = set()
+
+    async def handle(self, request: Request) -> Response:
+        token = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            return Response(status_code=status.HTTP_401_UNAUTHORIZED)
+
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError:
+            return Response(status_code=status.HTTP_400_BAD_REQUEST)
+
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return Response(status_code=status.HTTP_200_OK)
+
+    async def _process(self, update: Update) -> None:
+        try:
+            await self.dp.feed_update(self.bot, update, **self.data)
+        except Exception:
+            logger.exception("Update %s failed", update.update_id)
+        finally:
+            self._slots.release()
+
+    # Letting updates that were already acknowledged finish on shutdown
+
+    async def close(self) -> None:
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)